@@ -0,0 +1,318 @@
+# a_rtchat/archive.py
+"""
+Cold storage for old messages.
+
+archive_batch() moves a room's oldest messages out of GroupMessages into a
+segment file under CHAT_ARCHIVE_DIR, <group id>/<first id>-<last id>.jsonl.gz:
+one JSON message per line, gzip-compressed in blocks of BLOCK_SIZE messages.
+Every block is a gzip member of its own, so the file is still plain gzip to
+other tools, and the segment's ArchiveSegment row keeps the offset index
+([created in epoch microseconds, id, byte offset] of each block's first
+message), so a reader only decompresses the blocks it needs.
+
+Rooms are archived oldest first, so a room's archived messages all come before
+its hot ones in (created, id) order and history.page_before() simply reads on
+into the archive with read_before() once the hot rows run out. Search needs no
+help: the search index keeps the rows of archived messages.
+
+Segments are never changed in place; rewrite_segment() replaces one with a new
+file. That is how archived messages are deleted (redact()), expired
+(expire_segment()) and erased with their author's account (erase_author(),
+which finds the segments through ArchiveSegment.authors). Archived messages
+can no longer be edited, and their edit history is kept in their line, though
+the history viewer only serves hot messages; the chat hides both controls on
+archived rows.
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ArchiveSegment, GroupMessages
+from .sidebar import EPOCH
+
+# Messages per compressed block
+BLOCK_SIZE = 64
+# Messages per segment (and per archiving transaction) unless told otherwise
+BATCH_SIZE = 1000
+
+
+class ArchiveConflict(Exception):
+    """A message was edited or deleted while its batch was being archived."""
+
+
+def archive_dir():
+    return str(getattr(settings, 'CHAT_ARCHIVE_DIR', settings.BASE_DIR / 'archive'))
+
+
+def archive_after():
+    """How old a message must be before it is archived."""
+    return timedelta(days=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180))
+
+
+def full_path(path):
+    return os.path.join(archive_dir(), path)
+
+
+def micros(when):
+    return (when - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
+def to_line(message):
+    data = {
+        'id': message.id,
+        'author_id': message.author_id,
+        'body': message.body,
+        'created': micros(message.created),
+        'edited': message.edited,
+        'edited_at': micros(message.edited_at) if message.edited_at else None,
+        'is_deleted': message.is_deleted,
+    }
+    revisions = archived_revisions(message)
+    if revisions:
+        # Edit history (a_rtchat/revisions.py): [number, written_at micros, delta]
+        data['revisions'] = revisions
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def archived_revisions(message):
+    if hasattr(message, 'archived_revisions'):
+        return message.archived_revisions
+    return [[row.number, micros(row.written_at), row.delta] for row in message.revisions.all()]
+
+
+def from_line(data, group_id):
+    """An unsaved GroupMessages standing in for an archived message, renderable like a hot one."""
+    message = GroupMessages(
+        id=data['id'],
+        group_id=group_id,
+        author_id=data['author_id'],
+        body=data['body'],
+        created=from_micros(data['created']),
+        edited=data['edited'],
+        edited_at=from_micros(data['edited_at']) if data['edited_at'] is not None else None,
+        is_deleted=data['is_deleted'],
+    )
+    message.archived_revisions = data.get('revisions', [])
+    message.archived = True
+    return message
+
+
+def write_segment(path, messages):
+    """Write `messages` (oldest first) to the segment file at `path`; returns (blocks, size)."""
+    target = full_path(path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    blocks = []
+    with open(target + '.tmp', 'wb') as f:
+        for start in range(0, len(messages), BLOCK_SIZE):
+            block = messages[start:start + BLOCK_SIZE]
+            blocks.append([micros(block[0].created), block[0].id, f.tell()])
+            lines = ''.join(to_line(message) + '\n' for message in block)
+            f.write(gzip.compress(lines.encode(), mtime=0))
+        size = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(target + '.tmp', target)
+    return blocks, size
+
+
+def record_segment(group_id, path, messages, blocks, size):
+    """The ArchiveSegment row of the file just written at `path`, linked to its authors."""
+    first, last = messages[0], messages[-1]
+    segment = ArchiveSegment.objects.create(
+        group_id=group_id, path=path, count=len(messages), size=size, blocks=blocks,
+        first_id=first.id, first_created=first.created, last_id=last.id, last_created=last.created,
+    )
+    # Lines written before an account was erased may name it still
+    segment.authors.set(User.objects.filter(id__in={message.author_id for message in messages}))
+    return segment
+
+
+def archive_batch(group_id, before, limit=BATCH_SIZE):
+    """
+    Move up to `limit` of the room's oldest messages created before `before`
+    into a new segment. The file is written first, outside any transaction;
+    the transaction that records the segment and deletes the rows is short.
+    Returns how many messages were moved (0 when none are left, or when one of
+    them changed meanwhile; they are archived on a later run).
+    """
+    messages = list(
+        GroupMessages.objects.filter(group_id=group_id, created__lt=before)
+        .prefetch_related('revisions').order_by('created', 'id')[:limit]
+    )
+    if not messages:
+        return 0
+    first, last = messages[0], messages[-1]
+    path = f'{group_id}/{first.id}-{last.id}.jsonl.gz'
+    blocks, size = write_segment(path, messages)
+    ids = [message.id for message in messages]
+    try:
+        with transaction.atomic():
+            record_segment(group_id, path, messages, blocks, size)
+            # Only the versions just written: an edit since then aborts the batch
+            unchanged = Q(changed_at__isnull=True)
+            changed = [message.changed_at for message in messages if message.changed_at]
+            if changed:
+                unchanged |= Q(changed_at__lte=max(changed))
+            _, deleted = GroupMessages.objects.filter(id__in=ids).filter(unchanged).delete()
+            if deleted.get(GroupMessages._meta.label, 0) != len(ids):
+                raise ArchiveConflict(path)
+    except ArchiveConflict:
+        os.remove(full_path(path))
+        return 0
+    except Exception:
+        os.remove(full_path(path))
+        raise
+    return len(messages)
+
+
+def read_segment_before(segment, key, limit):
+    """Up to `limit` messages of `segment` before (created micros, id) `key` (all without one), newest first."""
+    found = []
+    ends = [block[2] for block in segment.blocks[1:]] + [segment.size]
+    with open(full_path(segment.path), 'rb') as f:
+        for (first_created, first_id, offset), end in reversed(list(zip(segment.blocks, ends))):
+            if key and (first_created, first_id) >= key:
+                continue
+            f.seek(offset)
+            lines = gzip.decompress(f.read(end - offset)).decode().splitlines()
+            for line in reversed(lines):
+                data = json.loads(line)
+                if key and (data['created'], data['id']) >= key:
+                    continue
+                found.append(from_line(data, segment.group_id))
+                if len(found) == limit:
+                    return found
+    return found
+
+
+def _read_before(group_id, position, limit):
+    segments = ArchiveSegment.objects.filter(group_id=group_id).order_by('-last_created', '-last_id')
+    key = None
+    if position:
+        created, message_id = position
+        key = (micros(created), message_id)
+        segments = segments.filter(Q(first_created__lt=created) | Q(first_created=created, first_id__lt=message_id))
+    found = []
+    # Every segment holds at least one message
+    for segment in segments[:limit]:
+        found += read_segment_before(segment, key, limit - len(found))
+        if len(found) == limit:
+            break
+    return found
+
+
+def read_before(group_id, position=None, limit=BATCH_SIZE):
+    """
+    Up to `limit` of the room's archived messages before (created, id)
+    `position` (the newest without one), newest first, with their authors
+    loaded. Messages whose author has since been deleted are skipped, as their
+    hot messages were deleted with them.
+    """
+    found = []
+    while len(found) < limit:
+        batch = _read_before(group_id, position, limit - len(found))
+        if not batch:
+            break
+        position = (batch[-1].created, batch[-1].id)
+        authors = User.objects.select_related('profile').in_bulk({message.author_id for message in batch})
+        for message in batch:
+            if message.author_id in authors:
+                message.author = authors[message.author_id]
+                found.append(message)
+    return found
+
+
+def segment_messages(segment):
+    """Every message of `segment`, oldest first (authors not loaded)."""
+    with gzip.open(full_path(segment.path), 'rt') as f:
+        return [from_line(json.loads(line), segment.group_id) for line in f]
+
+
+def rewrite_segment(segment, messages):
+    """
+    Replace `segment` with a new one holding `messages` (oldest first), or
+    just drop it when there are none. Run it in a transaction; the old file
+    goes once it commits.
+    """
+    if messages:
+        first, last = messages[0], messages[-1]
+        path = f'{segment.group_id}/{first.id}-{last.id}.jsonl.gz'
+        if path == segment.path or os.path.exists(full_path(path)):
+            # The old file is removed on commit, so the new one needs a name of its own
+            path = f'{segment.group_id}/{first.id}-{last.id}.{segment.id}.jsonl.gz'
+        blocks, size = write_segment(path, messages)
+        record_segment(segment.group_id, path, messages, blocks, size)
+    segment.delete()
+
+
+def expire_segment(segment, before):
+    """Drop the messages created before `before` from `segment`; returns those dropped."""
+    messages = segment_messages(segment)
+    expired = [message for message in messages if message.created < before]
+    if expired:
+        rewrite_segment(segment, [message for message in messages if message.created >= before])
+    return expired
+
+
+def erase_author(user_id):
+    """Drop every archived message of `user_id`, whose account is being deleted; returns their ids."""
+    erased = []
+    for segment in ArchiveSegment.objects.filter(authors=user_id).order_by('id'):
+        messages = segment_messages(segment)
+        erased += [message.id for message in messages if message.author_id == user_id]
+        rewrite_segment(segment, [message for message in messages if message.author_id != user_id])
+    return erased
+
+
+def redact(author_id, message_ids):
+    """
+    Delete the archived messages among `message_ids` written by `author_id`:
+    their lines are rewritten as deleted, without body or edit history.
+    Returns the messages deleted (authors not loaded). Run it in a transaction.
+    """
+    wanted = set(message_ids)
+    if not wanted:
+        return []
+    # Ids follow send order, so only segments spanning the ids can hold them
+    segments = ArchiveSegment.objects.filter(authors=author_id, first_id__lte=max(wanted), last_id__gte=min(wanted))
+    deleted = []
+    for segment in segments.order_by('id'):
+        messages = segment_messages(segment)
+        found = [m for m in messages if m.id in wanted and m.author_id == author_id and not m.is_deleted]
+        if not found:
+            continue
+        for message in found:
+            message.is_deleted = True
+            message.body = ''
+            message.archived_revisions = []
+        rewrite_segment(segment, messages)
+        deleted += found
+    return deleted
+
+
+def archived_messages():
+    """
+    Every archived message, room by room, oldest first (authors not loaded),
+    but for those of deleted accounts that are still in a segment file.
+    """
+    for segment in ArchiveSegment.objects.order_by('id').iterator():
+        messages = segment_messages(segment)
+        authors = set(User.objects.filter(id__in={m.author_id for m in messages}).values_list('id', flat=True))
+        yield from (message for message in messages if message.author_id in authors)
+
+
+def remove_file(segment):
+    try:
+        os.remove(full_path(segment.path))
+    except FileNotFoundError:
+        pass
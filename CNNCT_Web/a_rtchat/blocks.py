@@ -0,0 +1,29 @@
+# a_rtchat/blocks.py
+"""
+Block relationships as seen by a chat socket.
+
+A socket loads, once at connect, who has blocked its user. profile_block_user
+and profile_unblock_user push a block_update_handler event to the blocked
+user's sockets, so the send path never has to query BlockedUser: a message to
+a private room is dropped when the room's other member is in that set.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from a_users.models import BlockedUser
+
+from .sidebar import user_channel_group
+
+
+def blocked_by(user):
+    """Ids of the users who have blocked `user`."""
+    return set(BlockedUser.objects.filter(blocked=user).values_list('blocker_id', flat=True))
+
+
+def push_block_change(blocker, blocked, is_blocked):
+    """Tell every socket of `blocked` that `blocker` has (un)blocked them."""
+    async_to_sync(get_channel_layer().group_send)(user_channel_group(blocked.id), {
+        'type': 'block_update_handler',
+        'blocker_id': blocker.id,
+        'blocked': is_blocked,
+    })
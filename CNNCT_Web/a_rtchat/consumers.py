@@ -1,141 +1,455 @@
-from channels.generic.websocket import WebsocketConsumer
-from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string     
-from .models import *
-from a_users.models import BlockedUser
-from asgiref.sync import async_to_sync
-import json
-from channels.generic.websocket import WebsocketConsumer
-from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string     
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.template.loader import render_to_string
 from .models import *
-import json
+from . import blocks, history, inbox, nonces, presence, protocol, ratelimit, receipts, rooms, search, typists
+from .fanout import merge_frames, message_event, viewer_html
+from .sidebar import sidebar_events, user_channel_group
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    One socket per user for all of their rooms (see a_rtchat/rooms.py).
+
+    At connect the socket subscribes to every room the user is a member of
+    and is present in all of them. The page says which room it shows with an
+    {"type": "open", "room": ...} frame; room events (new messages, edits,
+    ticks, online counts) are only forwarded for that room, while sidebar
+    updates come from every room. Switching rooms is one small frame instead
+    of a new connection. ws/chatroom/<chatroom_name> opens that room right
+    away.
+
+    An open frame may carry "after", the last message id the client has; the
+    reply is then one frame with everything it missed (see resume()). Sends
+    may carry a client nonce, and a retransmit within CHAT_NONCE_WINDOW is
+    not stored twice (a_rtchat/nonces.py). {"type": "typing"} frames never
+    touch the database and are throttled per user and per room
+    (a_rtchat/typists.py).
+
+    Browsers get htmx OOB fragments. A client that offers a subprotocol from
+    protocol.SUBPROTOCOLS gets JSON or msgpack events instead, already encoded
+    in the channel-layer event (see a_rtchat/protocol.py).
 
-class ChatroomConsumer(WebsocketConsumer):
-    def connect(self):
+    Runs on the event loop; channel-layer calls are awaited directly and each
+    event's DB work is grouped into a single database_sync_to_async section,
+    so an idle socket holds no thread.
+
+    Outbound frames go through a bounded per-socket queue drained by a writer
+    task, which coalesces whatever text fragments arrive within
+    CHAT_COALESCE_WINDOW_MS into one frame (see merge_frames). Clients
+    acknowledge what they have read with {"type": "received", "seq": n}, n
+    being the number of frames received on the socket so far; a client that
+    leaves CHAT_OUTBOX_FRAMES frames unacknowledged is disconnected rather than
+    buffered without limit. The bound holds on any server: Daphne's send()
+    returns before the frame reaches the client, so the queue alone would
+    never fill there.
+    """
+
+    # Close code for a client that could not keep up with its frames
+    CLOSE_TOO_SLOW = 4008
+    # Wire format: None speaks htmx HTML, otherwise 'json' or 'msgpack' (set at connect)
+    format = None
+    # Newest message id of the open room already sent in a resume frame
+    resumed_to = 0
+    # Frames written to the socket, and how many of them the client has acknowledged
+    sent = 0
+    received = 0
+    dropped = False
+
+    async def connect(self):
         self.user = self.scope['user']
-        self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
-        self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)  
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.rooms = {}
+        self.active = None
+        # Room name -> when this socket last reported its user typing there
+        self.typing_at = {}
+        self.subprotocol = protocol.negotiate(self.scope.get('subprotocols', []))
+        self.format = protocol.SUBPROTOCOLS.get(self.subprotocol)
+        # Personal group for live sidebar updates, block and membership changes. Joined
+        # before anything is loaded so a change made in between is not missed.
+        await self.channel_layer.group_add(user_channel_group(self.user.id), self.channel_name)
 
-        async_to_sync(self.channel_layer.group_add)(
-            self.chatroom_name, self.channel_name
-        )
+        initial = self.scope['url_route']['kwargs'].get('chatroom_name')
+        joined = await self.join_rooms(initial)
+        if joined is None:
+            # Unknown room: reject the handshake
+            await self.channel_layer.group_discard(user_channel_group(self.user.id), self.channel_name)
+            await self.close()
+            return
+        first_in, online_counts, delivered = joined
+        self.heartbeat = asyncio.create_task(self.keep_presence())
 
-        #add and update users that are online
-        if self.user not in self.chatroom.users_online.all():
-            self.chatroom.users_online.add(self.user)
-            self.update_online_count()
-        self.accept()
+        for name in self.rooms:
+            await self.channel_layer.group_add(name, self.channel_name)
+        await self.accept(subprotocol=self.subprotocol)
+        self.outbox = asyncio.Queue(maxsize=getattr(settings, 'CHAT_OUTBOX_FRAMES', 256))
+        self.writer = asyncio.create_task(self.drain_outbox())
 
-        # Mark inbound messages as delivered now that the recipient is connected to this room
-        self.mark_inbound_as_delivered()
-    
+        for name in first_in:
+            await self.update_online_count(name, online_counts[name])
+        if initial:
+            await self.activate(initial, online_counts[initial], announced=initial in first_in)
+        # Inbound messages were marked as delivered now that the recipient is connected
+        for event in delivered:
+            await self.channel_layer.group_send(event['room'], event)
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-            self.chatroom_name, self.channel_name
-        )
-        #remove and update users
-        if self.user in self.chatroom.users_online.all():
-            self.chatroom.users_online.remove(self.user)
-            self.update_online_count()
-        # Do not call accept() on disconnect
-
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        body = text_data_json['body']
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'heartbeat'):
+            return
+        self.heartbeat.cancel()
+        if hasattr(self, 'writer'):
+            self.writer.cancel()
+        for name in self.rooms:
+            await self.channel_layer.group_discard(name, self.channel_name)
+        await self.channel_layer.group_discard(user_channel_group(self.user.id), self.channel_name)
+        online_counts = await self.leave_rooms(list(self.rooms.values()))
+        for name, online_count in online_counts.items():
+            await self.update_online_count(name, online_count)
+
+    async def keep_presence(self):
+        # Refresh this socket's presence entries; if the worker dies they just expire
+        while True:
+            await asyncio.sleep(presence.HEARTBEAT_SECONDS)
+            await sync_to_async(presence.heartbeat_rooms, thread_sensitive=False)(
+                [room['id'] for room in self.rooms.values()], self.user.id, self.channel_name
+            )
+
+    async def send(self, text_data=None, bytes_data=None, close=False, key=None):
+        """
+        Queue a frame for the writer. Fragments sharing a `key` replace each other
+        when coalesced, so only the newest online count or tick update goes out.
+        """
+        if not hasattr(self, 'outbox') or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        try:
+            self.outbox.put_nowait((key, text_data, bytes_data))
+        except asyncio.QueueFull:
+            await self.drop_slow_client()
+
+    async def drain_outbox(self):
+        window = getattr(settings, 'CHAT_COALESCE_WINDOW_MS', 0) / 1000
+        unacknowledged = getattr(settings, 'CHAT_OUTBOX_FRAMES', 256)
+        while True:
+            frames = [await self.outbox.get()]
+            # Let the rest of a burst arrive, then write it all at once
+            await asyncio.sleep(window)
+            while not self.outbox.empty():
+                frames.append(self.outbox.get_nowait())
+            for text_data, bytes_data in merge_frames(frames):
+                if self.sent - self.received >= unacknowledged:
+                    # The client is not reading what it was sent, or not acknowledging it
+                    await self.drop_slow_client()
+                    return
+                await super().send(text_data=text_data, bytes_data=bytes_data)
+                self.sent += 1
+
+    async def drop_slow_client(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        await sync_to_async(ratelimit.count_overflow, thread_sensitive=False)()
+        await self.close(code=self.CLOSE_TOO_SLOW)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = protocol.decode(text_data, bytes_data)
+        if data.get('type') == 'received':
+            try:
+                # Never more than was sent, so a client cannot pre-acknowledge frames
+                self.received = max(self.received, min(int(data.get('seq')), self.sent))
+            except (TypeError, ValueError):
+                pass
+            return
+        if data.get('type') == 'open':
+            await self.open(data.get('room'), data.get('after'))
+            return
+        if data.get('type') == 'typing':
+            await self.typing(data.get('room') or self.active)
+            return
+
+        room = self.rooms.get(data.get('room') or self.active)
+        if room is None:
+            return
+        body = data['body']
         # Enforce max length of 25,000 characters
         if body:
             body = body[:25000]
 
-        # Prevent sending if any recipient has blocked the author
-        if self.chatroom.is_private:
-            for member in self.chatroom.members.all():
-                if member.id == self.user.id:
-                    continue
-                # If recipient has blocked current user, do not deliver
-                if BlockedUser.objects.filter(blocker=member, blocked=self.user).exists():
-                    # Silently drop; optionally could send not-delivered notice to sender
-                    return
+        if room['is_private'] and room['peer_id'] in self.blocked_by:
+            # The recipient has blocked the author: silently drop
+            return
+        nonce = str(data.get('nonce') or '')[:nonces.MAX_LENGTH]
+        if nonce:
+            original = await sync_to_async(nonces.claim, thread_sensitive=False)(self.user.id, nonce)
+            if original is not None:
+                # A retransmit of a message already stored (or being stored)
+                await self.acknowledge(room['group_name'], nonce, original)
+                return
+        if not await sync_to_async(ratelimit.allow, thread_sensitive=False)(self.user.id):
+            # Sending faster than the limit: drop before any render or insert
+            if nonce:
+                await sync_to_async(nonces.release, thread_sensitive=False)(self.user.id, nonce)
+            return
+        message, sidebar, delivered = await self.create_message(room, body, nonce)
 
-        # Use the chatroom we fetched in connect()
-        message = GroupMessages.objects.create(
-            body=body,
-            author=self.user,
-            group=self.chatroom
-        )
+        await self.channel_layer.group_send(room['group_name'], message)
+        for target, event in sidebar:
+            await self.channel_layer.group_send(target, event)
+        if delivered:
+            # re-render ticks for author
+            await self.channel_layer.group_send(room['group_name'], delivered)
 
-        context = {
-            'message': message,
-            'user': self.user,
-        }
-        html = render_to_string("a_rtchat/partials/chat_messages_p.html", context=context)
+    async def open(self, name, after=None):
+        """
+        Show `name` on this socket, subscribing to it first if it is a room the
+        socket doesn't follow yet, and resume it from message `after` if given.
+        """
+        if after is not None:
+            try:
+                after = int(after)
+            except (TypeError, ValueError):
+                # Not a message id: open the room without resuming it
+                after = None
+        if name not in self.rooms:
+            joined = await self.follow_room(name)
+            if joined is None:
+                return
+            first_in, online_count, delivered = joined
+            if first_in:
+                await self.update_online_count(name, online_count)
+            if delivered:
+                await self.channel_layer.group_send(name, delivered)
+            await self.activate(name, online_count, announced=first_in)
+        else:
+            online_count = (await sync_to_async(presence.online_users_by_room, thread_sensitive=False)(
+                [self.rooms[name]['id']]
+            ))[self.rooms[name]['id']]
+            await self.activate(name, len(online_count) - 1)
+        if after is not None:
+            await self.resume(name, after)
 
-        event = {
-            'type' : 'message_handler', 
-            'message_id' : message.id,
-        }
+    async def resume(self, name, after):
+        """
+        Send, as one frame, the messages of `name` after `after` and the edits and
+        deletes of older ones since. Channel-layer events are handled one at a time,
+        so new messages that race the query are only forwarded afterwards, and are
+        skipped if the frame already had them. If the frame had to stop short
+        (`more`), new messages wait for the client to resume again.
+        """
+        text_data, bytes_data, newest, more = await self.missed(name, after)
+        self.resumed_to = float('inf') if more else newest
+        await self.send(text_data=text_data, bytes_data=bytes_data)
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.chatroom_name, event
+    async def typing(self, name):
+        room = self.rooms.get(name)
+        if room is None or (room['is_private'] and room['peer_id'] in self.blocked_by):
+            return
+        # Keystroke reports within the interval are dropped here, before any round trip
+        now = time.monotonic()
+        if now - self.typing_at.get(name, float('-inf')) < typists.interval():
+            return
+        self.typing_at[name] = now
+        event = await sync_to_async(typists.typing, thread_sensitive=False)(
+            room['id'], name, self.user.id, self.display_name
         )
+        if event:
+            await self.channel_layer.group_send(name, event)
 
-        # Mark as delivered for other members currently connected (excluding author)
-        for member in self.chatroom.members.all():
-            if member.id == self.user.id:
-                continue
-            # If recipient is online in this room, update to delivered immediately
-            if member in self.chatroom.users_online.all():
-                try:
-                    msg = GroupMessages.objects.get(id=message.id)
-                    if msg.status < GroupMessages.STATUS_DELIVERED:
-                        msg.status = GroupMessages.STATUS_DELIVERED
-                        msg.save(update_fields=['status'])
-                        # Push a message update to re-render ticks for author
-                        upd = { 'type': 'message_update_handler', 'message_id': msg.id }
-                        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, upd)
-                except GroupMessages.DoesNotExist:
-                    pass
-
-    def message_handler(self, event):
-        message_id= event['message_id']
-        message= GroupMessages.objects.get(id=message_id)
-        context = {
-            'message': message,
-            'user' : self.user,
-        }
-        html = render_to_string("a_rtchat/partials/chat_messages_p.html",context=context)
-        self.send(text_data=html)
-    
-    def message_update_handler(self, event):
-        message_id = event['message_id']
-        message = GroupMessages.objects.get(id=message_id)
-        context = {
-            'message': message,
-            'user': self.user,
-        }
-        # Send single-item render to replace existing li via OOB swap
-        html = render_to_string("a_rtchat/chat_message.html", context=context)
-        self.send(text_data=html)
-    
-    def update_online_count(self):
-        online_count = self.chatroom.users_online.count() -1
-
-        event = {
+    async def acknowledge(self, name, nonce, message_id):
+        # Browsers don't track their sends; only structured clients get an ack
+        if self.format is not None:
+            await self.send_payload(protocol.ack_payload(name, nonce, message_id))
+
+    async def send_payload(self, payload):
+        """A structured event meant for this socket only, encoded in its format alone."""
+        await self.send(*self.payload_frame(payload))
+
+    def payload_frame(self, payload):
+        data = protocol.encode_as(payload, self.format)
+        return (None, data) if self.format == 'msgpack' else (data, None)
+
+    async def activate(self, name, online_count, announced=False):
+        self.active = name
+        self.resumed_to = 0
+        if not announced:
+            # Nobody else needed telling; just give this socket the count
+            event = self.online_count_event(name, online_count)
+            await self.forward(event['html'], event['wire'], key='online-count')
+
+    # Room events are only forwarded for the room this socket shows
+
+    def shows(self, event):
+        return event.get('room') == self.active
+
+    async def forward(self, html, wire, key=None):
+        """Send an event's HTML, or its pre-encoded frame in this socket's format."""
+        if self.format is None:
+            await self.send(text_data=html, key=key)
+            return
+        text_data, bytes_data = protocol.frame(wire, self.format)
+        await self.send(text_data=text_data, bytes_data=bytes_data, key=key)
+
+    # Handlers only pick the pre-rendered variant for this viewer: no DB access
+
+    async def message_handler(self, event):
+        if self.shows(event) and event['message_id'] > self.resumed_to:
+            await self.forward(viewer_html(event, self.user.id), event['wire'])
+
+    async def message_update_handler(self, event):
+        # Single-item render replaces the existing li via OOB swap
+        if self.shows(event):
+            await self.forward(viewer_html(event, self.user.id), event['wire'], key=f'message-{event["message_id"]}')
+
+    async def message_status_handler(self, event):
+        if self.shows(event):
+            variant = receipts.viewer_status_key(event, self.user.id)
+            await self.forward(event['html'][variant], event['wire'][variant], key='message-status')
+
+    async def online_count_handler(self, event):
+        if self.shows(event):
+            await self.forward(event['html'], event['wire'], key='online-count')
+
+    async def typing_handler(self, event):
+        if self.shows(event) and event['typists'] != [self.user.id]:
+            variant = typists.viewer_key(event, self.user.id)
+            await self.forward(event['html'][variant], event['wire'], key='typing')
+
+    async def purge_handler(self, event):
+        if self.shows(event):
+            await self.forward(event['html'], event['wire'])
+
+    async def sidebar_item_handler(self, event):
+        await self.forward(event['html'], event['wire'], key=f'sidebar-{event["item"]["group"]["group_name"]}')
+
+    async def block_update_handler(self, event):
+        if event['blocked']:
+            self.blocked_by.add(event['blocker_id'])
+        else:
+            self.blocked_by.discard(event['blocker_id'])
+
+    async def room_membership_handler(self, event):
+        name = event['room']
+        if event['joined'] and name not in self.rooms:
+            joined = await self.follow_room(name)
+            if joined and joined[0]:
+                await self.update_online_count(name, joined[1])
+            if joined and joined[2]:
+                await self.channel_layer.group_send(name, joined[2])
+        elif not event['joined'] and name in self.rooms:
+            room = self.rooms.pop(name)
+            await self.channel_layer.group_discard(name, self.channel_name)
+            online_counts = await self.leave_rooms([room])
+            if name in online_counts:
+                await self.update_online_count(name, online_counts[name])
+            if self.active == name:
+                self.active = None
+
+    async def update_online_count(self, name, online_count):
+        await self.channel_layer.group_send(name, self.online_count_event(name, online_count))
+
+    def online_count_event(self, name, online_count):
+        return {
             'type': 'online_count_handler',
-            'online_count': online_count
+            'room': name,
+            'html': render_to_string("a_rtchat/partials/online_count.html", {'online_count': online_count}),
+            'wire': protocol.encode(protocol.online_payload(name, online_count)),
         }
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
-
-    def online_count_handler(self, event):
-        online_count = event['online_count']
-        html= render_to_string("a_rtchat/partials/online_count.html", {'online_count' : online_count})
-        self.send(text_data=html)
-
-    def mark_inbound_as_delivered(self):
-        inbound = GroupMessages.objects.filter(group=self.chatroom).exclude(author=self.user)
-        updated = inbound.filter(status__lt=GroupMessages.STATUS_DELIVERED).update(status=GroupMessages.STATUS_DELIVERED)
-        if updated:
-            for mid in inbound.values_list('id', flat=True):
-                upd = { 'type': 'message_update_handler', 'message_id': mid }
-                async_to_sync(self.channel_layer.group_send)(self.chatroom_name, upd)
\ No newline at end of file
+
+    # Database (and presence) sections: each runs in one trip to the sync thread
+
+    @database_sync_to_async
+    def join_rooms(self, initial=None):
+        """
+        Subscribe to the user's rooms (plus `initial` if given). Returns (names of the
+        rooms the user just came online in, {name: online count}, status events for
+        inbound messages now delivered), or None to reject an unknown `initial` room.
+        """
+        self.rooms = rooms.user_rooms(self.user)
+        if initial and initial not in self.rooms:
+            room = rooms.open_room(self.user, initial)
+            if room is None:
+                return None
+            self.rooms[initial] = room
+        self.blocked_by = blocks.blocked_by(self.user)
+        self.display_name = self.user.profile.name
+
+        by_id = {room['id']: name for name, room in self.rooms.items()}
+        first_in = presence.connect_rooms(by_id, self.user.id, self.channel_name)
+        online = presence.online_users_by_room(by_id)
+        online_counts = {by_id[gid]: len(users) - 1 for gid, users in online.items()}
+        delivered = receipts.mark_delivered_rooms(by_id, self.user.id)
+        return {by_id[gid] for gid in first_in}, online_counts, delivered
+
+    async def follow_room(self, name):
+        """Subscribe to one more room. Returns (first socket in it, online count, status event or None), or None."""
+        joined = await self.join_one_room(name)
+        if joined is not None:
+            await self.channel_layer.group_add(name, self.channel_name)
+        return joined
+
+    @database_sync_to_async
+    def join_one_room(self, name):
+        room = rooms.open_room(self.user, name)
+        if room is None:
+            return None
+        self.rooms[name] = room
+        first_in = presence.connect(room['id'], self.user.id, self.channel_name)
+        online_count = len(presence.online_user_ids(room['id'])) - 1
+        delivered = receipts.mark_delivered(room['id'], [self.user.id])
+        return first_in, online_count, delivered
+
+    @database_sync_to_async
+    def missed(self, name, after):
+        """(text_data, bytes_data) of the resume frame for `name`, the newest message id in it, and `more`."""
+        new, changed, more = history.missed(self.rooms[name]['id'], after)
+        newest = max([after] + [message.id for message in new])
+        if self.format is None:
+            html = render_to_string('a_rtchat/partials/resume.html', {
+                'new_messages': new, 'changed_messages': changed, 'more': more, 'user': self.user,
+            })
+            return html, None, newest, more
+        return *self.payload_frame(protocol.resume_payload(name, after, new, changed, more)), newest, more
+
+    @sync_to_async(thread_sensitive=False)
+    def leave_rooms(self, left):
+        """{name: online count} to broadcast for the rooms where this was the user's last socket."""
+        names = {room['id']: room['group_name'] for room in left}
+        last_in = presence.disconnect_rooms(names, self.user.id, self.channel_name)
+        if not last_in:
+            return {}
+        online = presence.online_users_by_room(last_in)
+        return {names[gid]: len(users) - 1 for gid, users in online.items()}
+
+    @database_sync_to_async
+    def create_message(self, room, body, nonce=''):
+        """Returns (message event, sidebar events, delivery status event or None)."""
+        try:
+            message = GroupMessages.objects.create(
+                body=body,
+                author=self.user,
+                group_id=room['id'],
+            )
+        except Exception:
+            if nonce:
+                nonces.release(self.user.id, nonce)
+            raise
+        if nonce:
+            nonces.record(self.user.id, nonce, message.id)
+        inbox.record_message(message)
+        search.index_message(message)
+
+        event = message_event(message, nonce)
+
+        # Delivered to every other member currently connected
+        online = presence.online_user_ids(room['id']) - {self.user.id}
+        delivered = receipts.mark_delivered(room['id'], online, up_to_id=message.id)
+        return event, sidebar_events(message.group), delivered
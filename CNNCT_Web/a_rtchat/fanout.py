@@ -0,0 +1,95 @@
+# a_rtchat/fanout.py
+"""
+Render-once events for the chatroom sockets.
+
+A message looks the same to everyone except its author, so it is rendered
+once per viewer variant ('own' and 'others') when the event is built and the
+HTML travels in the event. Consumers pick their variant without touching the
+database. The same goes for the structured protocol: 'wire' carries the event
+already encoded in each format (see a_rtchat/protocol.py).
+"""
+from django.template.loader import render_to_string
+
+from . import protocol
+from .models import GroupMessages
+from .receipts import annotate_ticks
+
+NEW_MESSAGE_TEMPLATE = 'a_rtchat/partials/chat_messages_p.html'
+UPDATE_TEMPLATE = 'a_rtchat/chat_message.html'
+
+
+def render_variants(message, template_name):
+    """{'own': the author's bubble, 'others': everyone else's}."""
+    return {
+        'own': render_to_string(template_name, {'message': message, 'user': message.author}),
+        'others': render_to_string(template_name, {'message': message, 'user': None}),
+    }
+
+
+def message_event(message, nonce=None):
+    # Nobody has received a message that was just created
+    message._tick = GroupMessages.STATUS_SENT
+    return {
+        'type': 'message_handler',
+        'room': message.group.group_name,
+        'message_id': message.id,
+        'author_id': message.author_id,
+        'html': render_variants(message, NEW_MESSAGE_TEMPLATE),
+        'wire': protocol.encode(protocol.message_payload(message, nonce=nonce)),
+    }
+
+
+def update_events(message_ids):
+    """One message_update_handler event per message, with authors and profiles fetched in one query."""
+    return message_update_events(
+        GroupMessages.objects.filter(id__in=message_ids).select_related('author__profile', 'group').order_by('id')
+    )
+
+
+def message_update_events(messages):
+    """update_events() for messages already loaded with their author and group, such as archived ones."""
+    messages = annotate_ticks(list(messages))
+    return [
+        (message.group.group_name, {
+            'type': 'message_update_handler',
+            'room': message.group.group_name,
+            'message_id': message.id,
+            'author_id': message.author_id,
+            'html': render_variants(message, UPDATE_TEMPLATE),
+            'wire': protocol.encode(protocol.message_payload(message, 'message_update')),
+        })
+        for message in messages
+    ]
+
+
+def merge_frames(frames):
+    """
+    Coalesce queued (key, text, bytes) frames into as few frames as possible.
+    htmx applies every top-level OOB fragment of a frame and structured
+    clients read a frame as a stream of events, so consecutive text frames are
+    joined with newlines and consecutive binary (msgpack) frames are simply
+    concatenated. Of the frames sharing a key only the last is kept, in its own
+    place.
+    """
+    merged = []
+    fragments, binary = {}, False
+
+    def flush():
+        if fragments:
+            joined = b''.join(fragments.values()) if binary else '\n'.join(fragments.values())
+            merged.append((None, joined) if binary else (joined, None))
+            fragments.clear()
+
+    for n, (key, text_data, bytes_data) in enumerate(frames):
+        if (bytes_data is not None) != binary:
+            flush()
+            binary = bytes_data is not None
+        key = n if key is None else key
+        fragments.pop(key, None)
+        fragments[key] = text_data if bytes_data is None else bytes_data
+    flush()
+    return merged
+
+
+def viewer_html(event, user_id):
+    return event['html']['own' if event['author_id'] == user_id else 'others']
@@ -35,10 +35,16 @@ class NewGroupForm(ModelForm):
 class ChatRoomEditForm(ModelForm):
     class Meta:
         model = ChatGroup   
-        fields=['groupchat_name']
+        fields=['groupchat_name', 'retention_days']
+        labels={
+            'retention_days': 'Delete messages after',
+        }
         widgets={
             'groupchat_name': forms.TextInput(attrs={
                 'class':'p-4 text-xl font-bold mb-4',
                 'maxlength':'300'
             }),
+            'retention_days': forms.Select(attrs={
+                'class':'p-2 rounded-lg border border-gray-300',
+            }),
         }
\ No newline at end of file
@@ -0,0 +1,80 @@
+# a_rtchat/history.py
+"""
+Reading a room's messages outside the live stream.
+
+page_before() is scrollback: pages of older messages, keyset-paginated on
+(created, id) so every page costs one index range scan however deep the
+user scrolls, and reading on into the room's archived segments (see
+a_rtchat/archive.py) once the hot rows run out. missed() is what a reconnecting socket asks for: given the
+last message it saw, the messages sent since and the older ones edited or
+deleted since.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Subquery
+
+from . import archive
+from .models import GroupMessages
+from .receipts import annotate_ticks
+from .sidebar import EPOCH, decode_cursor
+
+PAGE_SIZE = 30
+
+
+def page_before(group_id, cursor=None, limit=PAGE_SIZE):
+    """
+    The `limit` messages of the room just before `cursor` (the newest ones
+    without a cursor), oldest first for prepending. Returns (messages,
+    next_cursor); next_cursor is None once the start of the room is reached.
+    """
+    rows = (
+        GroupMessages.objects.filter(group_id=group_id)
+        .select_related('author__profile')
+        .order_by('-created', '-id')
+    )
+    position = decode_cursor(cursor)
+    if position:
+        created, message_id = position
+        # (created, id) < cursor, written so the (group, created, id) index bounds the scan
+        rows = rows.filter(created__lte=created).exclude(created=created, id__gte=message_id)
+    rows = list(rows[:limit + 1])
+    if len(rows) <= limit:
+        # Past the hot window: carry on into the archive
+        last = (rows[-1].created, rows[-1].id) if rows else position
+        rows += archive.read_before(group_id, last, limit + 1 - len(rows))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return annotate_ticks(rows[::-1]), next_cursor
+
+
+def encode_cursor(message):
+    micros = (message.created - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}-{message.id}'
+
+
+def resume_limit():
+    return getattr(settings, 'CHAT_RESUME_LIMIT', 200)
+
+
+def missed(group_id, after, limit=None):
+    """
+    (new messages, changed messages, more) for a socket that last saw message
+    `after` in the room. New messages are the oldest `limit` sent after it;
+    `more` means there are newer ones still, to be fetched by resuming again
+    from the last one returned. Changed messages are those up to `after`
+    edited or deleted since it was sent.
+    """
+    limit = limit or resume_limit()
+    messages = GroupMessages.objects.filter(group_id=group_id).select_related('author__profile', 'group')
+    new = list(messages.filter(id__gt=after).order_by('id')[:limit + 1])
+    more = len(new) > limit
+    last_seen = (
+        GroupMessages.objects.filter(group_id=group_id, id__lte=after)
+        .order_by('-id').values('created')[:1]
+    )
+    changed = list(messages.filter(id__lte=after, changed_at__gte=Subquery(last_seen)).order_by('id'))
+    annotate_ticks(new[:limit] + changed)
+    return new[:limit], changed, more
@@ -0,0 +1,239 @@
+# a_rtchat/inbox.py
+"""
+Write-side maintenance of the ChatInbox table.
+
+Every function here issues a fixed number of queries regardless of how many
+members a room has, so they are safe to call on the message send path.
+"""
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import sidebar_cache, unread
+from .models import ChatGroup, ChatInbox, ChatReadState, GroupMessages
+
+PREVIEW_LENGTH = 120
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def tracks_group(group):
+    """Only group chats and private chats show up in the sidebar."""
+    return bool(group.groupchat_name) or group.is_private
+
+
+def make_preview(message):
+    if message.is_deleted:
+        return ''
+    return ' '.join(message.body.split())[:PREVIEW_LENGTH]
+
+
+def sync_members(group, user_ids=None):
+    """Create missing inbox rows for members of `group` and refresh private-room peers."""
+    if not tracks_group(group):
+        return
+    member_ids = list(group.members.values_list('id', flat=True))
+    if user_ids is None:
+        user_ids = member_ids
+    ChatInbox.objects.bulk_create(
+        [ChatInbox(user_id=uid, group=group) for uid in user_ids if uid in member_ids],
+        ignore_conflicts=True,
+    )
+    if group.is_private:
+        for uid in member_ids:
+            peer_id = next((mid for mid in member_ids if mid != uid), None)
+            ChatInbox.objects.filter(user_id=uid, group=group).update(peer_id=peer_id)
+        sidebar_cache.bump(member_ids)
+    else:
+        sidebar_cache.bump(user_ids)
+
+
+def remove_members(group, user_ids=None):
+    rows = ChatInbox.objects.filter(group=group)
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=user_ids)
+    sidebar_cache.bump(list(rows.values_list('user_id', flat=True)))
+    rows.delete()
+
+
+def record_message(message):
+    """A new message landed: bump the author's activity and every other member's unread count."""
+    group = message.group
+    if not tracks_group(group):
+        return
+    rows = ChatInbox.objects.filter(group_id=message.group_id)
+    member_ids = list(rows.values_list('user_id', flat=True))
+    shared = {
+        'last_activity_at': message.created,
+        'last_message': message,
+        'preview': make_preview(message),
+    }
+    rows.filter(user_id=message.author_id).update(**shared)
+
+    inbound = {
+        'unread_count': F('unread_count') + 1,
+        'last_inbound_at': message.created,
+    }
+    if group.is_private:
+        # A private chat is a request until the recipient has opened it once
+        inbound['is_request'] = ~Exists(ChatReadState.objects.filter(
+            user_id=OuterRef('user_id'), group_id=message.group_id, last_read_at__isnull=False,
+        ))
+    rows.exclude(user_id=message.author_id).update(**shared, **inbound)
+    unread.increment(message.group_id, [uid for uid in member_ids if uid != message.author_id])
+    sidebar_cache.bump(member_ids)
+
+
+def record_edit(message):
+    ChatInbox.objects.filter(group_id=message.group_id, last_message=message).update(
+        preview=make_preview(message)
+    )
+
+
+def record_deletes(message_ids):
+    ChatInbox.objects.filter(last_message_id__in=message_ids).update(preview='')
+
+
+def record_purge(group_id, messages):
+    """
+    Purged messages (hot or archived) come off the unread counts of the members
+    who had not read them: those sent by someone else after their last read.
+    """
+    if not messages:
+        return
+    created = sorted(message.created for message in messages)
+    own = defaultdict(list)
+    for message in messages:
+        own[message.author_id].append(message.created)
+    for times in own.values():
+        times.sort()
+    rows = ChatInbox.objects.filter(group_id=group_id, unread_count__gt=0).annotate(read_floor=Coalesce(Subquery(
+        ChatReadState.objects.filter(group_id=group_id, user_id=OuterRef('user_id')).values('last_read_at')[:1]
+    ), Value(EPOCH)))
+    purged = {}
+    for user_id, read_floor in rows.values_list('user_id', 'read_floor'):
+        times = own.get(user_id, [])
+        count = len(created) - bisect_right(created, read_floor) - (len(times) - bisect_right(times, read_floor))
+        if count:
+            purged[user_id] = count
+    if not purged:
+        return
+    ChatInbox.objects.filter(group_id=group_id, user_id__in=purged).update(unread_count=Greatest(
+        F('unread_count') - Case(*[When(user_id=uid, then=Value(count)) for uid, count in purged.items()]), 0,
+    ))
+    # Re-seeded from the rows just corrected
+    unread.forget(list(purged))
+    sidebar_cache.bump(list(purged))
+
+
+def mark_read(user, group):
+    """Clear the user's badge for `group`. Returns whether their sidebar row changed."""
+    changed = (
+        ChatInbox.objects.filter(user=user, group=group)
+        .filter(Q(unread_count__gt=0) | Q(is_request=True) | Q(hidden=True))
+        .update(unread_count=0, is_request=False, hidden=False)
+    )
+    unread.reset(user.id, group.id)
+    if changed:
+        sidebar_cache.bump([user.id])
+    return bool(changed)
+
+
+def hide(user, group):
+    if ChatInbox.objects.filter(user=user, group=group, hidden=False).update(hidden=True):
+        sidebar_cache.bump([user.id])
+
+
+def rebuild_inbox(group_ids):
+    """
+    Recompute the inbox rows of the given groups from GroupMessages and
+    ChatReadState. Used by the rebuild_inbox management command to backfill
+    the table and to correct drift. Returns the number of rows written.
+    """
+    groups = {
+        g.id: g for g in ChatGroup.objects.filter(id__in=group_ids)
+        .filter(Q(groupchat_name__isnull=False) | Q(is_private=True))
+    }
+    Membership = ChatGroup.members.through
+
+    # Drop rows for people who are no longer members (or rooms that are no longer tracked)
+    stale = ChatInbox.objects.filter(group_id__in=group_ids).exclude(
+        Exists(Membership.objects.filter(chatgroup_id=OuterRef('group_id'), user_id=OuterRef('user_id'))),
+        group_id__in=groups,
+    )
+    sidebar_cache.bump(list(stale.values_list('user_id', flat=True)))
+    stale.delete()
+    if not groups:
+        return 0
+
+    read_state = ChatReadState.objects.filter(group_id=OuterRef('chatgroup_id'), user_id=OuterRef('user_id'))
+    inbound = GroupMessages.objects.filter(group_id=OuterRef('chatgroup_id')).exclude(author_id=OuterRef('user_id'))
+    memberships = list(
+        Membership.objects.filter(chatgroup_id__in=groups)
+        .annotate(
+            last_read_at=Subquery(read_state.values('last_read_at')[:1]),
+            hidden=Coalesce(Subquery(read_state.values('hidden')[:1]), Value(False)),
+            read_floor=Coalesce(Subquery(read_state.values('last_read_at')[:1]), Value(EPOCH)),
+            last_inbound_at=Subquery(inbound.order_by('-created').values('created')[:1]),
+        )
+        .annotate(unread=Coalesce(Subquery(
+            inbound.filter(created__gt=OuterRef('read_floor'))
+            .order_by().values('group_id').annotate(n=Count('id')).values('n')
+        ), 0))
+        .order_by('id')
+    )
+
+    latest_ids = (
+        ChatGroup.objects.filter(id__in=groups)
+        .annotate(latest_id=Subquery(
+            GroupMessages.objects.filter(group_id=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        ))
+        .values_list('id', 'latest_id')
+    )
+    latest_ids = {gid: mid for gid, mid in latest_ids if mid}
+    latest = GroupMessages.objects.in_bulk(list(latest_ids.values()))
+
+    existing = dict(
+        ((uid, gid), ts) for uid, gid, ts in
+        ChatInbox.objects.filter(group_id__in=groups).values_list('user_id', 'group_id', 'last_activity_at')
+    )
+
+    members_by_group = {}
+    for m in memberships:
+        members_by_group.setdefault(m.chatgroup_id, []).append(m.user_id)
+
+    now = timezone.now()
+    rows = []
+    for m in memberships:
+        group = groups[m.chatgroup_id]
+        message = latest.get(latest_ids.get(group.id))
+        peer_id = None
+        if group.is_private:
+            peer_id = next((uid for uid in members_by_group[group.id] if uid != m.user_id), None)
+        rows.append(ChatInbox(
+            user_id=m.user_id,
+            group_id=group.id,
+            peer_id=peer_id,
+            unread_count=m.unread,
+            last_inbound_at=m.last_inbound_at,
+            last_activity_at=message.created if message else existing.get((m.user_id, group.id), now),
+            last_message=message,
+            preview=make_preview(message) if message else '',
+            is_request=group.is_private and m.last_read_at is None and m.last_inbound_at is not None,
+            hidden=m.hidden,
+        ))
+    ChatInbox.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['user', 'group'],
+        update_fields=[
+            'peer', 'unread_count', 'last_inbound_at', 'last_activity_at',
+            'last_message', 'preview', 'is_request', 'hidden',
+        ],
+    )
+    unread.forget({row.user_id for row in rows})
+    sidebar_cache.bump({row.user_id for row in rows})
+    return len(rows)
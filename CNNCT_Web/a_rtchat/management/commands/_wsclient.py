@@ -0,0 +1,110 @@
+# Shared by the bench_* commands; the leading underscore keeps it out of the command list.
+import asyncio
+import base64
+import os
+import resource
+import ssl
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+
+
+def raise_fd_limit():
+    # every socket needs a file descriptor on this side too
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def session_cookie(username):
+    """Log `username` in (creating it if missing) and return the session cookie header value."""
+    user, _ = User.objects.get_or_create(username=username)
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+def origin_for(url):
+    parsed = urlparse(url)
+    return f'{"https" if parsed.scheme == "wss" else "http"}://{parsed.netloc}'
+
+
+class Socket:
+    """
+    Bare-bones WebSocket client: does the HTTP upgrade, then discards whatever
+    the server pushes and answers its pings, so the connection stays idle but alive.
+    """
+
+    def __init__(self, reader, writer, on_text=None):
+        self.reader, self.writer = reader, writer
+        self.on_text = on_text
+        self.closed = False
+        self.drain_task = asyncio.create_task(self.drain())
+
+    @classmethod
+    async def open(cls, url, headers, on_text=None):
+        parsed = urlparse(url)
+        secure = parsed.scheme == 'wss'
+        reader, writer = await asyncio.open_connection(
+            parsed.hostname, parsed.port or (443 if secure else 80), ssl=ssl.create_default_context() if secure else None
+        )
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = [
+            f'GET {parsed.path} HTTP/1.1',
+            f'Host: {parsed.netloc}',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Key: {key}',
+            'Sec-WebSocket-Version: 13',
+        ] + [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise OSError(response.split(b'\r\n', 1)[0].decode(errors='replace'))
+        return cls(reader, writer, on_text)
+
+    async def drain(self):
+        try:
+            while True:
+                head = await self.reader.readexactly(2)
+                opcode, length = head[0] & 0x0F, head[1] & 0x7F
+                if length == 126:
+                    length = int.from_bytes(await self.reader.readexactly(2), 'big')
+                elif length == 127:
+                    length = int.from_bytes(await self.reader.readexactly(8), 'big')
+                payload = await self.reader.readexactly(length)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    # answer the server's keepalive pings or it will close us
+                    self.write_frame(0xA, payload)
+                elif opcode == 0x1 and self.on_text:
+                    self.on_text(payload)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        self.closed = True
+
+    def write_frame(self, opcode, payload):
+        # client frames must be masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 127]) + length.to_bytes(8, 'big')
+        self.writer.write(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    def send_text(self, text):
+        self.write_frame(0x1, text.encode())
+
+    def close(self):
+        self.drain_task.cancel()
+        self.writer.close()
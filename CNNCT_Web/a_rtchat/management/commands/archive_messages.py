@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from a_rtchat import archive
+from a_rtchat.models import ChatGroup
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than CHAT_ARCHIVE_AFTER_DAYS out of GroupMessages into compressed per-room segments, one short transaction per batch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None, help='Archive messages older than this (default CHAT_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=archive.BATCH_SIZE, help=f'Messages per segment and transaction (default {archive.BATCH_SIZE})')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to sleep between batches, letting other writers in (default 0.05)')
+        parser.add_argument('--room', action='append', dest='rooms', default=[], help='Only archive this room (group_name); repeatable')
+
+    def handle(self, *args, **options):
+        age = timedelta(days=options['days']) if options['days'] is not None else archive.archive_after()
+        before = timezone.now() - age
+        batch_size = max(1, options['batch_size'])
+        groups = ChatGroup.objects.order_by('id')
+        if options['rooms']:
+            groups = groups.filter(group_name__in=options['rooms'])
+
+        last_id = 0
+        total_rooms = total_messages = total_segments = 0
+        while True:
+            # keyset over rooms, then batch by batch within each room
+            room_ids = list(groups.filter(id__gt=last_id).values_list('id', flat=True)[:200])
+            if not room_ids:
+                break
+            last_id = room_ids[-1]
+            for room_id in room_ids:
+                moved = 0
+                while count := archive.archive_batch(room_id, before, batch_size):
+                    moved += count
+                    total_segments += 1
+                    time.sleep(options['pause'])
+                    if count < batch_size:
+                        break
+                if moved:
+                    total_rooms += 1
+                    total_messages += moved
+                    self.stdout.write(f'{total_rooms} rooms, {total_messages} messages')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total_messages} messages from {total_rooms} rooms into {total_segments} segments'
+        ))
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from a_rtchat.models import ChatGroup
+from ._wsclient import Socket, origin_for, raise_fd_limit, session_cookie
+
+ROOM = 'bench-coalesce'
+# Every event a socket receives is one or more top-level OOB fragments
+FRAGMENT = b'hx-swap-oob='
+NEW_MESSAGE = b'id="chat_messages"'
+
+
+class Command(BaseCommand):
+    help = (
+        'Send bursts of messages into a room of listening sockets on a running server and '
+        'report how many WebSocket frames each listener received per message and per '
+        'OOB fragment. The server needs a send limit that allows the bursts.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://127.0.0.1:8000', help='Server base URL (default ws://127.0.0.1:8000)')
+        parser.add_argument('--sockets', type=int, default=50, help='Listening sockets in the room (default 50)')
+        parser.add_argument('--bursts', type=int, default=5, help='Number of bursts (default 5)')
+        parser.add_argument('--burst-size', type=int, default=20, dest='burst_size', help='Messages per burst (default 20)')
+        parser.add_argument('--timeout', type=float, default=60.0, help='Give up waiting for delivery after this many seconds (default 60)')
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(username='bench-sender')
+        listener, _ = User.objects.get_or_create(username='bench-listener')
+        room, _ = ChatGroup.objects.get_or_create(group_name=ROOM, defaults={'groupchat_name': 'Bench coalesce'})
+        room.members.add(sender, listener)
+        raise_fd_limit()
+        asyncio.run(self.run(session_cookie(sender.username), session_cookie(listener.username), **options))
+
+    async def run(self, sender_cookie, listener_cookie, url, sockets, bursts, burst_size, timeout, **options):
+        target = f'{url.rstrip("/")}/ws/chatroom/{ROOM}'
+        origin = origin_for(url)
+        frames = [0] * sockets
+        fragments = [0] * sockets
+        received = [0] * sockets
+        counting = False
+
+        def counter(i):
+            def on_text(payload):
+                if counting:
+                    frames[i] += 1
+                    fragments[i] += payload.count(FRAGMENT)
+                    received[i] += payload.count(NEW_MESSAGE)
+            return on_text
+
+        listeners = await asyncio.gather(*[
+            Socket.open(target, {'Origin': origin, 'Cookie': listener_cookie}, counter(i)) for i in range(sockets)
+        ])
+        sender = await Socket.open(target, {'Origin': origin, 'Cookie': sender_cookie})
+        # let connect-time broadcasts settle before counting
+        await asyncio.sleep(2)
+        counting = True
+
+        messages = bursts * burst_size
+        started = time.perf_counter()
+        for b in range(bursts):
+            for n in range(burst_size):
+                sender.send_text(json.dumps({'body': f'burst {b} message {n}'}))
+            await sender.writer.drain()
+            await asyncio.sleep(1)
+        while min(received) < messages and time.perf_counter() - started < timeout:
+            await asyncio.sleep(0.2)
+        # trailing status and sidebar fragments
+        await asyncio.sleep(1)
+
+        for sock in listeners + [sender]:
+            sock.close()
+        total_frames, total_fragments = sum(frames), sum(fragments)
+        self.stdout.write(
+            f'{sum(received)} of {messages * sockets} messages delivered to {sockets} sockets: '
+            f'{total_frames} frames carrying {total_fragments} OOB fragments'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'{total_frames / max(sum(received), 1):.2f} frames per message, '
+            f'{total_frames / max(total_fragments, 1):.2f} frames per fragment'
+        ))
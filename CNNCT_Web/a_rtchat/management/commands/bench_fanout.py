@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from a_rtchat.models import ChatGroup
+from ._wsclient import Socket, origin_for, raise_fd_limit, session_cookie
+
+ROOM = 'bench-fanout'
+# Marker of a new-message frame (partials/chat_messages_p.html)
+NEW_MESSAGE = b'id="chat_messages"'
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill a room with listening sockets on a running server, send messages from one '
+        'more socket and report messages/sec fully delivered to every listener. '
+        'Run it against each build to compare.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://127.0.0.1:8000', help='Server base URL (default ws://127.0.0.1:8000)')
+        parser.add_argument('--sockets', type=int, default=500, help='Listening sockets in the room (default 500)')
+        parser.add_argument('--messages', type=int, default=200, help='Messages to send (default 200)')
+        parser.add_argument('--timeout', type=float, default=120.0, help='Give up waiting for delivery after this many seconds (default 120)')
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(username='bench-sender')
+        listener, _ = User.objects.get_or_create(username='bench-listener')
+        room, _ = ChatGroup.objects.get_or_create(group_name=ROOM, defaults={'groupchat_name': 'Bench fan-out'})
+        room.members.add(sender, listener)
+        raise_fd_limit()
+        asyncio.run(self.run(session_cookie(sender.username), session_cookie(listener.username), **options))
+
+    async def run(self, sender_cookie, listener_cookie, url, sockets, messages, timeout, **options):
+        target = f'{url.rstrip("/")}/ws/chatroom/{ROOM}'
+        origin = origin_for(url)
+        received = [0] * sockets
+        everyone_done = asyncio.Event()
+        done = 0
+
+        def counter(i):
+            def on_text(payload):
+                nonlocal done
+                if NEW_MESSAGE in payload:
+                    received[i] += 1
+                    if received[i] == messages:
+                        done += 1
+                        if done == sockets:
+                            everyone_done.set()
+            return on_text
+
+        listeners = []
+        for start in range(0, sockets, 100):
+            listeners += await asyncio.gather(*[
+                Socket.open(target, {'Origin': origin, 'Cookie': listener_cookie}, counter(i))
+                for i in range(start, min(start + 100, sockets))
+            ])
+        sender = await Socket.open(target, {'Origin': origin, 'Cookie': sender_cookie})
+        # let connect-time broadcasts settle before timing
+        await asyncio.sleep(2)
+        self.stdout.write(f'{len(listeners)} listeners connected, sending {messages} messages')
+
+        started = time.perf_counter()
+        for n in range(messages):
+            sender.send_text(json.dumps({'body': f'bench message {n}'}))
+        await sender.writer.drain()
+        try:
+            await asyncio.wait_for(everyone_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+
+        delivered = sum(received)
+        for sock in listeners + [sender]:
+            sock.close()
+        self.stdout.write(
+            f'{delivered} of {messages * sockets} frames delivered in {elapsed:.2f} s '
+            f'({delivered / elapsed:.0f} frames/sec)'
+        )
+        # a message counts once every listener has it
+        self.stdout.write(self.style.SUCCESS(
+            f'{min(received) / elapsed:.1f} messages/sec fanned out to {sockets} sockets'
+        ))
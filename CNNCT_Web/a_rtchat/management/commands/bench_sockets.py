@@ -0,0 +1,68 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from a_rtchat.models import ChatGroup
+from ._wsclient import Socket, origin_for, raise_fd_limit, session_cookie
+
+
+class Command(BaseCommand):
+    help = (
+        'Ramp up idle chat sockets against a running server (e.g. one daphne process) '
+        'until handshakes fail or get too slow, and report how many it held. '
+        'Run it against each build to compare.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://127.0.0.1:8000', help='Server base URL (default ws://127.0.0.1:8000)')
+        parser.add_argument('--room', default='public-chat', help='Room to connect to (group_name)')
+        parser.add_argument('--username', default='bench', help='User the sockets log in as (created if missing)')
+        parser.add_argument('--step', type=int, default=250, help='Sockets opened per step (default 250)')
+        parser.add_argument('--max', dest='max_sockets', type=int, default=20000, help='Stop after this many sockets (default 20000)')
+        parser.add_argument('--timeout', type=float, default=5.0, help='Handshake timeout in seconds (default 5)')
+        parser.add_argument('--max-p95', type=float, default=1000.0, help='Stop when the p95 handshake in a step exceeds this many ms (default 1000)')
+
+    def handle(self, *args, **options):
+        if not ChatGroup.objects.filter(group_name=options['room']).exists():
+            raise CommandError(f'No room named {options["room"]}')
+        raise_fd_limit()
+        asyncio.run(self.ramp(session_cookie(options['username']), **options))
+
+    async def ramp(self, cookie, url, room, step, max_sockets, timeout, max_p95, **options):
+        target = f'{url.rstrip("/")}/ws/chatroom/{room}'
+        headers = {'Origin': origin_for(url), 'Cookie': cookie}
+        sockets = []
+
+        async def open_one():
+            started = time.perf_counter()
+            try:
+                sockets.append(await asyncio.wait_for(Socket.open(target, headers), timeout))
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return None
+            return (time.perf_counter() - started) * 1000
+
+        reason = f'reached --max {max_sockets}'
+        while len(sockets) < max_sockets:
+            results = await asyncio.gather(*[open_one() for _ in range(min(step, max_sockets - len(sockets)))])
+            # let the server settle, then make sure the earlier sockets are still up
+            await asyncio.sleep(1)
+            timings = sorted(ms for ms in results if ms is not None)
+            failed = len(results) - len(timings)
+            dropped = sum(sock.closed for sock in sockets)
+            p95 = timings[max(0, int(len(timings) * 0.95) - 1)] if timings else 0
+            self.stdout.write(
+                f'{len(sockets) - dropped} open, {failed} failed, {dropped} dropped, '
+                f'handshake p50 {statistics.median(timings) if timings else 0:.0f} ms, p95 {p95:.0f} ms'
+            )
+            if failed or dropped:
+                reason = 'handshakes failed or sockets dropped'
+                break
+            if p95 > max_p95:
+                reason = f'p95 handshake over {max_p95:.0f} ms'
+                break
+
+        held = sum(not sock.closed for sock in sockets)
+        for sock in sockets:
+            sock.close()
+        self.stdout.write(self.style.SUCCESS(f'Held {held} concurrent sockets ({reason})'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from a_rtchat import ratelimit
+
+
+class Command(BaseCommand):
+    help = 'Show how often the per-user send limiter and the outbound socket bound kicked in.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Zero the counters after printing them')
+
+    def handle(self, *args, **options):
+        counts = ratelimit.stats()
+        total = counts['allowed'] + counts['limited']
+        share = f'{counts["limited"] / total:.1%}' if total else 'n/a'
+        self.stdout.write(
+            f'Send limiter ({ratelimit.rate()}/s, burst {ratelimit.burst()}): '
+            f'{counts["allowed"]} allowed, {counts["limited"]} limited ({share})'
+        )
+        self.stdout.write(f'Sockets closed for falling behind: {counts["overflows"]}')
+        if options['reset']:
+            ratelimit.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
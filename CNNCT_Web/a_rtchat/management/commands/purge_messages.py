@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from a_rtchat import retention
+from a_rtchat.models import ChatGroup
+
+
+class Command(BaseCommand):
+    help = "Delete messages past their room's retention policy, in small paced batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=retention.BATCH_SIZE, help=f'Messages per batch and transaction (default {retention.BATCH_SIZE})')
+        parser.add_argument('--pause', type=float, default=0.1, help='Least seconds to sleep between batches (default 0.1)')
+        parser.add_argument('--room', action='append', dest='rooms', default=[], help='Only purge this room (group_name); repeatable')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        groups = ChatGroup.objects.filter(retention_days__isnull=False).order_by('id')
+        if options['rooms']:
+            groups = groups.filter(group_name__in=options['rooms'])
+        now = timezone.now()
+
+        last_id = 0
+        total_rooms = total_messages = total_batches = 0
+        while True:
+            # keyset over rooms, then batch by batch within each room
+            batch = list(groups.filter(id__gt=last_id)[:200])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for group in batch:
+                before = retention.cutoff(group, now)
+                purged = retention.purge_archive(group, before)
+                while True:
+                    started = time.monotonic()
+                    count = retention.purge_batch(group, before, batch_size)
+                    if not count:
+                        break
+                    purged += count
+                    total_batches += 1
+                    retention.pause(time.monotonic() - started, options['pause'])
+                if purged:
+                    total_rooms += 1
+                    total_messages += purged
+                    self.stdout.write(f'{total_rooms} rooms, {total_messages} messages')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {total_messages} messages from {total_rooms} rooms in {total_batches} batches'
+        ))
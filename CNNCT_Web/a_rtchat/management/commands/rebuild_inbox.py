@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.inbox import rebuild_inbox
+from a_rtchat.models import ChatGroup
+
+
+class Command(BaseCommand):
+    help = 'Backfill or reconcile the ChatInbox table from GroupMessages and ChatReadState, in batches of rooms.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Rooms per batch (default 200)')
+        parser.add_argument('--room', action='append', dest='rooms', default=[], help='Only rebuild this room (group_name); repeatable')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        groups = ChatGroup.objects.order_by('id')
+        if options['rooms']:
+            groups = groups.filter(group_name__in=options['rooms'])
+
+        last_id = 0
+        total_rooms = total_rows = 0
+        while True:
+            # keyset over ids so each batch is a short transaction and an index range scan
+            batch = list(groups.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            total_rows += rebuild_inbox(batch)
+            total_rooms += len(batch)
+            last_id = batch[-1]
+            self.stdout.write(f'{total_rooms} rooms, {total_rows} inbox rows')
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt inbox for {total_rooms} rooms ({total_rows} rows)'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from a_rtchat import search
+from a_rtchat.models import GroupMessages
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text message search index from GroupMessages (deleted messages are left out).'
+
+    def handle(self, *args, **options):
+        count = search.reindex(GroupMessages.objects.all())
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} messages'))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from a_rtchat import unread
+from a_rtchat.models import ChatInbox
+from a_rtchat.redis_store import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Compare the Redis unread counters with ChatInbox and rewrite the hashes that drifted. Meant to run periodically (cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Users per batch (default 500)')
+
+    def handle(self, *args, **options):
+        r = get_redis()
+        if r is None:
+            raise CommandError('CHAT_REDIS_URL is not set, nothing to reconcile')
+        batch_size = max(1, options['batch_size'])
+        user_ids = ChatInbox.objects.order_by('user_id').values_list('user_id', flat=True).distinct()
+
+        last_id = 0
+        checked = fixed = 0
+        while True:
+            batch = list(user_ids.filter(user_id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1]
+
+            expected = {uid: {} for uid in batch}
+            rows = ChatInbox.objects.filter(user_id__in=batch, unread_count__gt=0)
+            for uid, gid, count in rows.values_list('user_id', 'group_id', 'unread_count'):
+                expected[uid][gid] = count
+
+            pipe = r.pipeline()
+            for uid in batch:
+                pipe.hgetall(unread.counter_key(uid))
+            current = pipe.execute()
+
+            pipe = r.pipeline()
+            for uid, data in zip(batch, current):
+                checked += 1
+                # unseeded users are read from the database on demand anyway
+                if not data:
+                    continue
+                actual = {int(gid): int(n) for gid, n in data.items() if gid != unread.SEEDED and int(n)}
+                if actual != expected[uid]:
+                    unread.store(pipe, uid, expected[uid])
+                    fixed += 1
+            pipe.execute()
+
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} users, corrected {fixed} drifted counters'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from a_rtchat import sidebar_cache
+
+
+class Command(BaseCommand):
+    help = 'Show the hit rate of the per-user sidebar cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Zero the counters after printing them')
+
+    def handle(self, *args, **options):
+        hits, misses = sidebar_cache.stats()
+        total = hits + misses
+        rate = f'{hits / total:.1%}' if total else 'n/a'
+        self.stdout.write(f'Sidebar cache: {hits} hits, {misses} misses, hit rate {rate}')
+        if options['reset']:
+            sidebar_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
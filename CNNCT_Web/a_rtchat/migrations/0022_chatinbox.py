@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:47
+
+import django.db.models.deletion
+import django.utils.timezone
+import shortuuid.main
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0021_groupmessages_edited_at_alter_chatgroup_group_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='group_name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=128, unique=True),
+        ),
+        migrations.CreateModel(
+            name='ChatInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_inbound_at', models.DateTimeField(blank=True, null=True)),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('preview', models.CharField(blank=True, default='', max_length=120)),
+                ('is_request', models.BooleanField(default=False)),
+                ('hidden', models.BooleanField(default=False)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='a_rtchat.chatgroup')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='a_rtchat.groupmessages')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity_at', '-group'], name='inbox_user_activity_idx')],
+                'unique_together': {('user', 'group')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:51
+
+import shortuuid.main
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0022_chatinbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='private_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='group_name',
+            field=models.CharField(default=shortuuid.main.ShortUUID.uuid, max_length=128, unique=True),
+        ),
+    ]
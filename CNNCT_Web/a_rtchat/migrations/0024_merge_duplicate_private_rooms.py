@@ -0,0 +1,76 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def merge_duplicate_private_rooms(apps, schema_editor):
+    """
+    Fold every set of private rooms between the same two users into the
+    oldest one (messages, read states, inbox rows), then give each private
+    room its canonical "<low id>:<high id>" key.
+    """
+    ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+    GroupMessages = apps.get_model('a_rtchat', 'GroupMessages')
+    ChatReadState = apps.get_model('a_rtchat', 'ChatReadState')
+    ChatInbox = apps.get_model('a_rtchat', 'ChatInbox')
+    Membership = ChatGroup.members.through
+
+    members = defaultdict(set)
+    for group_id, user_id in Membership.objects.filter(chatgroup__is_private=True).values_list('chatgroup_id', 'user_id'):
+        members[group_id].add(user_id)
+
+    rooms_by_key = defaultdict(list)
+    for group_id, user_ids in members.items():
+        if len(user_ids) != 2:
+            continue
+        low, high = sorted(user_ids)
+        rooms_by_key[f'{low}:{high}'].append(group_id)
+
+    for key, group_ids in rooms_by_key.items():
+        keeper, *duplicates = sorted(group_ids)
+        if duplicates:
+            GroupMessages.objects.filter(group_id__in=duplicates).update(group_id=keeper)
+            for state in ChatReadState.objects.filter(group_id__in=duplicates):
+                kept = ChatReadState.objects.filter(user_id=state.user_id, group_id=keeper).first()
+                if kept is None:
+                    state.group_id = keeper
+                    state.save(update_fields=['group'])
+                    continue
+                # newest read wins; the merged room is hidden only if every copy was
+                if state.last_read_at and (kept.last_read_at is None or state.last_read_at > kept.last_read_at):
+                    kept.last_read_at = state.last_read_at
+                kept.hidden = kept.hidden and state.hidden
+                kept.save(update_fields=['last_read_at', 'hidden'])
+                state.delete()
+            ChatGroup.objects.filter(id__in=duplicates).delete()
+            _recompute_inbox(ChatInbox, ChatReadState, GroupMessages, keeper)
+        ChatGroup.objects.filter(id=keeper).update(private_key=key)
+
+
+def _recompute_inbox(ChatInbox, ChatReadState, GroupMessages, group_id):
+    messages = GroupMessages.objects.filter(group_id=group_id)
+    last = messages.order_by('-created', '-id').first()
+    for row in ChatInbox.objects.filter(group_id=group_id):
+        state = ChatReadState.objects.filter(user_id=row.user_id, group_id=group_id).first()
+        last_read = state.last_read_at if state else None
+        inbound = messages.exclude(author_id=row.user_id)
+        row.unread_count = (inbound.filter(created__gt=last_read) if last_read else inbound).count()
+        row.last_inbound_at = inbound.order_by('-created').values_list('created', flat=True).first()
+        row.is_request = last_read is None and row.last_inbound_at is not None
+        row.hidden = bool(state and state.hidden)
+        if last:
+            row.last_activity_at = last.created
+            row.last_message_id = last.id
+            row.preview = '' if last.is_deleted else ' '.join(last.body.split())[:120]
+        row.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0023_chatgroup_private_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_private_rooms, migrations.RunPython.noop),
+    ]
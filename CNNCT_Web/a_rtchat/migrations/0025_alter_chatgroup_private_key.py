@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0024_merge_duplicate_private_rooms'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatgroup',
+            name='private_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
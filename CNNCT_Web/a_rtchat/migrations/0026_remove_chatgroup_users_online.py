@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:23
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0025_alter_chatgroup_private_key'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatgroup',
+            name='users_online',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0026_remove_chatgroup_users_online'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='last_delivered_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='last_read_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
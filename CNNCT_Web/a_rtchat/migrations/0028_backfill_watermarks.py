@@ -0,0 +1,64 @@
+from django.db import migrations
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def backfill_watermarks(apps, schema_editor):
+    """
+    Derive every member's watermarks from the old per-message status column.
+    last_read_id comes from the member's own last_read_at; last_delivered_id is
+    the newest inbound message the old column had marked delivered or read.
+    """
+    ChatGroup = apps.get_model('a_rtchat', 'ChatGroup')
+    GroupMessages = apps.get_model('a_rtchat', 'GroupMessages')
+    ChatReadState = apps.get_model('a_rtchat', 'ChatReadState')
+    Membership = ChatGroup.members.through
+
+    state = ChatReadState.objects.filter(group_id=OuterRef('chatgroup_id'), user_id=OuterRef('user_id'))
+    room = GroupMessages.objects.filter(group_id=OuterRef('chatgroup_id')).order_by().values('group_id')
+    memberships = Membership.objects.annotate(
+        last_read_at=Subquery(state.values('last_read_at')[:1]),
+    ).annotate(
+        read=Coalesce(Subquery(
+            room.filter(created__lte=OuterRef('last_read_at'))
+            .annotate(top=Max('id')).values('top')
+        ), Value(0)),
+        delivered=Coalesce(Subquery(
+            room.exclude(author_id=OuterRef('user_id')).filter(status__gte=1)
+            .annotate(top=Max('id')).values('top')
+        ), Value(0)),
+    ).order_by('id')
+
+    last_id = 0
+    while True:
+        batch = list(memberships.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        ChatReadState.objects.bulk_create(
+            [
+                ChatReadState(
+                    user_id=m.user_id,
+                    group_id=m.chatgroup_id,
+                    last_read_id=m.read,
+                    last_delivered_id=max(m.read, m.delivered),
+                )
+                for m in batch if m.read or m.delivered
+            ],
+            update_conflicts=True,
+            unique_fields=['user', 'group'],
+            update_fields=['last_read_id', 'last_delivered_id'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0027_chatreadstate_watermarks'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
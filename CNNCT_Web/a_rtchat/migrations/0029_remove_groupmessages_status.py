@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0028_backfill_watermarks'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='groupmessages',
+            name='status',
+        ),
+    ]
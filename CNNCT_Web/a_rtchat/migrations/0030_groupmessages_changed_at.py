@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0029_remove_groupmessages_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessages',
+            name='changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessages',
+            index=models.Index(fields=['group', 'changed_at'], name='message_group_changed_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0030_groupmessages_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmessages',
+            index=models.Index(fields=['group', 'created', 'id'], name='message_group_created_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+# The full-text index read by a_rtchat/search.py; kept here as it was at this
+# migration, so later changes to that module cannot change what it creates
+TABLE = 'a_rtchat_message_search'
+SQLITE_CREATE = [
+    f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+    "body, group_id UNINDEXED, author_id UNINDEXED, created UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+]
+POSTGRES_CREATE = [
+    f"CREATE TABLE {TABLE} ("
+    "message_id bigint PRIMARY KEY, group_id bigint NOT NULL, author_id integer NOT NULL, "
+    "created timestamp with time zone NOT NULL, body text NOT NULL, "
+    "document tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED)",
+    f"CREATE INDEX {TABLE}_document_idx ON {TABLE} USING GIN (document)",
+]
+
+
+def create_search_index(apps, schema_editor):
+    """Create the full-text index and fill it with the messages not deleted."""
+    sqlite = schema_editor.connection.vendor == 'sqlite'
+    for statement in SQLITE_CREATE if sqlite else POSTGRES_CREATE:
+        schema_editor.execute(statement)
+    key = 'rowid' if sqlite else 'message_id'
+    schema_editor.execute(
+        f'INSERT INTO {TABLE} ({key}, group_id, author_id, created, body) '
+        'SELECT id, group_id, author_id, created, body FROM a_rtchat_groupmessages WHERE NOT is_deleted'
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    schema_editor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0031_groupmessages_history_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0032_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('first_id', models.PositiveBigIntegerField()),
+                ('first_created', models.DateTimeField()),
+                ('last_id', models.PositiveBigIntegerField()),
+                ('last_created', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('size', models.PositiveBigIntegerField()),
+                ('blocks', models.JSONField(default=list)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='a_rtchat.chatgroup')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', 'last_created', 'last_id'], name='archive_group_last_idx')],
+            },
+        ),
+    ]
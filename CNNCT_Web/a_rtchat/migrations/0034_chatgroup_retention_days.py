@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0033_archivesegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, choices=[(1, '1 day'), (7, '1 week'), (30, '30 days'), (90, '90 days'), (365, '1 year')], null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0034_chatgroup_retention_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('delta', models.TextField()),
+                ('written_at', models.DateTimeField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='a_rtchat.groupmessages')),
+            ],
+            options={
+                'unique_together': {('message', 'number')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:15
+
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_authors(apps, schema_editor):
+    """Link every segment to the authors of its lines (a_rtchat/archive.py) that still have accounts."""
+    ArchiveSegment = apps.get_model('a_rtchat', 'ArchiveSegment')
+    User = apps.get_model('auth', 'User')
+    archive_dir = str(getattr(settings, 'CHAT_ARCHIVE_DIR', settings.BASE_DIR / 'archive'))
+    for segment in ArchiveSegment.objects.order_by('id').iterator():
+        try:
+            with gzip.open(os.path.join(archive_dir, segment.path), 'rt') as f:
+                author_ids = {json.loads(line)['author_id'] for line in f}
+        except FileNotFoundError:
+            continue
+        segment.authors.set(User.objects.filter(id__in=author_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0035_messagerevision'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivesegment',
+            name='authors',
+            field=models.ManyToManyField(blank=True, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(fill_authors, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,47 @@
 # a_rtchat/models.py
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import FilteredRelation, Min, Q
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
 import shortuuid
 
 class ChatGroup(models.Model):
     group_name = models.CharField(max_length=128, unique=True,default=shortuuid.uuid)
     groupchat_name=models.CharField(max_length=128,null=True,blank=True)
     admin=models.ForeignKey(User,related_name='groupchats',blank=True,null=True,on_delete=models.SET_NULL)
-    users_online = models.ManyToManyField(User, related_name='online_in_groups',blank=True)
     members= models.ManyToManyField(User, related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
+    # "<lower user id>:<higher user id>" for private rooms, so a DM lookup is one unique-index probe
+    private_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    # Messages older than this many days are purged (a_rtchat/retention.py); empty keeps them forever
+    RETENTION_CHOICES = [(1, '1 day'), (7, '1 week'), (30, '30 days'), (90, '90 days'), (365, '1 year')]
+    retention_days = models.PositiveIntegerField(null=True, blank=True, choices=RETENTION_CHOICES)
     
     def __str__(self):  
         return self.group_name
+
+    @staticmethod
+    def private_key_for(user_a, user_b):
+        low, high = sorted([user_a.id, user_b.id])
+        return f'{low}:{high}'
+
+    @classmethod
+    def get_or_create_private(cls, user_a, user_b):
+        """Return (room, created) for the private room between two users, safe under concurrent requests."""
+        key = cls.private_key_for(user_a, user_b)
+        room = cls.objects.filter(private_key=key).first()
+        if room:
+            return room, False
+        try:
+            # room and members commit together, so nobody sees a memberless room
+            with transaction.atomic():
+                room = cls.objects.create(is_private=True, private_key=key)
+                room.members.add(user_a, user_b)
+            return room, True
+        except IntegrityError:
+            # lost the race: the other request's room is committed now
+            return cls.objects.get(private_key=key), False
 class GroupMessages(models.Model):
     group=models.ForeignKey(ChatGroup,related_name='chat_messages', on_delete=models.CASCADE)
     author=models.ForeignKey(User,on_delete=models.CASCADE)
@@ -20,33 +49,149 @@ class GroupMessages(models.Model):
     is_deleted = models.BooleanField(default=False)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # Last edit or delete, so a resuming socket can find what changed while it was away
+    changed_at = models.DateTimeField(null=True, blank=True)
     created= models.DateTimeField(auto_now_add=True)
-    # 0=sent, 1=delivered, 2=read
+    # True on the stand-ins a_rtchat/archive.py builds from segment lines
+    archived = False
+    # Ticks, derived from the other members' ChatReadState watermarks
     STATUS_SENT = 0
     STATUS_DELIVERED = 1
     STATUS_READ = 2
-    STATUS_CHOICES = (
-        (STATUS_SENT, 'sent'),
-        (STATUS_DELIVERED, 'delivered'),
-        (STATUS_READ, 'read'),
-    )
-    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=STATUS_SENT)
     def __str__(self):
         return f'{self.author.username} : {self.body}'  
+
+    @property
+    def tick(self):
+        """STATUS_* as the author sees it; a_rtchat.receipts.annotate_ticks() fills it in bulk."""
+        if not hasattr(self, '_tick'):
+            self._tick = self.tick_for(ChatReadState.watermarks(self.group_id, self.author_id))
+        return self._tick
+
+    def tick_for(self, watermarks):
+        delivered, read = watermarks
+        if self.id <= read:
+            return self.STATUS_READ
+        if self.id <= delivered:
+            return self.STATUS_DELIVERED
+        return self.STATUS_SENT
     class Meta:
         # Ascending order so initial render is oldest -> newest
         ordering=['created','id']
+        indexes = [
+            # Keyset pagination of a room's history (a_rtchat/history.py)
+            models.Index(fields=['group', 'created', 'id'], name='message_group_created_idx'),
+            models.Index(fields=['group', 'changed_at'], name='message_group_changed_idx'),
+        ]
 
 
 class ChatReadState(models.Model):
-    """Tracks the last time a user viewed a given chat group."""
+    """Tracks the last time a user viewed a given chat group, and how far they have received and read it."""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_read_states')
     group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='read_states')
     last_read_at = models.DateTimeField(null=True, blank=True)
     hidden = models.BooleanField(default=False)
+    # Highest GroupMessages id delivered to / read by this member (last_delivered_id >= last_read_id)
+    last_delivered_id = models.PositiveBigIntegerField(default=0)
+    last_read_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'group')
+
+    def __str__(self):
+        return f'{self.user.username} read {self.group.group_name} at {self.last_read_at}'
+
+    @classmethod
+    def member_watermarks(cls, group_id):
+        """Membership rows of a room annotated with each member's `delivered` and `read` watermark (0 without a state row)."""
+        return ChatGroup.members.through.objects.filter(chatgroup_id=group_id).annotate(
+            state=FilteredRelation('user__chat_read_states', condition=Q(user__chat_read_states__group_id=group_id)),
+        ).annotate(
+            delivered=Coalesce('state__last_delivered_id', 0),
+            read=Coalesce('state__last_read_id', 0),
+        )
+
+    @classmethod
+    def watermarks(cls, group_id, author_id):
+        """(delivered, read) up to which every member but `author_id` has got the room."""
+        lowest = (
+            cls.member_watermarks(group_id).exclude(user_id=author_id)
+            .aggregate(lowest_delivered=Min('delivered'), lowest_read=Min('read'))
+        )
+        return lowest['lowest_delivered'] or 0, lowest['lowest_read'] or 0
+
+class ChatInbox(models.Model):
+    """
+    Denormalized sidebar row for one user in one chat group.
+    Kept up to date on write (see a_rtchat/inbox.py) so the sidebar never
+    has to aggregate over GroupMessages.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_inbox')
+    group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='inbox_entries')
+    # Other member of a private room, empty for group chats
+    peer = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_inbound_at = models.DateTimeField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    last_message = models.ForeignKey(GroupMessages, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    preview = models.CharField(max_length=120, blank=True, default='')
+    is_request = models.BooleanField(default=False)
+    hidden = models.BooleanField(default=False)
 
     class Meta:
         unique_together = ('user', 'group')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at', '-group'], name='inbox_user_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user.username} inbox {self.group.group_name} ({self.unread_count} unread)'
+
+
+class ArchiveSegment(models.Model):
+    """
+    A run of a room's oldest messages moved out of GroupMessages into a
+    compressed JSONL file under CHAT_ARCHIVE_DIR (see a_rtchat/archive.py).
+    """
+    group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE, related_name='archive_segments')
+    # Relative to CHAT_ARCHIVE_DIR
+    path = models.CharField(max_length=255, unique=True)
+    first_id = models.PositiveBigIntegerField()
+    first_created = models.DateTimeField()
+    last_id = models.PositiveBigIntegerField()
+    last_created = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    size = models.PositiveBigIntegerField()
+    # Offset index: [created (epoch microseconds), id, byte offset] of the first message of every block
+    blocks = models.JSONField(default=list)
+    # Whose messages the file holds, so deleting an account finds the segments to rewrite
+    authors = models.ManyToManyField(User, related_name='+', blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'last_created', 'last_id'], name='archive_group_last_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.group.group_name} archive {self.first_id}-{self.last_id} ({self.count} messages)'
+
+
+class MessageRevision(models.Model):
+    """
+    A body a message had before an edit, stored as a delta against the body
+    that replaced it (see a_rtchat/revisions.py). Only the edit history viewer
+    reads these; message reads never join them.
+    """
+    message = models.ForeignKey(GroupMessages, on_delete=models.CASCADE, related_name='revisions')
+    # 0 is the original text
+    number = models.PositiveIntegerField()
+    delta = models.TextField()
+    # When this version was written: the message's creation or the edit before
+    written_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('message', 'number')
 
     def __str__(self):
-        return f'{self.user.username} read {self.group.group_name} at {self.last_read_at}'
\ No newline at end of file
+        return f'message {self.message_id} revision {self.number}'
@@ -0,0 +1,108 @@
+# a_rtchat/nonces.py
+"""
+Client nonces for idempotent sends.
+
+A client may tag each message it sends with a nonce of its choosing. The
+first send with a given nonce claims it for CHAT_NONCE_WINDOW seconds; a
+retransmit of the same message within the window (say, after a flaky
+reconnect) is recognised and not stored again. The claim lives in Redis (one
+SET NX per message) when CHAT_REDIS_URL is set, otherwise in process. If
+Redis is unreachable, sends go through unchecked.
+"""
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .redis_store import get_redis
+
+# Longest nonce accepted; anything longer is not a nonce this app handed out
+MAX_LENGTH = 64
+
+
+def window():
+    return getattr(settings, 'CHAT_NONCE_WINDOW', 300)
+
+
+def nonce_key(user_id, nonce):
+    return f'chat:nonce:{user_id}:{nonce}'
+
+
+class LocalNonces:
+
+    def __init__(self):
+        self.claims = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key, ttl, now):
+        with self.lock:
+            if len(self.claims) > 10000:
+                self.claims = {k: v for k, v in self.claims.items() if v[1] > now}
+            held = self.claims.get(key)
+            if held and held[1] > now:
+                return held[0]
+            self.claims[key] = (0, now + ttl)
+            return None
+
+    def record(self, key, message_id, ttl, now):
+        with self.lock:
+            if key in self.claims:
+                self.claims[key] = (message_id, now + ttl)
+
+    def release(self, key):
+        with self.lock:
+            self.claims.pop(key, None)
+
+
+class RedisNonces:
+
+    def __init__(self, client):
+        self.r = client
+
+    def claim(self, key, ttl, now):
+        if self.r.set(key, 0, nx=True, ex=ttl):
+            return None
+        return int(self.r.get(key) or 0)
+
+    def record(self, key, message_id, ttl, now):
+        self.r.set(key, message_id, xx=True, ex=ttl)
+
+    def release(self, key):
+        self.r.delete(key)
+
+
+_local = LocalNonces()
+
+
+def _store():
+    client = get_redis()
+    return RedisNonces(client) if client is not None else _local
+
+
+def claim(user_id, nonce):
+    """
+    Claim `nonce` for a message `user_id` is about to store. Returns None if
+    it is new, else the id of the message already stored with it (0 while
+    that one is still being stored).
+    """
+    try:
+        return _store().claim(nonce_key(user_id, nonce), window(), time.time())
+    except redis.RedisError:
+        return None
+
+
+def record(user_id, nonce, message_id):
+    """The message for a claimed nonce has been stored."""
+    try:
+        _store().record(nonce_key(user_id, nonce), message_id, window(), time.time())
+    except redis.RedisError:
+        pass
+
+
+def release(user_id, nonce):
+    """The message for a claimed nonce was not stored after all; a retry may use it."""
+    try:
+        _store().release(nonce_key(user_id, nonce))
+    except redis.RedisError:
+        pass
@@ -0,0 +1,168 @@
+# a_rtchat/presence.py
+"""
+Who is connected to which room, kept out of the database.
+
+Every socket is its own entry, "<user id>:<channel name>", in a per-room
+sorted set scored by its expiry time. Sockets refresh their entry on a
+heartbeat; an entry whose worker crashed simply stops being refreshed and
+drops out after TTL_SECONDS. A user is online while any of their sockets
+is, so closing one of two tabs leaves them online. A socket is present in
+every room it is subscribed to; the *_rooms functions handle all of them in
+one round trip.
+
+Uses Redis when CHAT_REDIS_URL is set, otherwise an in-process store
+(enough for a single development server and the tests).
+"""
+import threading
+import time
+
+import redis
+
+from .redis_store import get_redis
+
+HEARTBEAT_SECONDS = 20
+TTL_SECONDS = 3 * HEARTBEAT_SECONDS
+
+
+def room_key(group_id):
+    return f'chat:presence:{group_id}'
+
+
+def _entry(user_id, channel_name):
+    return f'{user_id}:{channel_name}'
+
+
+def _users(entries):
+    return {int(entry.split(':', 1)[0]) for entry in entries}
+
+
+class LocalPresence:
+
+    def __init__(self):
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def _live(self, group_id, now):
+        room = self.rooms.setdefault(group_id, {})
+        for entry in [e for e, expires in room.items() if expires <= now]:
+            del room[entry]
+        return room
+
+    def touch(self, group_ids, entry):
+        """Add or refresh `entry` in each room; returns the user ids online before, per room."""
+        now = time.time()
+        before = {}
+        with self.lock:
+            for group_id in group_ids:
+                room = self._live(group_id, now)
+                before[group_id] = _users(room)
+                room[entry] = now + TTL_SECONDS
+        return before
+
+    def remove(self, group_ids, entry):
+        with self.lock:
+            for group_id in group_ids:
+                self.rooms.get(group_id, {}).pop(entry, None)
+
+    def entries(self, group_ids):
+        now = time.time()
+        with self.lock:
+            return {group_id: list(self._live(group_id, now)) for group_id in group_ids}
+
+
+class RedisPresence:
+
+    def __init__(self, client):
+        self.r = client
+
+    def touch(self, group_ids, entry):
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for group_id in group_ids:
+            key = room_key(group_id)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zrangebyscore(key, now, '+inf')
+            pipe.zadd(key, {entry: now + TTL_SECONDS})
+            # the whole set goes away once a room has been idle for a TTL
+            pipe.expire(key, TTL_SECONDS)
+        results = pipe.execute()
+        return {group_id: _users(results[4 * n + 1]) for n, group_id in enumerate(group_ids)}
+
+    def remove(self, group_ids, entry):
+        pipe = self.r.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.zrem(room_key(group_id), entry)
+        pipe.execute()
+
+    def entries(self, group_ids):
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.zrangebyscore(room_key(group_id), now, '+inf')
+        return dict(zip(group_ids, pipe.execute()))
+
+
+_local = LocalPresence()
+
+
+def _store():
+    client = get_redis()
+    return RedisPresence(client) if client is not None else _local
+
+
+def connect(group_id, user_id, channel_name):
+    """Register a socket. Returns True if the user was not online in the room before."""
+    return group_id in connect_rooms([group_id], user_id, channel_name)
+
+
+def connect_rooms(group_ids, user_id, channel_name):
+    """Register a socket in every room of `group_ids`. Returns the rooms the user was not online in before."""
+    group_ids = list(group_ids)
+    try:
+        before = _store().touch(group_ids, _entry(user_id, channel_name))
+    except redis.RedisError:
+        return set()
+    return {group_id for group_id, users in before.items() if user_id not in users}
+
+
+def heartbeat(group_id, user_id, channel_name):
+    heartbeat_rooms([group_id], user_id, channel_name)
+
+
+def heartbeat_rooms(group_ids, user_id, channel_name):
+    try:
+        _store().touch(list(group_ids), _entry(user_id, channel_name))
+    except redis.RedisError:
+        pass
+
+
+def disconnect(group_id, user_id, channel_name):
+    """Drop a socket. Returns True if that was the user's last one in the room."""
+    return group_id in disconnect_rooms([group_id], user_id, channel_name)
+
+
+def disconnect_rooms(group_ids, user_id, channel_name):
+    """Drop a socket from every room of `group_ids`. Returns the rooms where that was the user's last one."""
+    group_ids = list(group_ids)
+    try:
+        _store().remove(group_ids, _entry(user_id, channel_name))
+    except redis.RedisError:
+        return set()
+    return {group_id for group_id, users in online_users_by_room(group_ids).items() if user_id not in users}
+
+
+def online_users_by_room(group_ids):
+    """{group id: set of online user ids} in one round trip."""
+    group_ids = list(group_ids)
+    try:
+        return {group_id: _users(entries) for group_id, entries in _store().entries(group_ids).items()}
+    except redis.RedisError:
+        return {group_id: set() for group_id in group_ids}
+
+
+def online_user_ids(group_id):
+    return online_users_by_room([group_id])[group_id]
+
+
+def is_online(group_id, user_id):
+    return user_id in online_user_ids(group_id)
@@ -0,0 +1,140 @@
+# a_rtchat/protocol.py
+"""
+Structured wire protocol for clients that are not browsers (the Android app, bots).
+
+Browsers get htmx OOB fragments. A client that offers one of SUBPROTOCOLS in
+its WebSocket handshake gets compact events instead:
+
+    cnnct.json     text frames, one JSON event per line
+    cnnct.msgpack  binary frames, a stream of concatenated msgpack maps
+
+Every event is a map with a type "t" and its "room":
+
+    message         a new message: id, author, body, ts (epoch ms), status, and
+                    the sender's nonce if it gave one
+    message_update  an edit or delete: the same fields plus edited and deleted
+                    (the body of a deleted message is null)
+    status          your messages up to "delivered"/"read" (ids) have those ticks
+    online          how many other members are online
+    sidebar         your sidebar row for the room changed (see sidebar_payload)
+    resume          reply to an open frame carrying "after" (the last message id
+                    seen): "messages" sent since, "updates" to older ones, and
+                    "more" if you should open again from the last one to get the rest
+    typing          who is typing: the first few "users" ({id, name}, oldest first)
+                    and the "count" of all, you included if you are typing; gone
+                    unless repeated within a few seconds
+    ack             a send whose nonce was already used: the message stored for it
+                    ("id", 0 while it is still being stored) was not stored again
+    purge           the room's retention policy removed "count" messages, those with
+                    ids "from" to "to": drop them
+
+Events are encoded when they are built, once per format, and travel in the
+channel-layer event next to the HTML; a consumer only picks the frame for its
+socket. Clients send what browsers send ({"type": "open", "room": ..., "after": ...}
+and {"body": ..., "room": ..., "nonce": ...}), encoded in their format.
+
+Every client, browsers included, acknowledges the frames it has read with
+{"type": "received", "seq": n}, n counting the frames received on the socket
+since it opened. Send one at least every RECEIVED_EVERY frames: a socket with
+CHAT_OUTBOX_FRAMES unacknowledged frames is closed with code 4008.
+"""
+import json
+
+import msgpack
+
+# How often clients should acknowledge frames; well inside CHAT_OUTBOX_FRAMES
+RECEIVED_EVERY = 16
+
+# Subprotocol name -> format
+SUBPROTOCOLS = {
+    'cnnct.json': 'json',
+    'cnnct.msgpack': 'msgpack',
+}
+
+
+def negotiate(offered):
+    """The first of the `offered` subprotocols we speak, or None for the HTML protocol."""
+    return next((name for name in offered if name in SUBPROTOCOLS), None)
+
+
+def encode(payload):
+    """`payload` in every format: {'json': str, 'msgpack': bytes}."""
+    return {fmt: encode_as(payload, fmt) for fmt in SUBPROTOCOLS.values()}
+
+
+def encode_as(payload, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+def frame(wire, fmt):
+    """(text_data, bytes_data) carrying an encode()d event to a socket speaking `fmt`."""
+    if fmt == 'msgpack':
+        return None, wire['msgpack']
+    return wire['json'], None
+
+
+def decode(text_data=None, bytes_data=None):
+    """An inbound frame as a dict: JSON text from browsers and JSON clients, msgpack bytes otherwise."""
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
+
+
+def message_payload(message, kind='message', nonce=None):
+    payload = {
+        't': kind,
+        'room': message.group.group_name,
+        'id': message.id,
+        'author': {'id': message.author_id, 'username': message.author.username, 'name': message.author.profile.name},
+        'body': None if message.is_deleted else message.body,
+        'ts': int(message.created.timestamp() * 1000),
+        'status': message.tick,
+    }
+    if kind == 'message_update':
+        payload['edited'] = message.edited
+        payload['deleted'] = message.is_deleted
+    if nonce:
+        payload['nonce'] = nonce
+    return payload
+
+
+def resume_payload(room, after, new, changed, more):
+    return {
+        't': 'resume',
+        'room': room,
+        'after': after,
+        'messages': [message_payload(message) for message in new],
+        'updates': [message_payload(message, 'message_update') for message in changed],
+        'more': more,
+    }
+
+
+def ack_payload(room, nonce, message_id):
+    return {'t': 'ack', 'room': room, 'nonce': nonce, 'id': message_id}
+
+
+def typing_payload(room, typists, shown):
+    return {
+        't': 'typing',
+        'room': room,
+        'users': [{'id': uid, 'name': name} for uid, name in typists[:shown]],
+        'count': len(typists),
+    }
+
+
+def status_payload(room, delivered, read):
+    return {'t': 'status', 'room': room, 'delivered': delivered, 'read': read}
+
+
+def online_payload(room, online_count):
+    return {'t': 'online', 'room': room, 'count': online_count}
+
+
+def purge_payload(room, first_id, last_id, count):
+    return {'t': 'purge', 'room': room, 'from': first_id, 'to': last_id, 'count': count}
+
+
+def sidebar_payload(room, item):
+    return {'t': 'sidebar', 'room': room, 'item': item}
@@ -0,0 +1,87 @@
+# a_rtchat/queryplans.py
+"""
+Query-plan checks for the chat's hot queries.
+
+full_scans() runs EXPLAIN for a captured SQL statement (SQLite or
+PostgreSQL) and returns the chat tables it reads in full. The tests run the
+hot paths of the views and the consumer against a seeded database, capture
+every statement and fail on any full scan, so a query that loses its index
+is caught when it is written rather than when a table has grown.
+
+The planners are asked what they would do with large tables: SQLite without
+ANALYZE statistics assumes every table is big, and PostgreSQL is run with
+enable_seqscan off, so a sequential scan that remains has no index to use.
+"""
+import json
+import re
+
+from django.db import connections, transaction
+
+# Tables that grow with use; a full scan of any of them is a regression
+WATCHED = ('a_rtchat_', 'a_users_', 'auth_user')
+
+# Django aliases tables in joins and subqueries as T3, U0, V1...
+ALIAS = re.compile(r'(?:FROM|JOIN)\s+"(\w+)"\s+(?:AS\s+)?"?([A-Z]\d+)\b')
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)')
+# A virtual table given constraints (an FTS5 MATCH) answers from its own index
+SQLITE_VIRTUAL_LOOKUP = re.compile(r'VIRTUAL TABLE INDEX \d+:\S')
+
+
+def watched(table):
+    return table.startswith(WATCHED)
+
+
+def full_scans(sql, using='default'):
+    """Watched tables that `sql` reads in full, according to the database's planner."""
+    connection = connections[using]
+    if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+        return []
+    if connection.vendor == 'sqlite':
+        return _sqlite_scans(connection, sql)
+    if connection.vendor == 'postgresql':
+        return _postgres_scans(connection, sql)
+    raise NotImplementedError(f'No query-plan check for {connection.vendor}')
+
+
+def _sqlite_scans(connection, sql):
+    aliases = dict((alias, table) for table, alias in ALIAS.findall(sql))
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        details = [row[-1] for row in cursor.fetchall()]
+    scans = []
+    for detail in details:
+        # "SCAN t" and "SCAN t USING [COVERING] INDEX i" both visit every row
+        match = SQLITE_SCAN.match(detail)
+        if match and not SQLITE_VIRTUAL_LOOKUP.search(detail):
+            table = aliases.get(match.group(1), match.group(1))
+            if watched(table):
+                scans.append(table)
+    return scans
+
+
+def _postgres_scans(connection, sql):
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scans = []
+
+    def walk(node):
+        if node.get('Node Type') == 'Seq Scan' and watched(node.get('Relation Name', '')):
+            scans.append(node['Relation Name'])
+        for child in node.get('Plans', []):
+            walk(child)
+    walk(plan[0]['Plan'])
+    return scans
+
+
+def plan_report(statements, using='default'):
+    """[(sql, tables scanned in full)] for the captured `statements` that do a full scan."""
+    report = []
+    for sql in dict.fromkeys(statements):
+        scans = full_scans(sql, using)
+        if scans:
+            report.append((sql, scans))
+    return report
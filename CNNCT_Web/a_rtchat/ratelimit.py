@@ -0,0 +1,136 @@
+# a_rtchat/ratelimit.py
+"""
+Per-user token bucket for sending messages, shared by all of a user's sockets
+and the htmx send form.
+
+A bucket holds up to CHAT_SEND_BURST tokens and refills at CHAT_SEND_RATE
+tokens per second; each message takes one. The bucket lives in Redis (one
+atomic script call per message) when CHAT_REDIS_URL is set, otherwise in
+process. If Redis is unreachable, sends are allowed.
+
+The counters behind stats() are for tuning the thresholds; see the
+chat_limiter_stats management command.
+"""
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .redis_store import get_redis
+
+STATS_KEY = 'chat:rate:stats'
+COUNTERS = ('allowed', 'limited', 'overflows')
+
+TAKE_TOKEN = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = tokens >= 1
+if allowed then tokens = tokens - 1 end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+redis.call('HINCRBY', KEYS[2], allowed and 'allowed' or 'limited', 1)
+return allowed and 1 or 0
+"""
+
+
+def rate():
+    return getattr(settings, 'CHAT_SEND_RATE', 1.0)
+
+
+def burst():
+    return getattr(settings, 'CHAT_SEND_BURST', 10)
+
+
+def bucket_key(user_id):
+    return f'chat:rate:{user_id}'
+
+
+class LocalLimiter:
+
+    def __init__(self):
+        self.buckets = {}
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+
+    def take(self, user_id, rate, burst, now):
+        with self.lock:
+            tokens, ts = self.buckets.get(user_id, (burst, now))
+            tokens = min(burst, tokens + max(0, now - ts) * rate)
+            allowed = tokens >= 1
+            self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+            self.counts['allowed' if allowed else 'limited'] += 1
+            return allowed
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(COUNTERS, 0)
+
+
+class RedisLimiter:
+
+    def __init__(self, client):
+        self.r = client
+
+    def take(self, user_id, rate, burst, now):
+        return bool(self.r.eval(TAKE_TOKEN, 2, bucket_key(user_id), STATS_KEY, rate, burst, now))
+
+    def count(self, name):
+        self.r.hincrby(STATS_KEY, name, 1)
+
+    def stats(self):
+        counts = self.r.hgetall(STATS_KEY)
+        return {name: int(counts.get(name, 0)) for name in COUNTERS}
+
+    def reset(self):
+        self.r.delete(STATS_KEY)
+
+
+_local = LocalLimiter()
+
+
+def _store():
+    client = get_redis()
+    return RedisLimiter(client) if client is not None else _local
+
+
+def allow(user_id):
+    """Take a token from the user's bucket. Returns False if they are sending too fast."""
+    try:
+        return _store().take(user_id, rate(), burst(), time.time())
+    except redis.RedisError:
+        return True
+
+
+def count_overflow():
+    """A socket was closed because it fell too far behind on outbound frames."""
+    try:
+        _store().count('overflows')
+    except redis.RedisError:
+        pass
+
+
+def stats():
+    """{'allowed', 'limited', 'overflows'} since the counters were last reset."""
+    try:
+        return _store().stats()
+    except redis.RedisError:
+        return dict.fromkeys(COUNTERS, 0)
+
+
+def reset_stats():
+    try:
+        _store().reset()
+    except redis.RedisError:
+        pass
@@ -0,0 +1,145 @@
+# a_rtchat/receipts.py
+"""
+Delivery and read receipts as per-member watermarks.
+
+ChatReadState.last_delivered_id / last_read_id record how far each member
+has received and read a room. A message's tick is derived when rendering,
+from the lowest watermarks among the members other than its author, so a
+delivery or a read is one row update however large the backlog is.
+"""
+from django.db.models import F, Max
+from django.db.models.functions import Greatest
+from django.template.loader import render_to_string
+
+from . import protocol
+from .models import ChatGroup, ChatInbox, ChatReadState, GroupMessages
+
+STATUS_TEMPLATE = 'a_rtchat/partials/message_status.html'
+
+
+def annotate_ticks(messages):
+    """Fill message.tick for a list of messages with one query per (room, author)."""
+    watermarks = {}
+    for message in messages:
+        key = (message.group_id, message.author_id)
+        if key not in watermarks:
+            watermarks[key] = ChatReadState.watermarks(*key)
+        message._tick = message.tick_for(watermarks[key])
+    return messages
+
+
+def mark_delivered(group_id, user_ids, up_to_id=None):
+    """Raise the delivered watermark of members `user_ids` to `up_to_id` (default: newest message)."""
+    return _advance(group_id, user_ids, up_to_id, read=False)
+
+
+def mark_delivered_rooms(group_ids, user_id):
+    """
+    Raise the user's delivered watermark to the newest message of each room in
+    `group_ids`. Rooms already up to date cost nothing beyond three queries for
+    all of them; returns the status events of the rooms that moved.
+    """
+    group_ids = list(group_ids)
+    # ChatInbox already knows the newest message of every sidebar room
+    tops = dict(
+        ChatInbox.objects.filter(user_id=user_id, group_id__in=group_ids, last_message__isnull=False)
+        .values_list('group_id', 'last_message_id')
+    )
+    missing = set(group_ids) - set(tops)
+    if missing:
+        # The other rooms' newest messages, in one grouped query
+        tops.update(
+            GroupMessages.objects.filter(group_id__in=missing).order_by()
+            .values('group_id').annotate(top=Max('id')).values_list('group_id', 'top')
+        )
+    delivered = dict(
+        ChatReadState.objects.filter(user_id=user_id, group_id__in=tops).values_list('group_id', 'last_delivered_id')
+    )
+    events = []
+    for group_id, top in tops.items():
+        if delivered.get(group_id, 0) < top:
+            event = _advance(group_id, [user_id], top, read=False)
+            if event:
+                events.append(event)
+    return events
+
+
+def mark_read(group_id, user_id, up_to_id=None):
+    return _advance(group_id, [user_id], up_to_id, read=True)
+
+
+def _advance(group_id, user_ids, up_to_id, read):
+    """Returns a message_status_handler event for the room, or None if no watermark moved."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return None
+    if up_to_id is None:
+        up_to_id = GroupMessages.objects.filter(group_id=group_id).aggregate(top=Max('id'))['top']
+        if up_to_id is None:
+            return None
+
+    # Only members have watermarks
+    user_ids = list(
+        ChatGroup.members.through.objects.filter(chatgroup_id=group_id, user_id__in=user_ids)
+        .values_list('user_id', flat=True)
+    )
+    ChatReadState.objects.bulk_create(
+        [ChatReadState(group_id=group_id, user_id=uid) for uid in user_ids], ignore_conflicts=True
+    )
+    states = ChatReadState.objects.filter(group_id=group_id, user_id__in=user_ids)
+    if read:
+        moved = states.filter(last_read_id__lt=up_to_id).update(
+            last_read_id=up_to_id, last_delivered_id=Greatest(F('last_delivered_id'), up_to_id),
+        )
+    else:
+        moved = states.filter(last_delivered_id__lt=up_to_id).update(last_delivered_id=up_to_id)
+    return status_event(group_id) if moved else None
+
+
+def _lowest_two(rows, field):
+    """(lowest value, its member if only one has it, the value everyone else sees when they are that member)."""
+    (low_user, low), *rest = list(rows.order_by(field, 'user_id').values_list('user_id', field)[:2]) or [(None, 0)]
+    if not rest:
+        return low, low_user, 0
+    if rest[0][1] == low:
+        return low, None, low
+    return low, low_user, rest[0][1]
+
+
+def status_event(group_id):
+    """
+    One event that lets every socket in the room recompute its own ticks:
+    the lowest delivered/read watermarks, plus the runner-up for the one member
+    (if any) who holds the lowest, since a member's own watermark never counts
+    for their messages. The few distinct frames are rendered once.
+    """
+    rows = ChatReadState.member_watermarks(group_id)
+    room = ChatGroup.objects.filter(id=group_id).values_list('group_name', flat=True).get()
+    delivered = _lowest_two(rows, 'delivered')
+    read = _lowest_two(rows, 'read')
+
+    html, wire = {}, {}
+    for d in {delivered[0], delivered[2]}:
+        for r in {read[0], read[2]}:
+            html[f'{d}:{r}'] = render_to_string(STATUS_TEMPLATE, {'delivered': max(d, r), 'read': r})
+            wire[f'{d}:{r}'] = protocol.encode(protocol.status_payload(room, max(d, r), r))
+    return {
+        'type': 'message_status_handler',
+        'room': room,
+        'delivered': delivered,
+        'read': read,
+        'html': html,
+        'wire': wire,
+    }
+
+
+def viewer_status_key(event, user_id):
+    """Which of the event's variants `user_id` sees."""
+    def seen(watermark):
+        low, holder, runner_up = watermark
+        return runner_up if user_id == holder else low
+    return f'{seen(event["delivered"])}:{seen(event["read"])}'
+
+
+def viewer_status_html(event, user_id):
+    return event['html'][viewer_status_key(event, user_id)]
@@ -0,0 +1,23 @@
+# a_rtchat/redis_store.py
+import redis
+from django.conf import settings
+
+_clients = {}
+
+
+def get_redis():
+    """
+    Shared client for chat state kept directly in Redis (counters, presence...).
+    Returns None when CHAT_REDIS_URL is unset; callers then fall back to the database.
+    """
+    url = getattr(settings, 'CHAT_REDIS_URL', None)
+    if not url:
+        return None
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(
+            url,
+            decode_responses=True,
+            socket_timeout=0.5,
+            socket_connect_timeout=0.5,
+        )
+    return _clients[url]
@@ -0,0 +1,116 @@
+# a_rtchat/retention.py
+"""
+Per-room message retention.
+
+ChatGroup.retention_days is set by the room's admin on the edit page or by
+operators in the Django admin; empty keeps messages forever. The
+purge_messages command deletes what has expired:
+
+- purge_batch() deletes a room's oldest expired messages, a few hundred at a
+  time in (created, id) order off the (group, created, id) index, each batch
+  in its own short transaction that also takes them off the members' unread
+  counts;
+- purge_archive() drops expired messages from the room's archived segments
+  (a_rtchat/archive.py);
+- pause() paces the batches, so SQLite writers never wait long for the lock
+  and PostgreSQL replicas keep up.
+
+Sockets in the room hear about each batch in one tombstone-range event: the
+lowest and highest id purged. Ids follow send order, so the range is exactly
+the batch.
+"""
+import time
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import archive, inbox, protocol, search
+from .models import ArchiveSegment, GroupMessages
+
+BATCH_SIZE = 500
+
+
+def max_replica_lag():
+    """Seconds a PostgreSQL replica may fall behind before the purge waits for it."""
+    return getattr(settings, 'CHAT_PURGE_MAX_REPLICA_LAG', 2.0)
+
+
+def cutoff(group, now=None):
+    """Messages of `group` created before this have expired; None if the room keeps them forever."""
+    if not group.retention_days:
+        return None
+    return (now or timezone.now()) - timedelta(days=group.retention_days)
+
+
+def tombstone_event(room, first_id, last_id, count):
+    return {
+        'type': 'purge_handler',
+        'room': room,
+        'html': render_to_string('a_rtchat/partials/purge.html', {'first_id': first_id, 'last_id': last_id}),
+        'wire': protocol.encode(protocol.purge_payload(room, first_id, last_id, count)),
+    }
+
+
+def announce(group, ids):
+    """One tombstone-range event to the room for a purged batch, once it is committed."""
+    event = tombstone_event(group.group_name, min(ids), max(ids), len(ids))
+    transaction.on_commit(lambda: async_to_sync(get_channel_layer().group_send)(group.group_name, event))
+
+
+def purge_batch(group, before, limit=BATCH_SIZE):
+    """Delete up to `limit` of the room's oldest messages created before `before`; returns how many."""
+    messages = list(
+        GroupMessages.objects.filter(group_id=group.id, created__lt=before)
+        .order_by('created', 'id').only('id', 'author_id', 'created')[:limit]
+    )
+    if not messages:
+        return 0
+    ids = [message.id for message in messages]
+    with transaction.atomic():
+        # Before the rows go: the sidebar previews of purged messages are cleared by id
+        inbox.record_deletes(ids)
+        inbox.record_purge(group.id, messages)
+        search.unindex(ids)
+        GroupMessages.objects.filter(id__in=ids).delete()
+        announce(group, ids)
+    return len(ids)
+
+
+def purge_archive(group, before):
+    """Drop the room's archived messages created before `before`; returns how many (one event per segment)."""
+    purged = 0
+    for segment in ArchiveSegment.objects.filter(group_id=group.id, first_created__lt=before).order_by('first_created'):
+        with transaction.atomic():
+            expired = archive.expire_segment(segment, before)
+            ids = [message.id for message in expired]
+            if ids:
+                inbox.record_purge(group.id, expired)
+                search.unindex(ids)
+                announce(group, ids)
+        purged += len(ids)
+    return purged
+
+
+def replica_lag():
+    """Seconds the furthest PostgreSQL replica is behind (0 elsewhere, or without replicas)."""
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(EXTRACT(EPOCH FROM MAX(replay_lag)), 0) FROM pg_stat_replication')
+        return float(cursor.fetchone()[0])
+
+
+def pause(elapsed, minimum):
+    """
+    Sleep after a batch that took `elapsed` seconds: at least `minimum` and as
+    long as the batch itself, so the purge holds the database at most half the
+    time, then for as long as a replica lags behind.
+    """
+    time.sleep(max(minimum, elapsed))
+    while replica_lag() > max_replica_lag():
+        time.sleep(max(minimum, 0.5))
@@ -0,0 +1,129 @@
+# a_rtchat/revisions.py
+"""
+Edit history of messages.
+
+GroupMessages.body always holds the current text, so reading messages never
+touches the history. Each edit saves the body it replaces as a
+MessageRevision. The row holds a delta that rebuilds that body from the one
+replacing it, not the text itself, so a long message edited many times costs
+little more than its edits. Revision 0 is the original text and the current
+body is the newest revision; body_at() walks back from the current body to
+rebuild any of them.
+
+A delta is a JSON list of operations over the newer text: a positive int
+copies that many characters, a negative int skips that many, and a string
+is inserted. Whatever is left of the newer text after the last operation is
+dropped. The unchanged prefix and suffix are copied whole. Only the part in
+between is diffed, character by character when it is short and replaced
+outright when it is long.
+"""
+import json
+from difflib import SequenceMatcher
+
+from .models import MessageRevision
+
+# Longest changed stretch diffed character by character; longer ones are replaced whole
+DIFF_LIMIT = 2000
+
+
+def diff(source, target):
+    """Operations turning `source` into `target`."""
+    prefix = 0
+    limit = min(len(source), len(target))
+    while prefix < limit and source[prefix] == target[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and source[-suffix - 1] == target[-suffix - 1]:
+        suffix += 1
+    old, new = source[prefix:len(source) - suffix], target[prefix:len(target) - suffix]
+
+    ops = [prefix]
+    if max(len(old), len(new)) <= DIFF_LIMIT:
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+            if tag == 'equal':
+                ops.append(i2 - i1)
+                continue
+            if i2 > i1:
+                ops.append(i1 - i2)
+            if j2 > j1:
+                ops.append(new[j1:j2])
+    else:
+        ops += [-len(old), new]
+    ops.append(suffix)
+    return compact(ops)
+
+
+def compact(ops):
+    """Merge neighbouring operations of a kind and drop empty ones (and a trailing skip)."""
+    merged = []
+    for op in ops:
+        if op == 0 or op == '':
+            continue
+        if merged and type(op) is type(merged[-1]) and (isinstance(op, str) or (op > 0) == (merged[-1] > 0)):
+            merged[-1] += op
+        else:
+            merged.append(op)
+    while merged and isinstance(merged[-1], int) and merged[-1] < 0:
+        merged.pop()
+    return merged
+
+
+def apply(source, ops):
+    out, position = [], 0
+    for op in ops:
+        if isinstance(op, str):
+            out.append(op)
+        elif op > 0:
+            out.append(source[position:position + op])
+            position += op
+        else:
+            position -= op
+    return ''.join(out)
+
+
+def record(message, new_body):
+    """
+    Save `message`'s current body as a revision before it is replaced by
+    `new_body`. Call it in the edit's transaction, with the message row locked
+    (select_for_update()) and read again, before saving the message.
+    """
+    number = MessageRevision.objects.filter(message=message).count()
+    MessageRevision.objects.create(
+        message=message,
+        number=number,
+        delta=json.dumps(diff(new_body, message.body), ensure_ascii=False, separators=(',', ':')),
+        written_at=message.edited_at or message.created,
+    )
+
+
+def history(message):
+    """
+    Every version of `message`, oldest first, as dicts (number, body,
+    written_at); the last one is the current body.
+    """
+    rows = list(MessageRevision.objects.filter(message=message).order_by('-number'))
+    body = message.body
+    versions = [{'number': len(rows), 'body': body, 'written_at': message.edited_at or message.created}]
+    for row in rows:
+        body = apply(body, json.loads(row.delta))
+        versions.append({'number': row.number, 'body': body, 'written_at': row.written_at})
+    return versions[::-1]
+
+
+def body_at(message, number):
+    """The body `message` had at revision `number` (0 is the original), or None if it has no such revision."""
+    if number < 0:
+        return None
+    # Revisions are numbered from 0 without gaps, so these lead back to exactly `number`
+    deltas = list(
+        MessageRevision.objects.filter(message=message, number__gte=number)
+        .order_by('-number').values_list('delta', flat=True)
+    )
+    if not deltas:
+        # Only the current body can be newer than every stored revision
+        current = MessageRevision.objects.filter(message=message).count()
+        return message.body if number == current else None
+    body = message.body
+    for delta in deltas:
+        body = apply(body, json.loads(delta))
+    return body
@@ -0,0 +1,63 @@
+# a_rtchat/rooms.py
+"""
+Rooms followed by a chat socket.
+
+A user has one socket for all of their rooms: at connect it subscribes to the
+channel-layer group of every room they are a member of, and frames are routed
+by the room they belong to. Joining or leaving a room while connected is
+pushed to the user's sockets with a room_membership_handler event.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .models import ChatGroup
+from .sidebar import user_channel_group
+
+
+def room_entry(group_id, group_name, is_private, peer_id=None):
+    """What a socket keeps about one room: enough to route frames and check blocks without queries."""
+    return {'id': group_id, 'group_name': group_name, 'is_private': is_private, 'peer_id': peer_id}
+
+
+def user_rooms(user):
+    """{group_name: room entry} for every room `user` is a member of, in two queries."""
+    Membership = ChatGroup.members.through
+    rows = list(
+        Membership.objects.filter(user_id=user.id)
+        .values_list('chatgroup_id', 'chatgroup__group_name', 'chatgroup__is_private')
+    )
+    peers = dict(
+        Membership.objects.filter(chatgroup_id__in=[gid for gid, _, private in rows if private])
+        .exclude(user_id=user.id)
+        .values_list('chatgroup_id', 'user_id')
+    )
+    return {name: room_entry(gid, name, private, peers.get(gid)) for gid, name, private in rows}
+
+
+def open_room(user, group_name):
+    """Room entry for `group_name` if `user` may follow it (private rooms: members only), else None."""
+    group = ChatGroup.objects.filter(group_name=group_name).first()
+    if group is None:
+        return None
+    if not group.is_private:
+        return room_entry(group.id, group.group_name, False)
+    member_ids = set(group.members.values_list('id', flat=True))
+    if user.id not in member_ids:
+        return None
+    peer_id = next((uid for uid in member_ids if uid != user.id), None)
+    return room_entry(group.id, group.group_name, True, peer_id)
+
+
+def push_membership_change(group, user_ids, joined):
+    """Once committed, tell the sockets of `user_ids` to start (or stop) following `group`."""
+    def send():
+        channel_layer = get_channel_layer()
+        for uid in user_ids:
+            async_to_sync(channel_layer.group_send)(user_channel_group(uid), {
+                'type': 'room_membership_handler',
+                'room': group.group_name,
+                'joined': joined,
+            })
+    if user_ids:
+        transaction.on_commit(send)
@@ -1,6 +1,9 @@
 from django.urls import path
-from .consumers  import ChatroomConsumer
+from .consumers  import ChatConsumer
 
 websocket_urlpatterns=[
-    path("ws/chatroom/<chatroom_name>",ChatroomConsumer.as_asgi()),
+    # One socket per user for all rooms
+    path("ws/chat/", ChatConsumer.as_asgi()),
+    # Same socket, opening one room right away
+    path("ws/chatroom/<chatroom_name>",ChatConsumer.as_asgi()),
 ]
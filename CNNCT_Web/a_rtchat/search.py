@@ -0,0 +1,219 @@
+# a_rtchat/search.py
+"""
+Full-text search over the messages of a user's rooms.
+
+The index is a table of its own, a_rtchat_message_search, one row per
+searchable message (rowid / message_id is the message id) with what a result
+needs: room, author, time and body. On SQLite it is an FTS5 table, on
+PostgreSQL a plain table with a generated tsvector under a GIN index; both are
+created by migration 0032. The views and the consumer keep it in step as
+messages are sent, edited and deleted (index_message() / unindex()), and
+signals drop the rows of deleted accounts and rooms (unindex_author() /
+unindex_room()), so deleted messages never match and a search never reads
+GroupMessages. Rows outlive archiving, so archived messages are found like hot
+ones.
+
+search() matches against the index, restricted to the rooms the user is a
+member of, ranks by relevance (bm25 / ts_rank) and pages on (rank, id);
+snippets are cut only for the rows of the page returned.
+"""
+import re
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import archive
+from .models import ChatGroup, ChatInbox
+
+TABLE = 'a_rtchat_message_search'
+PAGE_SIZE = 20
+# Search terms beyond this are ignored
+MAX_TERMS = 8
+# Snippet highlight markers, swapped for <mark> once the snippet is escaped
+MARK_START, MARK_END = '\x02', '\x03'
+TERM = re.compile(r'\w+')
+
+def sqlite():
+    return connection.vendor == 'sqlite'
+
+
+def index_message(message):
+    """Add `message` to the index, or replace its body after an edit."""
+    row = [message.id, message.group_id, message.author_id, connection.ops.adapt_datetimefield_value(message.created), message.body]
+    with connection.cursor() as cursor:
+        if sqlite():
+            cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [message.id])
+            cursor.execute(f'INSERT INTO {TABLE} (rowid, group_id, author_id, created, body) VALUES (%s, %s, %s, %s, %s)', row)
+        else:
+            cursor.execute(
+                f'INSERT INTO {TABLE} (message_id, group_id, author_id, created, body) VALUES (%s, %s, %s, %s, %s) '
+                'ON CONFLICT (message_id) DO UPDATE SET body = EXCLUDED.body',
+                row,
+            )
+
+
+def unindex(message_ids):
+    """Drop deleted messages from the index."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    key = 'rowid' if sqlite() else 'message_id'
+    placeholders = ', '.join(['%s'] * len(message_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE {key} IN ({placeholders})', message_ids)
+
+
+def unindex_author(user_id):
+    """Drop every message of a deleted account, hot or archived."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE author_id = %s', [user_id])
+
+
+def unindex_room(group_id):
+    """Drop every message of a deleted room."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE group_id = %s', [group_id])
+
+
+def reindex(messages):
+    """
+    Rebuild the index from `messages` (a GroupMessages queryset) and the
+    archived messages; returns how many were indexed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+    count = 0
+    for message in messages.filter(is_deleted=False).order_by('id').iterator(chunk_size=2000):
+        index_message(message)
+        count += 1
+    for message in archive.archived_messages():
+        if not message.is_deleted:
+            index_message(message)
+            count += 1
+    return count
+
+
+def terms(query):
+    return TERM.findall(query.lower())[:MAX_TERMS]
+
+
+def match_expression(words):
+    """Every word must appear; the last one may be a prefix, as the user is probably still typing it."""
+    if sqlite():
+        return ' '.join(f'"{word}"' for word in words) + '*'
+    return ' & '.join(words) + ':*'
+
+
+def search(user, query, cursor=None, limit=PAGE_SIZE):
+    """
+    One page of the messages matching `query` in `user`'s rooms, best match
+    first, as a list of dicts (id, group, room, author, created, snippet).
+    Returns (results, next_cursor); next_cursor is None on the last page.
+    """
+    words = terms(query)
+    if not words:
+        return [], None
+    expression = match_expression(words)
+    position = decode_cursor(cursor)
+    rows = (_sqlite_search if sqlite() else _postgres_search)(user.id, expression, position, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return results(user, rows), next_cursor
+
+
+MEMBER_ROOMS = 'SELECT chatgroup_id FROM a_rtchat_chatgroup_members WHERE user_id = %s'
+
+
+def _sqlite_search(user_id, expression, position, limit):
+    after, params = '', [expression, user_id]
+    if position:
+        after = f'AND ({TABLE}.rank > %s OR ({TABLE}.rank = %s AND {TABLE}.rowid > %s))'
+        params += [position[0], position[0], position[1]]
+    # The page is ranked first and only its rows get a snippet
+    sql = f"""
+        WITH page AS (
+            SELECT rowid AS id, group_id, author_id, created, rank
+            FROM {TABLE}
+            WHERE {TABLE} MATCH %s AND group_id IN ({MEMBER_ROOMS}) {after}
+            ORDER BY rank, rowid
+            LIMIT %s
+        )
+        SELECT page.id, page.group_id, page.author_id, page.created, page.rank,
+               snippet({TABLE}, 0, char(2), char(3), '…', 16)
+        FROM page JOIN {TABLE} ON {TABLE}.rowid = page.id
+        WHERE {TABLE} MATCH %s
+        ORDER BY page.rank, page.id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit, expression])
+        return cursor.fetchall()
+
+
+def _postgres_search(user_id, expression, position, limit):
+    # ts_rank() is a real; as float8 it round-trips through the cursor and compares equal again
+    after, params = '', [expression, user_id]
+    if position:
+        after = 'AND (-ts_rank(document, query)::float8 > %s OR (-ts_rank(document, query)::float8 = %s AND message_id > %s))'
+        params += [position[0], position[0], position[1]]
+    sql = f"""
+        SELECT page.message_id, page.group_id, page.author_id, page.created, page.rank,
+               ts_headline('simple', page.body, page.query,
+                           'StartSel="{MARK_START}", StopSel="{MARK_END}", MaxWords=16, MinWords=6, MaxFragments=1')
+        FROM (
+            SELECT message_id, group_id, author_id, created, body, query, -ts_rank(document, query)::float8 AS rank
+            FROM {TABLE}, to_tsquery('simple', %s) AS query
+            WHERE document @@ query AND group_id IN ({MEMBER_ROOMS}) {after}
+            ORDER BY rank, message_id
+            LIMIT %s
+        ) AS page
+        ORDER BY page.rank, page.message_id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit])
+        return cursor.fetchall()
+
+
+def results(user, rows):
+    """Result dicts for the page `rows`, with authors and room titles loaded in bulk."""
+    authors = User.objects.select_related('profile').in_bulk({row[2] for row in rows})
+    group_ids = {row[1] for row in rows}
+    groups = ChatGroup.objects.in_bulk(group_ids)
+    peers = {
+        entry.group_id: entry.peer
+        for entry in ChatInbox.objects.filter(user=user, group_id__in=group_ids, peer__isnull=False).select_related('peer__profile')
+    }
+    items = []
+    for message_id, group_id, author_id, created, rank, snippet in rows:
+        group = groups[group_id]
+        peer = peers.get(group_id)
+        items.append({
+            'id': message_id,
+            'group': group,
+            'room': group.groupchat_name or (peer.profile.name if peer else 'Private chat'),
+            'author': authors.get(author_id),
+            # FTS5 columns come back as stored, i.e. as text
+            'created': parse_datetime(created) if isinstance(created, str) else created,
+            'snippet': highlight(snippet),
+        })
+    return items
+
+
+def highlight(snippet):
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def encode_cursor(row):
+    return f'{row[4]!r}_{row[0]}'
+
+
+def decode_cursor(cursor):
+    try:
+        rank, message_id = (cursor or '').rsplit('_', 1)
+        return float(rank), int(message_id)
+    except ValueError:
+        return None
@@ -0,0 +1,160 @@
+# a_rtchat/sidebar.py
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+
+from . import protocol, unread
+from .models import ChatInbox
+
+PAGE_SIZE = 30
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def user_channel_group(user_id):
+    """Personal channel-layer group every connected socket of a user subscribes to."""
+    return f'user_{user_id}'
+
+
+def build_sidebar(user, query=''):
+    """
+    Build the whole chat sidebar for `user` as a list of dicts
+    (kind, group, other, unread, is_request, latest, preview), most recent activity first.
+    """
+    return sidebar_page(user, query=query, limit=None)[0]
+
+
+def sidebar_page(user, cursor=None, query='', limit=PAGE_SIZE):
+    """
+    One page of the sidebar, keyset-paginated on (last_activity_at, group_id).
+    Returns (items, next_cursor); next_cursor is None on the last page.
+
+    Reads the denormalized ChatInbox rows in a single indexed query; the
+    counters are maintained on write by a_rtchat/inbox.py.
+    """
+    rows = (
+        ChatInbox.objects.filter(user=user)
+        # If hidden, only show if there are unread inbound messages
+        .filter(Q(hidden=False) | Q(unread_count__gt=0))
+        # Skip private rooms with users we blocked, or whose other member is gone
+        .exclude(peer__blocked_by__blocker=user)
+        .exclude(group__is_private=True, peer__isnull=True)
+        .select_related('group', 'peer__profile')
+        .order_by('-last_activity_at', '-group_id')
+    )
+    if query:
+        rows = rows.filter(
+            Q(group__groupchat_name__icontains=query) |
+            Q(peer__username__icontains=query) |
+            Q(peer__profile__displayname__icontains=query)
+        )
+    position = decode_cursor(cursor)
+    if position:
+        last_activity_at, group_id = position
+        rows = rows.filter(
+            Q(last_activity_at__lt=last_activity_at) |
+            Q(last_activity_at=last_activity_at, group_id__lt=group_id)
+        )
+
+    next_cursor = None
+    if limit is not None:
+        rows = list(rows[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1])
+
+    # ChatGroup.private_key guarantees one private room per pair, so no de-duplication here
+    items = [sidebar_item(row) for row in rows]
+    # Badges from the Redis counters when available (one round trip), else the inbox rows
+    counts = unread.unread_counts(user.id)
+    if counts is not None:
+        for item in items:
+            item['unread'] = counts.get(item['group'].id, 0)
+    return items, next_cursor
+
+
+def encode_cursor(row):
+    micros = (row.last_activity_at - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}-{row.group_id}'
+
+
+def decode_cursor(cursor):
+    try:
+        micros, group_id = (int(part) for part in (cursor or '').split('-'))
+        return EPOCH + timedelta(microseconds=micros), group_id
+    except (ValueError, OverflowError):
+        # Not one of ours, or a time out of range: start from the top
+        return None
+
+
+def sidebar_item(row):
+    return {
+        'kind': 'private' if row.group.is_private else 'group',
+        'group': row.group,
+        'other': row.peer if row.group.is_private else None,
+        'unread': row.unread_count,
+        'is_request': row.is_request,
+        'latest': row.last_inbound_at,
+        'preview': row.preview,
+    }
+
+
+def sidebar_payload(row):
+    """JSON/msgpack-safe version of sidebar_item(), renderable by the same template."""
+    item = sidebar_item(row)
+    group = row.group
+    item['group'] = {'group_name': group.group_name, 'groupchat_name': group.groupchat_name}
+    item['latest'] = row.last_inbound_at.isoformat() if row.last_inbound_at else None
+    if item['other']:
+        peer = item['other']
+        item['other'] = {
+            'username': peer.username,
+            'profile': {'name': peer.profile.name, 'avatar': peer.profile.avatar},
+        }
+    return item
+
+
+def sidebar_events(group, user_ids=None, move_to_top=True):
+    """
+    (channel group, event) pairs carrying the current sidebar row of `group`
+    for each member (or just `user_ids`), rendered ahead so every socket of
+    that user just forwards the HTML. Members' rows differ only in the peer,
+    the badges and (on the wire) the last inbound time, so each distinct row
+    is rendered and encoded once, however many members share it.
+    """
+    rows = (
+        ChatInbox.objects.filter(group=group)
+        .filter(Q(hidden=False) | Q(unread_count__gt=0))
+        .exclude(peer__blocked_by__blocker=F('user'))
+        .select_related('group', 'peer__profile')
+    )
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=user_ids)
+    events, rendered, encoded = [], {}, {}
+    for row in rows:
+        item = sidebar_payload(row)
+        looks = (row.peer_id, item['unread'], item['is_request'])
+        if looks not in rendered:
+            rendered[looks] = render_to_string(
+                'a_rtchat/partials/sidebar_item_oob.html', {'item': item, 'move_to_top': move_to_top}
+            )
+        data = looks + (item['latest'],)
+        if data not in encoded:
+            encoded[data] = protocol.encode(protocol.sidebar_payload(row.group.group_name, item))
+        events.append((user_channel_group(row.user_id), {
+            'type': 'sidebar_item_handler',
+            'item': item,
+            'move_to_top': move_to_top,
+            'html': rendered[looks],
+            'wire': encoded[data],
+        }))
+    return events
+
+
+def push_sidebar_updates(group, user_ids=None, move_to_top=True):
+    """Send sidebar_events() from synchronous code (views)."""
+    channel_layer = get_channel_layer()
+    for target, event in sidebar_events(group, user_ids, move_to_top):
+        async_to_sync(channel_layer.group_send)(target, event)
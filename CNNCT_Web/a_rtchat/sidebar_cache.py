@@ -0,0 +1,97 @@
+# a_rtchat/sidebar_cache.py
+"""
+Rendered first page of each user's sidebar, cached under a per-user version.
+
+Whatever changes what a user's sidebar shows (a new message in one of their
+rooms, a read, hiding a room, membership changes, block/unblock) calls
+bump(), which points the user at a fresh version; the old HTML is simply
+never read again and expires. Rows don't depend on the open room, so moving
+between rooms with chat_view is a cache hit until something changes.
+"""
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .sidebar import sidebar_page
+
+# Also bounds how stale a peer's name or avatar can get, since profile edits don't bump
+TIMEOUT = 10 * 60
+HITS_KEY = 'sidebar:stats:hits'
+MISSES_KEY = 'sidebar:stats:misses'
+
+
+def get_cache():
+    return caches[getattr(settings, 'CHAT_SIDEBAR_CACHE', 'default')]
+
+
+def version_key(user_id):
+    return f'sidebar:version:{user_id}'
+
+
+def html_key(user_id, version):
+    return f'sidebar:html:{user_id}:{version}'
+
+
+def bump(user_ids):
+    """Invalidate the cached sidebar of every user in `user_ids`."""
+    if not user_ids:
+        return
+    try:
+        get_cache().set_many({version_key(uid): uuid4().hex for uid in user_ids}, TIMEOUT)
+    except Exception:
+        # Cache is down: nothing cached can be served either
+        pass
+
+
+def render_sidebar(user):
+    """HTML of the first sidebar page for `user`, from the cache when the version is current."""
+    cache = get_cache()
+    try:
+        version = cache.get(version_key(user.id))
+        if version is None:
+            cache.add(version_key(user.id), uuid4().hex, TIMEOUT)
+            version = cache.get(version_key(user.id))
+        html = cache.get(html_key(user.id, version)) if version else None
+    except Exception:
+        return _render(user)
+
+    _count(HITS_KEY if html is not None else MISSES_KEY)
+    if html is None:
+        html = _render(user)
+        try:
+            # A bump while rendering leaves this under the old version, where it is never read
+            cache.set(html_key(user.id, version), html, TIMEOUT)
+        except Exception:
+            pass
+    return mark_safe(html)
+
+
+def _render(user):
+    sidebar_chats, sidebar_next_cursor = sidebar_page(user)
+    return render_to_string('a_rtchat/partials/sidebar_page.html', {
+        'sidebar_chats': sidebar_chats,
+        'sidebar_next_cursor': sidebar_next_cursor,
+    })
+
+
+def _count(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+    except Exception:
+        pass
+
+
+def stats():
+    """(hits, misses) since the counters were last reset."""
+    counts = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    return counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+
+
+def reset_stats():
+    get_cache().delete_many([HITS_KEY, MISSES_KEY])
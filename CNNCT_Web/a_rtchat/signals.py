@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from .models import ArchiveSegment, ChatGroup
+from . import archive, inbox, rooms, search
+
+
+@receiver(m2m_changed, sender=ChatGroup.members.through)
+def chatgroup_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Keep a ChatInbox row for every member of every sidebar room
+    if reverse:
+        # user.chat_groups.add(...) style call: instance is the user
+        groups = ChatGroup.objects.filter(pk__in=pk_set or [])
+        for group in groups:
+            if action == 'post_add':
+                inbox.sync_members(group, [instance.pk])
+                rooms.push_membership_change(group, [instance.pk], joined=True)
+            elif action == 'post_remove':
+                inbox.remove_members(group, [instance.pk])
+                rooms.push_membership_change(group, [instance.pk], joined=False)
+        if action == 'pre_clear':
+            instance.chat_inbox.all().delete()
+        return
+
+    if action == 'post_add':
+        inbox.sync_members(instance, pk_set)
+        rooms.push_membership_change(instance, pk_set, joined=True)
+    elif action == 'post_remove':
+        inbox.remove_members(instance, pk_set)
+        inbox.sync_members(instance, [])
+        rooms.push_membership_change(instance, pk_set, joined=False)
+    elif action == 'pre_clear':
+        inbox.remove_members(instance)
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def archive_segment_deleted(sender, instance, **kwargs):
+    # The room was deleted, or the segment expired or was rewritten (a_rtchat/archive.py)
+    transaction.on_commit(lambda: archive.remove_file(instance))
+
+
+# The search index has no foreign keys, so the cascades that delete an
+# account's or a room's messages leave its rows to be dropped here; an
+# account's archived messages are erased from the segment files as well
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    archive.erase_author(instance.pk)
+    search.unindex_author(instance.pk)
+
+
+@receiver(pre_delete, sender=ChatGroup)
+def chatgroup_deleted(sender, instance, **kwargs):
+    search.unindex_room(instance.pk)
@@ -1,3 +1,1862 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import os
+import socket
+import struct
+import tempfile
+import json
+import time
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import msgpack
+import redis
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from daphne.testing import DaphneProcess
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from a_users.models import BlockedUser, Profile
+from . import archive, fanout, history, inbox, nonces, presence, protocol, queryplans, ratelimit, receipts, retention, revisions, search, sidebar_cache, typists, unread
+from .consumers import ChatConsumer
+from .models import ArchiveSegment, ChatGroup, ChatInbox, ChatReadState, GroupMessages, MessageRevision
+from .redis_store import get_redis
+from .routing import websocket_urlpatterns
+from .sidebar import build_sidebar, push_sidebar_updates, sidebar_events, sidebar_page, user_channel_group
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+LOCAL_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'sidebar': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'sidebar-tests'},
+}
+
+
+def redis_available():
+    try:
+        return bool(get_redis() and get_redis().ping())
+    except redis.RedisError:
+        return False
+
+
+def seed_rooms(user, count):
+    """Give `user` `count` rooms, half group chats and half private chats, each with traffic."""
+    others = User.objects.bulk_create([
+        User(username=f'{user.username}-peer-{i}') for i in range(count // 2)
+    ])
+    Profile.objects.bulk_create([Profile(user=u) for u in others])
+    rooms = ChatGroup.objects.bulk_create(
+        [ChatGroup(groupchat_name=f'group {i}') for i in range(count - len(others))] +
+        [ChatGroup(is_private=True) for _ in others]
+    )
+    Membership = ChatGroup.members.through
+    memberships = [Membership(chatgroup_id=room.id, user_id=user.id) for room in rooms]
+    private_rooms = [room for room in rooms if room.is_private]
+    memberships += [Membership(chatgroup_id=room.id, user_id=other.id) for room, other in zip(private_rooms, others)]
+    Membership.objects.bulk_create(memberships)
+
+    author_for = dict(zip([room.id for room in private_rooms], others))
+    GroupMessages.objects.bulk_create([
+        GroupMessages(group=room, author=author_for.get(room.id, user), body='hello')
+        for room in rooms
+    ] + [
+        GroupMessages(group=room, author=user, body='hi back')
+        for room in private_rooms
+    ])
+    # bulk_create skips the membership signal, so build the inbox the way the backfill does
+    inbox.rebuild_inbox([room.id for room in rooms])
+    return rooms
+
+
+@override_settings(CHAT_REDIS_URL=None)
+class SidebarQueryCountTests(TestCase):
+
+    def test_query_count_is_constant(self):
+        counts = {}
+        for size in (10, 100, 1000):
+            user = User.objects.create(username=f'heavy-{size}')
+            seed_rooms(user, size)
+            with CaptureQueriesContext(connection) as ctx:
+                sidebar = build_sidebar(user)
+            self.assertEqual(len(sidebar), size)
+            counts[size] = len(ctx.captured_queries)
+        self.assertEqual(counts[10], 1)
+        self.assertEqual(counts[10], counts[100])
+        self.assertEqual(counts[10], counts[1000])
+
+
+@override_settings(CHAT_REDIS_URL=None)
+class SidebarPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='pager')
+        seed_rooms(self.user, 75)
+
+    def test_pages_walk_the_whole_sidebar(self):
+        walked, cursor, pages = [], None, 0
+        while True:
+            with self.assertNumQueries(1):
+                items, cursor = sidebar_page(self.user, cursor=cursor, limit=30)
+            walked += [item['group'].id for item in items]
+            pages += 1
+            if not cursor:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(walked, [item['group'].id for item in build_sidebar(self.user)])
+
+    def test_search_endpoint_filters_by_name(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/chat/sidebar/', {'q': 'group 12'})
+        self.assertContains(response, 'group 12')
+        self.assertNotContains(response, 'group 13')
+        self.assertNotContains(response, 'id="sidebar-more"')
+
+        response = self.client.get('/chat/sidebar/', {'q': 'pager-peer-7'})
+        self.assertContains(response, '@pager-peer-7')
+
+    def test_first_page_links_to_the_next(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/chat/sidebar/')
+        self.assertEqual(response.content.count(b'id="sidebar-room-'), 30)
+        self.assertContains(response, 'id="sidebar-more"')
+
+    def test_foreign_cursors_start_from_the_top(self):
+        self.client.force_login(self.user)
+        for cursor in ('100000000000000000000-1', '-100000000000000000000-1', 'abc', '1-2-3'):
+            response = self.client.get('/chat/sidebar/', {'cursor': cursor})
+            self.assertEqual(response.content.count(b'id="sidebar-room-'), 30)
+        # Room history decodes its cursors the same way
+        room = ChatInbox.objects.filter(user=self.user).first().group
+        response = self.client.get(f'/chat/room/{room.group_name}/history/', {'before': '100000000000000000000-1'})
+        self.assertEqual(response.status_code, 200)
+
+
+class SidebarContentTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+
+    def private_room(self, other):
+        room = ChatGroup.objects.create(is_private=True)
+        room.members.add(self.user, other)
+        return room
+
+    def send(self, room, author, body):
+        message = GroupMessages.objects.create(group=room, author=author, body=body)
+        inbox.record_message(message)
+        return message
+
+    def test_unread_and_request_flags(self):
+        room = self.private_room(self.bob)
+        self.send(room, self.bob, 'one')
+        self.send(room, self.bob, 'two')
+        self.send(room, self.user, 'mine')
+
+        item, = build_sidebar(self.user)
+        self.assertEqual(item['other'], self.bob)
+        self.assertEqual(item['unread'], 2)
+        self.assertTrue(item['is_request'])
+        self.assertEqual(item['preview'], 'mine')
+
+        ChatReadState.objects.create(user=self.user, group=room, last_read_at=timezone.now())
+        inbox.mark_read(self.user, room)
+        self.send(room, self.bob, 'three')
+
+        item, = build_sidebar(self.user)
+        self.assertEqual(item['unread'], 1)
+        self.assertFalse(item['is_request'])
+
+    def test_blocked_and_hidden_rooms_are_skipped(self):
+        blocked_room = self.private_room(self.bob)
+        hidden_room = self.private_room(self.carol)
+        self.send(blocked_room, self.bob, 'hey')
+        BlockedUser.objects.create(blocker=self.user, blocked=self.bob)
+        inbox.hide(self.user, hidden_room)
+
+        self.assertEqual(build_sidebar(self.user), [])
+
+        self.send(hidden_room, self.carol, 'back again')
+        item, = build_sidebar(self.user)
+        self.assertEqual(item['group'], hidden_room)
+
+    def test_ordered_by_latest_activity(self):
+        group = ChatGroup.objects.create(groupchat_name='team')
+        group.members.add(self.user, self.bob)
+        room = self.private_room(self.carol)
+        self.send(group, self.bob, 'first')
+        self.send(room, self.carol, 'second')
+        self.assertEqual([item['kind'] for item in build_sidebar(self.user)], ['private', 'group'])
+
+        self.send(group, self.user, 'third')
+        self.assertEqual([item['kind'] for item in build_sidebar(self.user)], ['group', 'private'])
+
+    def test_leaving_a_group_drops_its_row(self):
+        group = ChatGroup.objects.create(groupchat_name='team')
+        group.members.add(self.user, self.bob)
+        group.members.remove(self.user)
+        self.assertFalse(ChatInbox.objects.filter(user=self.user).exists())
+
+
+class PrivateRoomKeyTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_get_or_create_is_symmetric(self):
+        room, created = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(room.private_key, f'{self.alice.id}:{self.bob.id}')
+        self.assertEqual(set(room.members.all()), {self.alice, self.bob})
+
+        with self.assertNumQueries(1):
+            again, created = ChatGroup.get_or_create_private(self.bob, self.alice)
+        self.assertFalse(created)
+        self.assertEqual(again, room)
+
+    def test_start_chat_views_reuse_the_room(self):
+        self.client.force_login(self.alice)
+        first = self.client.get('/chat/bob/')
+        second = self.client.post('/chat/start/', {'q': 'bob'})
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 1)
+
+    def test_migration_merges_duplicate_rooms(self):
+        rooms = ChatGroup.objects.bulk_create([ChatGroup(is_private=True) for _ in range(3)])
+        for room in rooms:
+            room.members.add(self.alice, self.bob)
+        GroupMessages.objects.create(group=rooms[1], author=self.bob, body='in the copy')
+        GroupMessages.objects.create(group=rooms[2], author=self.alice, body='in another copy')
+        ChatReadState.objects.create(user=self.alice, group=rooms[2], last_read_at=timezone.now())
+
+        migration = import_module('a_rtchat.migrations.0024_merge_duplicate_private_rooms')
+        migration.merge_duplicate_private_rooms(apps, None)
+
+        room, = ChatGroup.objects.filter(is_private=True)
+        self.assertEqual(room, rooms[0])
+        self.assertEqual(room.private_key, f'{self.alice.id}:{self.bob.id}')
+        self.assertEqual(room.chat_messages.count(), 2)
+        self.assertEqual(ChatReadState.objects.get(user=self.alice).group, room)
+        row = ChatInbox.objects.get(user=self.bob, group=room)
+        self.assertEqual((row.unread_count, row.preview, row.is_request), (1, 'in another copy', True))
+
+
+class RebuildInboxTests(TestCase):
+
+    def test_rebuild_matches_incremental_rows(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        room = ChatGroup.objects.create(is_private=True)
+        room.members.add(alice, bob)
+        group = ChatGroup.objects.create(groupchat_name='team')
+        group.members.add(alice, bob)
+        for target, author, body in [(room, bob, 'a'), (room, alice, 'b'), (group, bob, 'c'), (room, bob, 'd')]:
+            inbox.record_message(GroupMessages.objects.create(group=target, author=author, body=body))
+
+        fields = ['user_id', 'group_id', 'peer_id', 'unread_count', 'last_inbound_at',
+                  'last_activity_at', 'last_message_id', 'preview', 'is_request', 'hidden']
+        incremental = list(ChatInbox.objects.order_by('user_id', 'group_id').values(*fields))
+        ChatInbox.objects.update(unread_count=42, preview='drift')
+
+        out = StringIO()
+        call_command('rebuild_inbox', batch_size=1, stdout=out)
+        self.assertIn('Rebuilt inbox for 2 rooms (4 rows)', out.getvalue())
+        self.assertEqual(list(ChatInbox.objects.order_by('user_id', 'group_id').values(*fields)), incremental)
+
+
+class PresenceTests(TestCase):
+
+    def test_entries_expire_without_heartbeat(self):
+        store = presence.LocalPresence()
+        store.touch([1], '7:crashed-worker')
+        store.touch([1], '8:alive')
+        store.rooms[1]['7:crashed-worker'] = 0
+        self.assertEqual(presence._users(store.entries([1])[1]), {8})
+
+    @override_settings(CHAT_REDIS_URL=None)
+    def test_one_socket_is_present_in_all_its_rooms(self):
+        self.assertEqual(presence.connect_rooms([11, 12], 5, 'tab-1'), {11, 12})
+        self.assertEqual(presence.connect_rooms([11, 12, 13], 5, 'tab-2'), {13})
+        self.assertEqual(presence.online_users_by_room([11, 12, 13]), {11: {5}, 12: {5}, 13: {5}})
+        self.assertEqual(presence.disconnect_rooms([11, 12], 5, 'tab-1'), set())
+        self.assertEqual(presence.disconnect_rooms([11, 12, 13], 5, 'tab-2'), {11, 12, 13})
+
+    @override_settings(CHAT_REDIS_URL=None)
+    def test_chat_view_reads_presence(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        room, _ = ChatGroup.get_or_create_private(alice, bob)
+        self.client.force_login(alice)
+        presence.connect(room.id, bob.id, 'tab-1')
+        self.assertTrue(self.client.get(f'/chat/room/{room.group_name}/').context['other_user_online'])
+        presence.disconnect(room.id, bob.id, 'tab-1')
+        self.assertFalse(self.client.get(f'/chat/room/{room.group_name}/').context['other_user_online'])
+
+
+class UnreadCounterTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(groupchat_name='team')
+        self.room.members.add(self.alice, self.bob)
+
+    def send(self, author):
+        inbox.record_message(GroupMessages.objects.create(group=self.room, author=author, body='hi'))
+
+    @override_settings(CHAT_REDIS_URL=None)
+    def test_database_fallback_without_redis(self):
+        self.send(self.alice)
+        self.assertIsNone(unread.unread_counts(self.bob.id))
+        item, = build_sidebar(self.bob)
+        self.assertEqual(item['unread'], 1)
+
+    @override_settings(CHAT_REDIS_URL='redis://localhost:1')
+    def test_unreachable_redis_falls_back(self):
+        self.send(self.alice)
+        inbox.mark_read(self.bob, self.room)
+        self.send(self.alice)
+        item, = build_sidebar(self.bob)
+        self.assertEqual(item['unread'], 1)
+
+    @skipUnless(redis_available(), 'needs a reachable CHAT_REDIS_URL')
+    def test_counters_follow_writes_and_reconcile_fixes_drift(self):
+        unread.forget([self.alice.id, self.bob.id])
+        self.send(self.alice)
+        self.assertEqual(unread.unread_counts(self.bob.id), {self.room.id: 1})
+        self.send(self.alice)
+        self.send(self.bob)
+        self.assertEqual(unread.unread_counts(self.bob.id), {self.room.id: 2})
+        self.assertEqual(unread.unread_counts(self.alice.id), {self.room.id: 1})
+
+        inbox.mark_read(self.bob, self.room)
+        self.assertEqual(unread.unread_counts(self.bob.id), {})
+
+        get_redis().hset(unread.counter_key(self.alice.id), self.room.id, 9)
+        out = StringIO()
+        call_command('reconcile_unread', stdout=out)
+        self.assertIn('corrected 1 drifted counters', out.getvalue())
+        self.assertEqual(unread.unread_counts(self.alice.id), {self.room.id: 1})
+        unread.forget([self.alice.id, self.bob.id])
+
+
+@override_settings(CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None, CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SidebarCacheTests(TestCase):
+
+    def setUp(self):
+        sidebar_cache.get_cache().clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.team = ChatGroup.objects.create(groupchat_name='team')
+        self.lounge = ChatGroup.objects.create(groupchat_name='lounge')
+        self.team.members.add(self.alice, self.bob)
+        self.lounge.members.add(self.alice, self.bob)
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def open(self, group):
+        return self.client.get(f'/chat/room/{group.group_name}/')
+
+    def test_moving_between_rooms_hits(self):
+        self.open(self.team)
+        self.open(self.lounge)
+        response = self.open(self.team)
+        self.assertEqual(sidebar_cache.stats(), (2, 1))
+        self.assertContains(response, f'li[id="sidebar-room-{self.team.group_name}"]')
+
+        out = StringIO()
+        call_command('sidebar_cache_stats', reset=True, stdout=out)
+        self.assertIn('2 hits, 1 misses, hit rate 66.7%', out.getvalue())
+        self.assertEqual(sidebar_cache.stats(), (0, 0))
+
+    def test_new_message_invalidates(self):
+        self.open(self.team)
+        inbox.record_message(GroupMessages.objects.create(group=self.lounge, author=self.bob, body='hi'))
+        response = self.open(self.team)
+        self.assertEqual(sidebar_cache.stats(), (0, 2))
+        self.assertContains(response, 'rounded-full bg-indigo-600 text-white text-xs font-semibold">1</span>')
+
+    def test_block_and_hide_invalidate(self):
+        row = f'id="sidebar-room-{self.room.group_name}"'
+        self.assertContains(self.open(self.team), row)
+        self.client.post('/profile/settings/block/bob/')
+        self.assertNotContains(self.open(self.team), row)
+        self.client.post('/profile/settings/unblock/bob/')
+        self.assertContains(self.open(self.team), row)
+        self.client.post(f'/chat/leave/{self.room.group_name}/')
+        self.assertNotContains(self.open(self.team), row)
+        self.assertEqual(sidebar_cache.stats(), (0, 4))
+
+
+@override_settings(CHAT_REDIS_URL=None, CACHES=LOCAL_CACHES, CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        messages = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob if i % 2 else self.alice, body=f'm {i}') for i in range(75)
+        ])
+        self.ids = [m.id for m in messages]
+        # Several messages sharing a timestamp straddle a page boundary
+        GroupMessages.objects.filter(id__in=self.ids[40:50]).update(created=messages[40].created)
+
+    def test_pages_walk_the_whole_room_once(self):
+        pages, cursor, counts = [], None, []
+        while True:
+            # The page, then the ticks: one query per author
+            with CaptureQueriesContext(connection) as queries:
+                page, cursor = history.page_before(self.room.id, cursor)
+            pages.append([m.id for m in page])
+            counts.append(len(queries))
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [30, 30, 15])
+        # Running out of hot rows costs one more, for the archive
+        self.assertEqual(counts, [3, 3, 4])
+        # Each page is oldest first, and prepending them rebuilds the room
+        self.assertEqual(sum(reversed(pages), []), self.ids)
+
+    def test_history_endpoint_prepends_the_page_before(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(f'/chat/room/{self.room.group_name}/')
+        cursor = response.context['history_next_cursor']
+        self.assertEqual([m.id for m in response.context['chat_messages']], self.ids[45:])
+
+        response = self.client.get(f'/chat/room/{self.room.group_name}/history/', {'before': cursor})
+        html = response.content.decode()
+        self.assertIn('hx-swap-oob="afterbegin"', html)
+        self.assertLess(html.index(f'id="message-{self.ids[15]}"'), html.index(f'id="message-{self.ids[44]}"'))
+        self.assertNotIn(f'id="message-{self.ids[45]}"', html)
+        self.assertIn(f'before={response.context["history_next_cursor"]}', html)
+
+        # Private rooms are members only
+        self.client.force_login(User.objects.create(username='eve'))
+        response = self.client.get(f'/chat/room/{self.room.group_name}/history/', {'before': cursor})
+        self.assertEqual(response.status_code, 404)
+
+
+class ReceiptTests(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob, self.carol = User.objects.bulk_create(
+            [User(username=name) for name in ('alice', 'bob', 'carol')]
+        )
+        self.room = ChatGroup.objects.create(groupchat_name='receipts')
+        self.room.members.add(self.alice, self.bob, self.carol)
+        self.messages = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=author, body=str(i))
+            for i, author in enumerate([self.alice, self.bob] * 5)
+        ])
+
+    def ticks(self):
+        messages = list(GroupMessages.objects.filter(group=self.room))
+        return [m.tick for m in receipts.annotate_ticks(messages)]
+
+    def test_ticks_follow_the_slowest_other_member(self):
+        receipts.mark_read(self.room.id, self.bob.id)
+        # carol has not received anything yet
+        self.assertEqual(self.ticks(), [0] * 10)
+        receipts.mark_delivered(self.room.id, [self.carol.id], up_to_id=self.messages[5].id)
+        # bob's own messages wait for alice
+        self.assertEqual(self.ticks(), [1, 0, 1, 0, 1, 0, 0, 0, 0, 0])
+        receipts.mark_read(self.room.id, self.carol.id, up_to_id=self.messages[3].id)
+        receipts.mark_read(self.room.id, self.alice.id)
+        self.assertEqual(self.ticks(), [2] * 4 + [1] * 2 + [0] * 4)
+
+    def test_watermarks_only_move_forward(self):
+        top = self.messages[-1].id
+        self.assertIsNotNone(receipts.mark_read(self.room.id, self.bob.id))
+        self.assertIsNone(receipts.mark_delivered(self.room.id, [self.bob.id], up_to_id=top - 3))
+        self.assertIsNone(receipts.mark_read(self.room.id, self.bob.id))
+        state = ChatReadState.objects.get(user=self.bob)
+        self.assertEqual((state.last_delivered_id, state.last_read_id), (top, top))
+
+    def test_each_viewer_sees_the_other_members_watermarks(self):
+        for user in (self.alice, self.bob):
+            receipts.mark_read(self.room.id, user.id)
+        event = receipts.mark_delivered(self.room.id, [self.carol.id], up_to_id=self.messages[4].id)
+        top, mid = self.messages[-1].id, self.messages[4].id
+        self.assertIn(f'data-delivered="{mid}" data-read="0"', receipts.viewer_status_html(event, self.alice.id))
+        self.assertIn(f'data-delivered="{top}" data-read="{top}"', receipts.viewer_status_html(event, self.carol.id))
+
+    def test_connecting_costs_the_same_for_any_number_of_rooms(self):
+        rooms = [self.room] + [ChatGroup.objects.create() for _ in range(4)]
+        for room in rooms[1:]:
+            room.members.add(self.carol)
+            GroupMessages.objects.create(group=room, author=self.alice, body='hi')
+        empty = ChatGroup.objects.create()
+        empty.members.add(self.carol)
+        group_ids = [room.id for room in rooms + [empty]]
+        # No ChatInbox row knows their newest message
+        self.assertFalse(ChatInbox.objects.filter(user=self.carol, last_message__isnull=False).exists())
+
+        self.assertEqual(len(receipts.mark_delivered_rooms(group_ids, self.carol.id)), 5)
+        self.assertEqual(
+            dict(ChatReadState.objects.filter(user=self.carol).values_list('group_id', 'last_delivered_id')),
+            {room.id: room.chat_messages.latest('id').id for room in rooms},
+        )
+        with self.assertNumQueries(3):
+            self.assertEqual(receipts.mark_delivered_rooms(group_ids, self.carol.id), [])
+
+    def test_annotating_a_page_is_one_query_per_author(self):
+        messages = list(GroupMessages.objects.filter(group=self.room))
+        with self.assertNumQueries(2):
+            receipts.annotate_ticks(messages)
+            [m.tick for m in messages]
+
+
+@override_settings(CHAT_REDIS_URL=None, CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_SEND_RATE=0.001, CHAT_SEND_BURST=3)
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        ratelimit._local.buckets.clear()
+        ratelimit.reset_stats()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_bucket_allows_a_burst_then_limits(self):
+        self.assertEqual([ratelimit.allow(self.alice.id) for _ in range(4)], [True, True, True, False])
+        # Buckets are per user
+        self.assertTrue(ratelimit.allow(self.bob.id))
+        self.assertEqual(ratelimit.stats(), {'allowed': 4, 'limited': 1, 'overflows': 0})
+
+    def test_bucket_refills(self):
+        now = time.time()
+        with mock.patch('a_rtchat.ratelimit.time.time', return_value=now):
+            self.assertEqual([ratelimit.allow(self.alice.id) for _ in range(4)], [True, True, True, False])
+        # One token per 1000 seconds at this rate
+        with mock.patch('a_rtchat.ratelimit.time.time', return_value=now + 1000):
+            self.assertEqual([ratelimit.allow(self.alice.id) for _ in range(2)], [True, False])
+
+    def test_htmx_send_is_limited(self):
+        room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        url = f'/chat/room/{room.group_name}/'
+        codes = [self.client.post(url, {'body': f'm {i}'}, HTTP_HX_REQUEST='true').status_code for i in range(4)]
+        self.assertEqual(codes, [200, 200, 200, 429])
+        self.assertEqual(GroupMessages.objects.count(), 3)
+
+    def test_stats_command(self):
+        ratelimit.allow(self.alice.id)
+        out = StringIO()
+        call_command('chat_limiter_stats', '--reset', stdout=out)
+        self.assertIn('1 allowed, 0 limited', out.getvalue())
+        self.assertEqual(ratelimit.stats()['allowed'], 0)
+
+
+@override_settings(CHAT_REDIS_URL=None, CHAT_NONCE_WINDOW=60)
+class NonceTests(TestCase):
+
+    def setUp(self):
+        nonces._local.claims.clear()
+
+    def test_nonce_is_claimed_once_per_window(self):
+        now = time.time()
+        with mock.patch('a_rtchat.nonces.time.time', return_value=now):
+            self.assertIsNone(nonces.claim(1, 'n-1'))
+            # In flight, then stored
+            self.assertEqual(nonces.claim(1, 'n-1'), 0)
+            nonces.record(1, 'n-1', 42)
+            self.assertEqual(nonces.claim(1, 'n-1'), 42)
+            # Nonces are per user
+            self.assertIsNone(nonces.claim(2, 'n-1'))
+        with mock.patch('a_rtchat.nonces.time.time', return_value=now + 61):
+            self.assertIsNone(nonces.claim(1, 'n-1'))
+
+    def test_released_nonce_can_be_retried(self):
+        self.assertIsNone(nonces.claim(1, 'n-2'))
+        nonces.release(1, 'n-2')
+        self.assertIsNone(nonces.claim(1, 'n-2'))
+
+
+@override_settings(CHAT_REDIS_URL=None, CHAT_TYPING_INTERVAL=3.0)
+class TypistTests(TestCase):
+
+    def setUp(self):
+        typists._local.until.clear()
+        typists._local.rooms.clear()
+
+    def test_one_event_per_room_per_interval(self):
+        now = time.time()
+        with mock.patch('a_rtchat.typists.time.time', return_value=now), self.assertNumQueries(0):
+            event = typists.typing(1, 'room', 10, 'alice')
+            # However many typists and keystrokes, the rest of the interval sends nothing
+            self.assertEqual([typists.typing(1, 'room', uid, f'user {uid}') for uid in range(11, 1011)], [None] * 1000)
+            self.assertIsNone(typists.typing(1, 'room', 10, 'alice'))
+            # Rooms are throttled separately
+            self.assertIsNotNone(typists.typing(2, 'other', 11, 'bob'))
+        self.assertEqual(event['typists'], [10])
+        self.assertIn('alice is typing', event['html']['all'])
+        with mock.patch('a_rtchat.typists.time.time', return_value=now + 3):
+            event = typists.typing(1, 'room', 10, 'alice')
+        self.assertEqual(len(event['typists']), 1001)
+        self.assertIn('user 11, user 12, user 13 and 998 others are typing', event['html']['all'])
+        # Typists stop being listed after two intervals without a report
+        with mock.patch('a_rtchat.typists.time.time', return_value=now + 9):
+            self.assertEqual(typists.typing(1, 'room', 12, 'user 12')['typists'], [12])
+
+    def test_viewers_never_see_themselves(self):
+        event = typists.typing_event('room', [(1, 'alice'), (2, 'bob'), (3, 'carol'), (4, 'dave')])
+        seen = {uid: event['html'][typists.viewer_key(event, uid)] for uid in (1, 4, 5)}
+        self.assertIn('bob, carol and 1 other are typing', seen[1])
+        self.assertIn('alice, bob and carol are typing', seen[4])
+        self.assertIn('alice, bob, carol and 1 other are typing', seen[5])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class LiveSidebarTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(is_private=True)
+        self.room.members.add(self.alice, self.bob)
+
+    def listen(self, user):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(user_channel_group(user.id), channel)
+        return lambda: async_to_sync(layer.receive)(channel)
+
+    def test_new_message_pushes_changed_row_only(self):
+        receive = self.listen(self.bob)
+        message = GroupMessages.objects.create(group=self.room, author=self.alice, body='hi')
+        inbox.record_message(message)
+        push_sidebar_updates(self.room)
+
+        event = receive()
+        self.assertEqual(event['type'], 'sidebar_item_handler')
+        self.assertTrue(event['move_to_top'])
+        self.assertEqual(event['item']['unread'], 1)
+        self.assertTrue(event['item']['is_request'])
+        self.assertEqual(event['item']['other']['username'], 'alice')
+
+        consumer = ChatConsumer()
+        sent = []
+
+        async def send(text_data, key=None):
+            sent.append(text_data)
+        consumer.send = send
+        with self.assertNumQueries(0):
+            async_to_sync(consumer.sidebar_item_handler)(event)
+        html, = sent
+        self.assertIn(f'id="sidebar-room-{self.room.group_name}" hx-swap-oob="delete"', html)
+        self.assertIn('<ul id="chat-list" hx-swap-oob="afterbegin">', html)
+        self.assertIn('Request', html)
+
+    def test_large_group_renders_each_distinct_row_once(self):
+        team = ChatGroup.objects.create(groupchat_name='team')
+        members = User.objects.bulk_create([User(username=f'member-{i}') for i in range(40)])
+        team.members.add(self.alice, *members)
+        inbox.record_message(GroupMessages.objects.create(group=team, author=members[0], body='first'))
+        ChatInbox.objects.filter(group=team, user__in=members[:31]).update(unread_count=0)
+        inbox.record_message(GroupMessages.objects.create(group=team, author=self.alice, body='second'))
+
+        with mock.patch('a_rtchat.sidebar.render_to_string', wraps=render_to_string) as render:
+            events = sidebar_events(team)
+        self.assertEqual(len(events), 41)
+        # Nine members have two unread messages, everyone else one: two rows to render
+        badges = sorted(event['item']['unread'] for _, event in events)
+        self.assertEqual(badges, [1] * 32 + [2] * 9)
+        self.assertEqual(render.call_count, 2)
+        for target, event in events:
+            unread = event['item']['unread']
+            self.assertEqual(f'>{unread}</span>' in event['html'], bool(unread))
+            self.assertEqual(json.loads(event['wire']['json'])['item']['unread'], unread)
+
+    def test_blocked_peer_is_not_pushed(self):
+        receive = self.listen(self.bob)
+        BlockedUser.objects.create(blocker=self.bob, blocked=self.alice)
+        inbox.record_message(GroupMessages.objects.create(group=self.room, author=self.alice, body='hi'))
+        push_sidebar_updates(self.room, [self.bob.id])
+
+        layer = get_channel_layer()
+        self.assertEqual(sum(len(q) for q in layer.channels.values()), 0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None)
+class ChatConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+
+    async def connect(self, user, room_name=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chatroom/{room_name or self.room.group_name}'
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def drain(self, communicator):
+        """Everything the socket has been sent so far, as one string of fragments."""
+        frames = []
+        while not await communicator.receive_nothing():
+            frames.append(await communicator.receive_from())
+        return '\n'.join(frames)
+
+    async def drain_msgpack(self, communicator):
+        """Every event a msgpack socket has been sent so far."""
+        events = []
+        while not await communicator.receive_nothing():
+            events.extend(msgpack.Unpacker(io.BytesIO((await communicator.receive_output())['bytes'])))
+        return events
+
+    def test_message_round_trip(self):
+        async def scenario():
+            alice, connected = await self.connect(self.alice)
+            self.assertTrue(connected)
+            self.assertIn('online', await alice.receive_from())
+
+            bob, _ = await self.connect(self.bob)
+            self.assertIn('online', await alice.receive_from())
+            await bob.receive_from()
+
+            await alice.send_json_to({'body': 'hello bob'})
+            await alice.receive_nothing()
+            theirs = await self.drain(bob)
+            self.assertIn('hello bob', theirs)
+            self.assertNotIn('data-own="1"', theirs)
+            self.assertIn('sidebar-room-', theirs)
+            self.assertIn('data-own="1"', await self.drain(alice))
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        message = GroupMessages.objects.get()
+        self.assertEqual(ChatReadState.objects.get(user=self.bob).last_delivered_id, message.id)
+        self.assertEqual(message.tick, GroupMessages.STATUS_DELIVERED)
+        self.assertEqual(ChatInbox.objects.get(user=self.bob).unread_count, 1)
+        self.assertEqual(presence.online_user_ids(self.room.id), set())
+
+    def test_second_tab_keeps_user_online(self):
+        async def scenario():
+            bob, _ = await self.connect(self.bob)
+            await bob.receive_from()
+            first, _ = await self.connect(self.alice)
+            self.assertIn('1', await bob.receive_from())
+            second, _ = await self.connect(self.alice)
+            self.assertIn('online-count', await second.receive_from())
+
+            await first.disconnect()
+            self.assertTrue(await bob.receive_nothing())
+            self.assertTrue(presence.is_online(self.room.id, self.alice.id))
+            await second.disconnect()
+            self.assertIn('0', await bob.receive_from())
+            self.assertFalse(presence.is_online(self.room.id, self.alice.id))
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_reconnect_sends_one_status_frame(self):
+        ids = [m.id for m in GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob, body=f'm {i}') for i in range(150)
+        ])]
+        ChatReadState.objects.create(user=self.alice, group=self.room, last_read_id=ids[99], last_delivered_id=ids[99])
+        ChatReadState.objects.create(user=self.bob, group=self.room, last_read_id=ids[-1], last_delivered_id=ids[-1])
+
+        async def scenario():
+            bob, _ = await self.connect(self.bob)
+            await bob.receive_from()
+            alice, _ = await self.connect(self.alice)
+            frames = await self.drain(bob)
+            self.assertEqual(frames.count('id="message-status"'), 1)
+            self.assertIn(f'data-delivered="{ids[-1]}" data-read="{ids[99]}"', frames)
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        state = ChatReadState.objects.get(user=self.alice)
+        self.assertEqual((state.last_delivered_id, state.last_read_id), (ids[-1], ids[99]))
+
+    def test_opening_the_chat_sends_one_read_event(self):
+        last = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob, body=f'm {i}') for i in range(30)
+        ])[-1]
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(self.room.group_name, channel)
+
+        self.client.force_login(self.alice)
+        self.client.get(f'/chat/room/{self.room.group_name}/')
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event['type'], 'message_status_handler')
+        self.assertIn(f'data-read="{last.id}"', receipts.viewer_status_html(event, self.bob.id))
+        self.assertEqual(ChatReadState.objects.get(user=self.alice).last_read_id, last.id)
+        self.assertEqual(sum(len(q) for q in layer.channels.values()), 0)
+
+    def test_handlers_render_nothing_and_query_nothing(self):
+        message = GroupMessages.objects.create(group=self.room, author=self.alice, body='once')
+        event = fanout.message_event(message)
+        consumer = ChatConsumer()
+        consumer.active = self.room.group_name
+        sent = []
+
+        async def send(text_data, key=None):
+            sent.append(text_data)
+        consumer.send = send
+        with self.assertNumQueries(0):
+            for user in (self.alice, self.bob):
+                consumer.user = user
+                async_to_sync(consumer.message_handler)(event)
+            # Events of a room this socket doesn't show are not forwarded
+            consumer.active = 'another-room'
+            async_to_sync(consumer.message_handler)(event)
+        own, theirs = sent
+        self.assertIn('data-own="1"', own)
+        self.assertIn('@alice', theirs)
+
+    def test_structured_events_are_encoded_once_per_format(self):
+        message = GroupMessages.objects.create(group=self.room, author=self.alice, body='once')
+        event = fanout.message_event(message)
+        sent = []
+
+        async def send(text_data=None, bytes_data=None, key=None):
+            sent.append(text_data if bytes_data is None else bytes_data)
+        with mock.patch.object(protocol, 'encode', side_effect=AssertionError('encoded per socket')):
+            for fmt, user in (('msgpack', self.alice), ('msgpack', self.bob), ('json', self.bob)):
+                consumer = ChatConsumer()
+                consumer.active, consumer.format, consumer.user = self.room.group_name, fmt, user
+                consumer.send = send
+                async_to_sync(consumer.message_handler)(event)
+        mine, theirs, as_json = sent
+        self.assertIs(mine, theirs)
+        self.assertEqual(msgpack.unpackb(mine), json.loads(as_json))
+        self.assertEqual(json.loads(as_json)['body'], 'once')
+
+    def test_retransmitted_send_is_stored_once(self):
+        nonces._local.claims.clear()
+
+        async def scenario():
+            alice = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/chatroom/{self.room.group_name}', subprotocols=['cnnct.json']
+            )
+            alice.scope['user'] = self.alice
+            await alice.connect()
+            await self.drain(alice)
+            for _ in range(2):
+                await alice.send_to(text_data=json.dumps({'body': 'once', 'nonce': 'retry-1'}))
+            events = [json.loads(line) for line in (await self.drain(alice)).splitlines()]
+            message = await sync_to_async(GroupMessages.objects.get)()
+            sent = next(event for event in events if event['t'] == 'message')
+            self.assertEqual((sent['id'], sent['nonce']), (message.id, 'retry-1'))
+            ack = next(event for event in events if event['t'] == 'ack')
+            self.assertEqual((ack['id'], ack['nonce']), (message.id, 'retry-1'))
+
+            # Browsers get no ack; the retransmit is just not stored
+            browser, _ = await self.connect(self.alice)
+            await self.drain(browser)
+            for _ in range(2):
+                await browser.send_json_to({'body': 'from the page', 'nonce': 'retry-2'})
+            self.assertEqual((await self.drain(browser)).count('from the page'), 1)
+            await alice.disconnect()
+            await browser.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(GroupMessages.objects.count(), 2)
+
+    def test_resume_sends_what_was_missed_in_one_frame(self):
+        edited, seen = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob, body=f'before {i}') for i in range(2)
+        ])
+        # While alice was away: an edit, a delete and two new messages
+        self.client.force_login(self.bob)
+        self.client.post(f'/chat/message/{edited.id}/edit/', {'body': 'edited while away'})
+        self.client.post(f'/chat/message/{seen.id}/delete/')
+        new = [GroupMessages.objects.create(group=self.room, author=self.bob, body=f'missed {i}') for i in range(2)]
+
+        async def scenario():
+            alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/', subprotocols=['cnnct.msgpack'])
+            alice.scope['user'] = self.alice
+            await alice.connect()
+            await alice.send_to(bytes_data=msgpack.packb({'type': 'open', 'room': self.room.group_name, 'after': seen.id}))
+            resume = next(event for event in await self.drain_msgpack(alice) if event['t'] == 'resume')
+            self.assertEqual([m['id'] for m in resume['messages']], [m.id for m in new])
+            self.assertEqual({m['id']: m['body'] for m in resume['updates']}, {edited.id: 'edited while away', seen.id: None})
+            self.assertFalse(resume['more'])
+
+            # Browsers get the same as OOB fragments
+            browser = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+            browser.scope['user'] = self.alice
+            await browser.connect()
+            await browser.send_json_to({'type': 'open', 'room': self.room.group_name, 'after': new[0].id})
+            html = await self.drain(browser)
+            self.assertIn(f'id="message-{new[1].id}"', html)
+            self.assertNotIn(f'id="message-{new[0].id}"', html)
+            # The edit came before the message it last saw, so it has it already
+            self.assertNotIn('edited while away', html)
+            await alice.disconnect()
+            await browser.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_bad_resume_point_opens_the_room_anyway(self):
+        team = ChatGroup.objects.create(groupchat_name='team', admin=self.bob)
+        team.members.add(self.alice, self.bob)
+
+        async def scenario():
+            alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+            alice.scope['user'] = self.alice
+            await alice.connect()
+            for after in ('latest', ['1'], {'id': 1}):
+                await alice.send_json_to({'type': 'open', 'room': self.room.group_name, 'after': after})
+                self.assertNotIn('resume', await self.drain(alice))
+            # The socket is still up and follows the rooms opened on it
+            await alice.send_json_to({'type': 'open', 'room': team.group_name, 'after': 'x'})
+            await self.drain(alice)
+            await alice.send_json_to({'room': team.group_name, 'body': 'still here'})
+            self.assertIn('still here', await self.drain(alice))
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_RESUME_LIMIT=2)
+    def test_long_gap_resumes_in_pages(self):
+        ids = [m.id for m in GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob, body=f'missed {i}') for i in range(3)
+        ])]
+
+        async def scenario():
+            alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/', subprotocols=['cnnct.json'])
+            alice.scope['user'] = self.alice
+            await alice.connect()
+            await alice.send_to(text_data=json.dumps({'type': 'open', 'room': self.room.group_name, 'after': 0}))
+            events = [json.loads(line) for line in (await self.drain(alice)).splitlines()]
+            resume = next(event for event in events if event['t'] == 'resume')
+            self.assertEqual(([m['id'] for m in resume['messages']], resume['more']), (ids[:2], True))
+
+            # Live messages wait for the client to catch up
+            bob, _ = await self.connect(self.bob)
+            await bob.send_json_to({'body': 'live'})
+            events = [json.loads(line) for line in (await self.drain(alice)).splitlines()]
+            self.assertNotIn('message', {event['t'] for event in events})
+            live = await sync_to_async(GroupMessages.objects.latest)('id')
+
+            await alice.send_to(text_data=json.dumps({'type': 'open', 'room': self.room.group_name, 'after': ids[1]}))
+            events = [json.loads(line) for line in (await self.drain(alice)).splitlines()]
+            resume = next(event for event in events if event['t'] == 'resume')
+            self.assertEqual(([m['id'] for m in resume['messages']], resume['more']), ([ids[2], live.id], False))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_purge_reaches_the_open_room_as_one_range(self):
+        GroupMessages.objects.bulk_create([GroupMessages(group=self.room, author=self.bob, body=f'old {i}') for i in range(5)])
+        GroupMessages.objects.update(created=timezone.now() - timedelta(days=10))
+        ids = list(GroupMessages.objects.order_by('id').values_list('id', flat=True))
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            msgpack_alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/', subprotocols=['cnnct.msgpack'])
+            msgpack_alice.scope['user'] = self.alice
+            await msgpack_alice.connect()
+            await msgpack_alice.send_to(bytes_data=msgpack.packb({'type': 'open', 'room': self.room.group_name}))
+            await self.drain(alice)
+            await self.drain_msgpack(msgpack_alice)
+
+            before = timezone.now() - timedelta(days=7)
+            self.assertEqual(await sync_to_async(retention.purge_batch)(self.room, before, 3), 3)
+            html = await self.drain(alice)
+            self.assertEqual(html.count('id="message-purge"'), 1)
+            self.assertIn(f'data-from="{ids[0]}" data-to="{ids[2]}"', html)
+            events = await self.drain_msgpack(msgpack_alice)
+            self.assertEqual(events, [{'t': 'purge', 'room': self.room.group_name, 'from': ids[0], 'to': ids[2], 'count': 3}])
+            await alice.disconnect()
+            await msgpack_alice.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_TYPING_INTERVAL=60)
+    def test_typing_is_throttled_per_user_and_room(self):
+        typists._local.until.clear()
+        typists._local.rooms.clear()
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            bob, _ = await self.connect(self.bob)
+            await self.drain(alice)
+            await self.drain(bob)
+            for _ in range(5):
+                await bob.send_json_to({'type': 'typing'})
+            frames = await self.drain(alice)
+            self.assertEqual(frames.count('id="typing-indicator"'), 1)
+            self.assertIn('bob is typing', frames)
+            # Nobody is told about their own typing
+            self.assertTrue(await bob.receive_nothing())
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_subprotocol_selects_the_wire_format(self):
+        async def scenario():
+            alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/', subprotocols=['cnnct.msgpack'])
+            alice.scope['user'] = self.alice
+            connected, subprotocol = await alice.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, 'cnnct.msgpack')
+            await alice.send_to(bytes_data=msgpack.packb({'type': 'open', 'room': self.room.group_name}))
+            events = await self.drain_msgpack(alice)
+            self.assertEqual(events, [{'t': 'online', 'room': self.room.group_name, 'count': 0}])
+
+            bob = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/chatroom/{self.room.group_name}', subprotocols=['v2', 'cnnct.json']
+            )
+            bob.scope['user'] = self.bob
+            connected, subprotocol = await bob.connect()
+            self.assertEqual(subprotocol, 'cnnct.json')
+            await self.drain(bob)
+            await bob.send_to(text_data=json.dumps({'body': 'from the app'}))
+            await alice.receive_nothing()
+            events = await self.drain_msgpack(alice)
+            new = next(event for event in events if event['t'] == 'message')
+            self.assertEqual((new['body'], new['author']['username'], new['status']), ('from the app', 'bob', 0))
+            self.assertIn('sidebar', {event['t'] for event in events})
+            # One JSON event per line
+            lines = (await self.drain(bob)).splitlines()
+            self.assertIn('message', {json.loads(line)['t'] for line in lines})
+
+            message = await sync_to_async(GroupMessages.objects.get)()
+            await sync_to_async(self.client.force_login)(self.bob)
+            await sync_to_async(self.client.post)(f'/chat/message/{message.id}/delete/')
+            await alice.receive_nothing()
+            events = await self.drain_msgpack(alice)
+            deleted = next(event for event in events if event['t'] == 'message_update')
+            self.assertEqual((deleted['id'], deleted['deleted'], deleted['body']), (message.id, True, None))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_blocked_author_is_dropped(self):
+        BlockedUser.objects.create(blocker=self.bob, blocked=self.alice)
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            await alice.receive_from()
+            await alice.send_json_to({'body': 'hello?'})
+            self.assertTrue(await alice.receive_nothing())
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertFalse(GroupMessages.objects.exists())
+
+    def test_block_changes_reach_connected_sockets(self):
+        self.client.force_login(self.bob)
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            await alice.receive_from()
+            await sync_to_async(self.client.get)(f'/profile/settings/block/{self.alice.username}/')
+            await alice.send_json_to({'body': 'hello?'})
+            self.assertTrue(await alice.receive_nothing())
+            self.assertFalse(await sync_to_async(GroupMessages.objects.exists)())
+
+            await sync_to_async(self.client.get)(f'/profile/settings/unblock/{self.alice.username}/')
+            await alice.send_json_to({'body': 'hello again'})
+            self.assertIn('hello again', await alice.receive_from())
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(GroupMessages.objects.get().body, 'hello again')
+
+    @override_settings(CHAT_SEND_BURST=2, CHAT_SEND_RATE=0.001)
+    def test_flooding_socket_is_limited(self):
+        ratelimit._local.buckets.clear()
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            await alice.receive_from()
+            for i in range(5):
+                await alice.send_json_to({'body': f'flood {i}'})
+            await alice.receive_nothing()
+            self.assertEqual((await self.drain(alice)).count('id="chat_messages"'), 2)
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(GroupMessages.objects.count(), 2)
+
+    def test_client_that_falls_behind_is_closed(self):
+        ratelimit.reset_stats()
+        consumer = ChatConsumer()
+        closed = []
+
+        async def close(code=None):
+            closed.append(code)
+        consumer.close = close
+
+        async def scenario():
+            consumer.outbox = asyncio.Queue(maxsize=2)
+            # A writer stuck on a client that is not reading
+            consumer.writer = asyncio.create_task(asyncio.sleep(60))
+            for i in range(3):
+                await consumer.send(text_data=f'frame {i}')
+            self.assertTrue(consumer.writer.cancelled() or consumer.writer.cancelling())
+
+        async_to_sync(scenario)()
+        self.assertEqual(closed, [ChatConsumer.CLOSE_TOO_SLOW])
+        self.assertEqual(ratelimit.stats()['overflows'], 1)
+
+    @override_settings(CHAT_COALESCE_WINDOW_MS=50)
+    def test_bursts_are_coalesced_into_one_frame(self):
+        messages = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.alice, body=f'm {i}') for i in range(20)
+        ])
+        events = fanout.update_events([m.id for m in messages])
+        status = receipts.mark_read(self.room.id, self.bob.id)
+
+        async def scenario():
+            bob, _ = await self.connect(self.bob)
+            await self.drain(bob)
+            layer = get_channel_layer()
+            for group, event in events + [(self.room.group_name, status)] * 3:
+                await layer.group_send(group, event)
+            frame = await bob.receive_from()
+            self.assertTrue(await bob.receive_nothing())
+            self.assertEqual(frame.count('id="message-'), 20 + 1)
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_merge_frames_keeps_the_last_of_each_key(self):
+        merged = fanout.merge_frames([
+            (None, '<a/>', None), ('count', '<b>1</b>', None), (None, '<c/>', None),
+            ('count', '<b>2</b>', None), (None, None, b'raw'), ('count', '<b>3</b>', None),
+        ])
+        self.assertEqual(merged, [('<a/>\n<c/>\n<b>2</b>', None), (None, b'raw'), ('<b>3</b>', None)])
+
+    def test_one_socket_follows_every_room(self):
+        team = ChatGroup.objects.create(groupchat_name='team', admin=self.bob)
+        team.members.add(self.alice, self.bob)
+        pending = GroupMessages.objects.create(group=team, author=self.bob, body='while you were away')
+
+        async def scenario():
+            alice = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+            alice.scope['user'] = self.alice
+            connected, _ = await alice.connect()
+            self.assertTrue(connected)
+            await alice.send_json_to({'type': 'open', 'room': self.room.group_name})
+            self.assertIn('online-count', await self.drain(alice))
+            # Connecting anywhere delivers every room's backlog
+            state = await sync_to_async(ChatReadState.objects.get)(user=self.alice, group=team)
+            self.assertEqual(state.last_delivered_id, pending.id)
+
+            bob, _ = await self.connect(self.bob, team.group_name)
+            await self.drain(bob)
+            await bob.send_json_to({'body': 'in the team room'})
+            frames = await self.drain(alice)
+            # Only the sidebar row of a room the page doesn't show
+            self.assertIn(f'sidebar-room-{team.group_name}', frames)
+            self.assertNotIn('in the team room', frames)
+
+            # Switching rooms is a frame on the same socket
+            await alice.send_json_to({'type': 'open', 'room': team.group_name})
+            await alice.send_json_to({'body': 'hello team'})
+            self.assertIn('hello team', await self.drain(alice))
+            self.assertIn('hello team', await self.drain(bob))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_rooms_joined_while_connected_are_followed(self):
+        team = ChatGroup.objects.create(groupchat_name='team', admin=self.bob)
+        team.members.add(self.bob)
+
+        async def scenario():
+            alice, _ = await self.connect(self.alice)
+            await self.drain(alice)
+            await sync_to_async(team.members.add)(self.alice)
+            await alice.receive_nothing()
+            self.assertTrue(presence.is_online(team.id, self.alice.id))
+            await sync_to_async(team.members.remove)(self.alice)
+            await alice.receive_nothing()
+            self.assertFalse(presence.is_online(team.id, self.alice.id))
+            await alice.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_private_rooms_of_others_cannot_be_opened(self):
+        carol = User.objects.create(username='carol')
+
+        async def scenario():
+            communicator, connected = await self.connect(carol)
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+    def test_unknown_room_is_rejected(self):
+        async def scenario():
+            communicator, connected = await self.connect(self.alice, 'no-such-room')
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+
+def daphne_application():
+    from channels.routing import get_default_application
+    return get_default_application()
+
+
+class RawWebSocket:
+    """Just enough of a websocket client to talk to a real server, and to stop reading on purpose."""
+
+    def __init__(self, port, path, cookie):
+        self.sock = socket.create_connection(('localhost', port), timeout=10)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            f'GET {path} HTTP/1.1\r\nHost: localhost:{port}\r\nOrigin: http://localhost\r\n'
+            f'Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nCookie: {cookie}\r\n\r\n'
+        ).encode())
+        self.buffer = b''
+        while b'\r\n\r\n' not in self.buffer:
+            self.buffer += self.read_some()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        self.status = int(head.split()[1])
+
+    def read_some(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError('the server went away without a close frame')
+        return chunk
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.buffer += self.read_some()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send_json(self, data):
+        payload = json.dumps(data).encode()
+        header = bytes([0x81, 0x80 | len(payload)]) if len(payload) < 126 else bytes([0x81, 0xFE]) + struct.pack('!H', len(payload))
+        mask = os.urandom(4)
+        self.sock.sendall(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    def receive(self):
+        """(opcode, payload) of the next frame."""
+        first, second = self.read(2)
+        size = second & 0x7F
+        if size == 126:
+            size, = struct.unpack('!H', self.read(2))
+        elif size == 127:
+            size, = struct.unpack('!Q', self.read(8))
+        return first & 0x0F, self.read(size)
+
+    def close_code(self):
+        """Read on to the server's close frame and return its status code."""
+        while True:
+            opcode, payload = self.receive()
+            if opcode == 0x8:
+                return struct.unpack('!H', payload[:2])[0]
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None,
+    CHAT_SEND_BURST=1000, CHAT_OUTBOX_FRAMES=8, CHAT_COALESCE_WINDOW_MS=0,
+)
+class DaphneFlowControlTests(TransactionTestCase):
+    """The socket bound under Daphne, where send() never waits for the client."""
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        self.cookie = f"sessionid={self.client.cookies['sessionid'].value}"
+        self.server = DaphneProcess('localhost', daphne_application)
+        self.server.start()
+        self.addCleanup(self.server.join)
+        self.addCleanup(self.server.terminate)
+        self.assertTrue(self.server.ready.wait(10))
+
+    def connect(self):
+        ws = RawWebSocket(self.server.port.value, f'/ws/chatroom/{self.room.group_name}', self.cookie)
+        self.addCleanup(ws.sock.close)
+        self.assertEqual(ws.status, 101)
+        return ws
+
+    def test_socket_that_never_reads_is_closed(self):
+        ratelimit.reset_stats()
+        ws = self.connect()
+        for i in range(30):
+            ws.send_json({'body': f'message {i}'})
+        self.assertEqual(ws.close_code(), ChatConsumer.CLOSE_TOO_SLOW)
+
+    def test_socket_that_acknowledges_stays_open(self):
+        ws = self.connect()
+        ws.sock.settimeout(0.2)
+        received = 0
+        for i in range(30):
+            ws.send_json({'body': f'message {i}'})
+            try:
+                while True:
+                    opcode, _ = ws.receive()
+                    self.assertNotEqual(opcode, 0x8)
+                    received += 1
+                    ws.send_json({'type': 'received', 'seq': received})
+            except socket.timeout:
+                pass
+        # Well past CHAT_OUTBOX_FRAMES, all acknowledged
+        self.assertGreater(received, 8)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None, CHAT_SEND_BURST=1000)
+class SearchTests(TestCase):
+
+    def setUp(self):
+        ratelimit._local.buckets.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def send(self, body, room=None):
+        room = room or self.room
+        self.client.post(f'/chat/room/{room.group_name}/', {'body': body}, HTTP_HX_REQUEST='true')
+        return GroupMessages.objects.latest('id')
+
+    def test_results_are_ranked_and_paged(self):
+        best = self.send('coffee coffee')
+        ids = {best.id} | {self.send(f'shall we get coffee after meeting number {i}?').id for i in range(24)}
+        self.send('tea instead')
+        pages, cursor = [], None
+        while True:
+            page, cursor = search.search(self.alice, 'Coffee', cursor)
+            pages.append([result['id'] for result in page])
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [20, 5])
+        self.assertEqual(pages[0][0], best.id)
+        self.assertEqual(set(sum(pages, [])), ids)
+        self.assertEqual(len(sum(pages, [])), len(ids))
+        # The last word may be a prefix, every word must appear
+        self.assertEqual(len(search.search(self.alice, 'meeting numb', limit=50)[0]), 24)
+        self.assertEqual(search.search(self.alice, 'tea coffee')[0], [])
+
+    @skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL')
+    def test_rank_ties_page_across_boundaries_on_postgres(self):
+        # Two runs of equal ranks (real, not float8 values), each spanning page boundaries
+        ids = {self.send('an espresso, then more espresso for the road').id for _ in range(12)}
+        ids |= {self.send('one espresso with a long tail of other words after it').id for _ in range(12)}
+        pages, cursor = [], None
+        while True:
+            page, cursor = search.search(self.alice, 'espresso', cursor, limit=5)
+            pages.append([result['id'] for result in page])
+            if cursor is None:
+                break
+        walked = sum(pages, [])
+        self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 4])
+        self.assertEqual(len(walked), len(set(walked)))
+        self.assertEqual(set(walked), ids)
+
+    def test_index_follows_edits_and_deletes(self):
+        kept, edited, deleted, bulk = (self.send(f'lunch plans {i}') for i in range(4))
+        self.client.post(f'/chat/message/{edited.id}/edit/', {'body': 'dinner plans'})
+        self.client.post(f'/chat/message/{deleted.id}/delete/')
+        self.client.post('/chat/messages/delete/', {'ids[]': [bulk.id]})
+        self.assertEqual([r['id'] for r in search.search(self.alice, 'lunch')[0]], [kept.id])
+        self.assertEqual([r['id'] for r in search.search(self.alice, 'dinner')[0]], [edited.id])
+
+    def test_only_the_users_rooms_are_searched(self):
+        mine = self.send('secret handshake')
+        carol, dave = User.objects.create(username='carol'), User.objects.create(username='dave')
+        others, _ = ChatGroup.get_or_create_private(carol, dave)
+        GroupMessages.objects.create(group=others, author=carol, body='secret handshake')
+        search.reindex(GroupMessages.objects.all())
+        self.assertEqual([r['id'] for r in search.search(self.alice, 'secret')[0]], [mine.id])
+        self.assertEqual(len(search.search(carol, 'secret')[0]), 1)
+
+    def test_deleted_accounts_and_rooms_leave_the_index(self):
+        GroupMessages.objects.create(group=self.room, author=self.bob, body='pineapple pizza')
+        mine = self.send('pineapple juice')
+        search.reindex(GroupMessages.objects.all())
+        self.bob.delete()
+        self.assertEqual([r['id'] for r in search.search(self.alice, 'pineapple')[0]], [mine.id])
+        group = ChatGroup.objects.create(groupchat_name='Fruit', admin=self.alice)
+        group.members.add(self.alice)
+        self.send('pineapple cake', group)
+        group.delete()
+        self.assertEqual([r['id'] for r in search.search(self.alice, 'pineapple')[0]], [mine.id])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {search.TABLE}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_endpoint_renders_escaped_highlighted_snippets(self):
+        self.send('<b>bold</b> move, very bold')
+        response = self.client.get('/chat/search/messages/', {'q': 'bold'})
+        html = response.content.decode()
+        self.assertIn('&lt;b&gt;<mark>bold</mark>&lt;/b&gt;', html)
+        self.assertIn('very <mark>bold</mark>', html)
+        self.assertIn('bob', html)
+        self.assertNotIn('search-more', html)
+        self.assertIn('No messages match', self.client.get('/chat/search/messages/', {'q': 'nothing'}).content.decode())
+        self.assertEqual(self.client.get('/chat/search/messages/').content.decode().strip(), '')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None)
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        settings_override = override_settings(CHAT_ARCHIVE_DIR=self.tmp.name, CHAT_ARCHIVE_AFTER_DAYS=30)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        messages = GroupMessages.objects.bulk_create([
+            GroupMessages(group=self.room, author=self.bob if i % 2 else self.alice, body=f'old news {i}') for i in range(100)
+        ])
+        self.ids = [m.id for m in messages]
+        start = timezone.now() - timedelta(days=400)
+        for i, message in enumerate(messages[:70]):
+            GroupMessages.objects.filter(id=message.id).update(created=start + timedelta(minutes=i))
+        search.reindex(GroupMessages.objects.all())
+
+    def archive(self, **options):
+        out = StringIO()
+        with mock.patch.object(archive, 'BLOCK_SIZE', 10):
+            call_command('archive_messages', batch_size=25, pause=0, stdout=out, **options)
+        return out.getvalue()
+
+    def test_old_messages_move_to_compressed_segments(self):
+        self.assertIn('Archived 70 messages from 1 rooms into 3 segments', self.archive())
+        self.assertEqual(list(GroupMessages.objects.values_list('id', flat=True)), self.ids[70:])
+        segments = list(ArchiveSegment.objects.order_by('first_id'))
+        self.assertEqual([s.count for s in segments], [25, 25, 20])
+        self.assertEqual([len(s.blocks) for s in segments], [3, 3, 2])
+        # Blocks are gzip members, so a segment is a plain gzip file
+        with gzip.open(os.path.join(self.tmp.name, segments[0].path), 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['id'] for line in lines], self.ids[:25])
+        self.assertEqual(lines[3]['body'], 'old news 3')
+        # Nothing left to archive
+        self.assertIn('Archived 0 messages', self.archive())
+
+    def test_history_reads_on_into_the_archive(self):
+        self.archive()
+        pages, cursor = [], None
+        while True:
+            with mock.patch('a_rtchat.archive.gzip.decompress', wraps=gzip.decompress) as decompress:
+                page, cursor = history.page_before(self.room.id, cursor)
+            # The page and one more span at most five of the eight blocks
+            self.assertLessEqual(decompress.call_count, 5)
+            pages.append([m.id for m in page])
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [30, 30, 30, 10])
+        self.assertEqual(sum(reversed(pages), []), self.ids)
+
+        self.client.force_login(self.alice)
+        _, cursor = history.page_before(self.room.id, history.page_before(self.room.id)[1])
+        response = self.client.get(f'/chat/room/{self.room.group_name}/history/', {'before': cursor})
+        html = response.content.decode()
+        self.assertIn(f'id="message-{self.ids[10]}"', html)
+        self.assertIn('old news 10', html)
+
+    def test_search_finds_archived_messages(self):
+        self.archive()
+        self.assertEqual(len(search.search(self.alice, 'news', limit=200)[0]), 100)
+        call_command('rebuild_search', stdout=StringIO())
+        results = search.search(self.alice, 'news 12')[0]
+        self.assertEqual([r['id'] for r in results], [self.ids[12]])
+
+    def test_edit_during_archiving_aborts_the_batch(self):
+        write_segment = archive.write_segment
+
+        def write_then_edit(path, messages):
+            written = write_segment(path, messages)
+            GroupMessages.objects.filter(id=messages[5].id).update(body='edited', changed_at=timezone.now())
+            return written
+
+        before = timezone.now() - timedelta(days=30)
+        with mock.patch.object(archive, 'write_segment', write_then_edit):
+            self.assertEqual(archive.archive_batch(self.room.id, before, 25), 0)
+        self.assertEqual(GroupMessages.objects.count(), 100)
+        self.assertFalse(ArchiveSegment.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, str(self.room.id))), [])
+        # The next run archives the edited version
+        self.assertEqual(archive.archive_batch(self.room.id, before, 25), 25)
+        self.assertEqual(archive.read_before(self.room.id, (timezone.now(), 0), 100)[-6].body, 'edited')
+
+    def test_deleting_the_room_deletes_its_segments(self):
+        self.archive()
+        directory = os.path.join(self.tmp.name, str(self.room.id))
+        self.assertEqual(len(os.listdir(directory)), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.delete()
+        self.assertEqual(os.listdir(directory), [])
+
+    def lines(self):
+        lines = []
+        for segment in ArchiveSegment.objects.order_by('first_id'):
+            with gzip.open(os.path.join(self.tmp.name, segment.path), 'rt') as f:
+                lines += [json.loads(line) for line in f]
+        return lines
+
+    def test_deleting_an_account_erases_its_archived_messages(self):
+        self.archive()
+        self.assertEqual(set(ArchiveSegment.objects.first().authors.all()), {self.alice, self.bob})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+        # Every segment held some of bob's messages and was rewritten without them
+        self.assertEqual([line['id'] for line in self.lines()], self.ids[:70:2])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, str(self.room.id)))), 3)
+        self.assertEqual(len(search.search(self.alice, 'news', limit=200)[0]), 50)
+        call_command('rebuild_search', stdout=StringIO())
+        self.assertEqual(len(search.search(self.alice, 'news', limit=200)[0]), 50)
+
+    def test_rebuilt_index_skips_lines_of_deleted_accounts(self):
+        self.archive()
+        # As left by segments written before accounts were erased from them
+        ArchiveSegment.authors.through.objects.filter(user=self.bob).delete()
+        self.bob.delete()
+        self.assertEqual(len(self.lines()), 70)
+        call_command('rebuild_search', stdout=StringIO())
+        self.assertEqual(len(search.search(self.alice, 'news', limit=200)[0]), 50)
+
+    def test_archived_messages_can_be_deleted_but_not_edited(self):
+        self.archive()
+        self.client.force_login(self.alice)
+        response = self.client.get(f'/chat/room/{self.room.group_name}/history/', {'before': history.page_before(self.room.id)[1]})
+        html = response.content.decode()
+        self.assertIn('data-action="open-delete"', html)
+        self.assertNotIn('data-action="open-edit"', html)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/chat/message/{self.ids[4]}/delete/')
+        self.assertContains(response, 'This message has been deleted')
+        # Not someone else's, and hot messages still go the usual way
+        self.assertEqual(self.client.post(f'/chat/message/{self.ids[5]}/delete/').status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/chat/messages/delete/', {'ids[]': [self.ids[6], self.ids[8], self.ids[5], self.ids[90]]})
+        self.assertEqual(response.json(), {'ok': True, 'count': 3})
+        self.assertTrue(GroupMessages.objects.get(id=self.ids[90]).is_deleted)
+
+        lines = {line['id']: line for line in self.lines()}
+        for message_id in (self.ids[4], self.ids[6], self.ids[8]):
+            self.assertEqual((lines[message_id]['is_deleted'], lines[message_id]['body']), (True, ''))
+        self.assertEqual(lines[self.ids[5]]['body'], 'old news 5')
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, str(self.room.id)))), 3)
+        found = {r['id'] for r in search.search(self.alice, 'news', limit=200)[0]}
+        self.assertEqual(found & {self.ids[4], self.ids[6], self.ids[8], self.ids[90]}, set())
+        self.assertEqual(len(found), 96)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None)
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room = ChatGroup.objects.create(groupchat_name='book club', admin=self.alice, retention_days=30)
+        self.room.members.add(self.alice, self.bob)
+        self.keep = ChatGroup.objects.create(groupchat_name='forever', admin=self.alice)
+        self.keep.members.add(self.alice, self.bob)
+        self.old = self.messages(self.room, 25, days=40)
+        self.new = self.messages(self.room, 5, days=1)
+        self.kept = self.messages(self.keep, 5, days=400)
+        inbox.rebuild_inbox([self.room.id, self.keep.id])
+        search.reindex(GroupMessages.objects.all())
+
+    def messages(self, room, count, days):
+        messages = GroupMessages.objects.bulk_create([
+            GroupMessages(group=room, author=self.bob, body=f'chapter {i}') for i in range(count)
+        ])
+        ids = [m.id for m in messages]
+        GroupMessages.objects.filter(id__in=ids).update(created=timezone.now() - timedelta(days=days))
+        return ids
+
+    def purge(self):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True), mock.patch('a_rtchat.retention.time.sleep') as sleep:
+            call_command('purge_messages', batch_size=10, pause=0, stdout=out)
+        return out.getvalue(), sleep
+
+    def test_expired_messages_go_in_paced_batches_with_one_event_each(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(self.room.group_name, channel)
+
+        output, sleep = self.purge()
+        self.assertIn('Purged 25 messages from 1 rooms in 3 batches', output)
+        self.assertEqual(sleep.call_count, 3)
+        self.assertEqual(set(GroupMessages.objects.filter(group=self.room).values_list('id', flat=True)), set(self.new))
+        self.assertEqual(GroupMessages.objects.filter(group=self.keep).count(), 5)
+
+        events = [async_to_sync(layer.receive)(channel) for _ in range(3)]
+        self.assertEqual([e['type'] for e in events], ['purge_handler'] * 3)
+        ranges = [json.loads(e['wire']['json']) for e in events]
+        self.assertEqual([(r['from'], r['to'], r['count']) for r in ranges], [
+            (self.old[0], self.old[9], 10), (self.old[10], self.old[19], 10), (self.old[20], self.old[24], 5),
+        ])
+        # Purged messages are out of search
+        found = {r['id'] for r in search.search(self.alice, 'chapter', limit=100)[0]}
+        self.assertEqual(found, set(self.new) | set(self.kept))
+
+    @override_settings(CHAT_ARCHIVE_AFTER_DAYS=42)
+    def test_purged_unread_messages_leave_the_badge(self):
+        carol = User.objects.create(username='carol')
+        self.room.members.add(carol)
+        # The first ten expired messages are archived; carol has read those, alice nothing
+        GroupMessages.objects.filter(id__in=self.old[:10]).update(created=timezone.now() - timedelta(days=45))
+        ChatReadState.objects.create(user=carol, group=self.room, last_read_at=timezone.now() - timedelta(days=43))
+        inbox.rebuild_inbox([self.room.id])
+        unread_of = lambda user: {item['group'].id: item['unread'] for item in build_sidebar(user)}[self.room.id]
+        self.assertEqual((unread_of(self.alice), unread_of(carol), unread_of(self.bob)), (30, 20, 0))
+        with tempfile.TemporaryDirectory() as tmp, override_settings(CHAT_ARCHIVE_DIR=tmp):
+            call_command('archive_messages', pause=0, room=[self.room.group_name], stdout=StringIO())
+            self.assertIn('Purged 25 messages', self.purge()[0])
+        self.assertEqual((unread_of(self.alice), unread_of(carol), unread_of(self.bob)), (5, 5, 0))
+        self.assertEqual(
+            {row.user_id: row.unread_count for row in ChatInbox.objects.filter(group=self.room)},
+            {self.alice.id: 5, carol.id: 5, self.bob.id: 0},
+        )
+
+    @override_settings(CHAT_ARCHIVE_AFTER_DAYS=20)
+    def test_archived_messages_expire_too(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(CHAT_ARCHIVE_DIR=tmp):
+            GroupMessages.objects.filter(id__in=self.old[20:]).update(created=timezone.now() - timedelta(days=25))
+            call_command('archive_messages', batch_size=15, pause=0, room=[self.room.group_name], stdout=StringIO())
+            self.assertEqual(ArchiveSegment.objects.filter(group=self.room).count(), 2)
+
+            self.purge()
+            # The first segment has expired whole, the second is rewritten with its five live messages
+            segment = ArchiveSegment.objects.get(group=self.room)
+            self.assertEqual((segment.first_id, segment.last_id, segment.count), (self.old[20], self.old[24], 5))
+            self.assertEqual(len(os.listdir(os.path.join(tmp, str(self.room.id)))), 1)
+            page, cursor = history.page_before(self.room.id)
+            self.assertEqual([m.id for m in page], self.old[20:] + self.new)
+            self.assertIsNone(cursor)
+
+    def test_room_admin_sets_the_policy(self):
+        self.client.force_login(self.alice)
+        self.client.post(f'/chat/edit/{self.keep.group_name}/', {'groupchat_name': 'forever', 'retention_days': 7})
+        self.keep.refresh_from_db()
+        self.assertEqual(self.keep.retention_days, 7)
+
+        self.client.force_login(self.bob)
+        response = self.client.post(f'/chat/edit/{self.keep.group_name}/', {'groupchat_name': 'forever', 'retention_days': ''})
+        self.assertEqual(response.status_code, 404)
+        self.keep.refresh_from_db()
+        self.assertEqual(self.keep.retention_days, 7)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None)
+class RevisionTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatGroup.get_or_create_private(self.alice, self.bob)
+        self.message = GroupMessages.objects.create(group=self.room, author=self.alice, body='see you at noon')
+        self.client.force_login(self.alice)
+
+    def edit(self, body):
+        self.client.post(f'/chat/message/{self.message.id}/edit/', {'body': body})
+        self.message.refresh_from_db()
+
+    def test_deltas_are_small_and_exact(self):
+        long_text = ''.join(f'line {i}: caf\u00e9 \u2615\n' for i in range(1500))[:25000]
+        cases = [
+            ('', 'new'),
+            ('same', 'same'),
+            ('see you at noon', 'see you at one'),
+            (long_text, long_text[:12000] + 'inserted ' + long_text[12000:]),
+            (long_text, long_text.replace('line 700', 'row 700')),
+            (long_text, 'x' * 25000),
+        ]
+        for source, target in cases:
+            ops = revisions.diff(source, target)
+            self.assertEqual(revisions.apply(source, ops), target)
+        # A small change to a long body costs a few bytes
+        edited = long_text[:12000] + 'inserted ' + long_text[12000:]
+        self.assertLess(len(json.dumps(revisions.diff(edited, long_text))), 40)
+
+    def test_every_revision_can_be_rebuilt(self):
+        self.edit('see you at one')
+        self.edit('see you at one, at the cafe')
+        self.edit('see you at one, at the cafe')  # no change, no revision
+        self.edit('running late!')
+        self.assertEqual(MessageRevision.objects.filter(message=self.message).count(), 3)
+
+        html = self.client.get(f'/chat/message/{self.message.id}/history/').content.decode()
+        bodies = ['see you at noon', 'see you at one', 'see you at one, at the cafe', 'running late!']
+        positions = [html.index(body + '</div>') for body in bodies]
+        self.assertEqual(positions, sorted(positions))
+        self.assertIn('Original', html)
+        self.assertIn('Current', html)
+
+        for number, body in enumerate(bodies):
+            response = self.client.get(f'/chat/message/{self.message.id}/history/', {'revision': number})
+            self.assertIn(body + '</div>', response.content.decode())
+            self.assertEqual(revisions.body_at(self.message, number), body)
+        self.assertEqual(self.client.get(f'/chat/message/{self.message.id}/history/', {'revision': 4}).status_code, 404)
+
+        # Members only, and nothing of deleted messages
+        self.client.force_login(User.objects.create(username='eve'))
+        self.assertEqual(self.client.get(f'/chat/message/{self.message.id}/history/').status_code, 404)
+        self.client.force_login(self.alice)
+        self.client.post(f'/chat/message/{self.message.id}/delete/')
+        self.assertEqual(self.client.get(f'/chat/message/{self.message.id}/history/').status_code, 404)
+
+    def test_edit_builds_on_the_version_it_locked(self):
+        from . import views
+        stale = GroupMessages.objects.get(id=self.message.id)
+        real = views.get_object_or_404
+
+        def edited_meanwhile(model, **kwargs):
+            # Another edit commits after this one's first read, before it takes the lock
+            if model is GroupMessages:
+                current = GroupMessages.objects.get(id=self.message.id)
+                revisions.record(current, 'see you at one')
+                GroupMessages.objects.filter(id=current.id).update(body='see you at one', edited=True, edited_at=timezone.now())
+                return stale
+            return real(model, **kwargs)
+
+        with mock.patch.object(views, 'get_object_or_404', edited_meanwhile):
+            self.edit('running late!')
+        self.assertEqual(list(MessageRevision.objects.filter(message=self.message).values_list('number', flat=True)), [0, 1])
+        self.assertEqual(
+            [version['body'] for version in revisions.history(self.message)],
+            ['see you at noon', 'see you at one', 'running late!'],
+        )
+
+    def test_delete_before_the_lock_stops_the_edit(self):
+        from . import views
+        real = views.get_object_or_404
+        calls = []
+
+        def deleted_meanwhile(model, **kwargs):
+            calls.append(model)
+            if len(calls) == 2:
+                # A delete commits after the edit's first read, before it takes the lock
+                GroupMessages.objects.filter(id=self.message.id).update(is_deleted=True, changed_at=timezone.now())
+            return real(model, **kwargs)
+
+        with mock.patch.object(views, 'get_object_or_404', deleted_meanwhile):
+            response = self.client.post(f'/chat/message/{self.message.id}/edit/', {'body': 'too late'})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((response.status_code, response.json()), (400, {'ok': False, 'error': 'deleted'}))
+        self.message.refresh_from_db()
+        self.assertEqual((self.message.body, self.message.edited), ('see you at noon', False))
+        self.assertFalse(MessageRevision.objects.filter(message=self.message).exists())
+
+    def test_reading_messages_never_touches_the_history(self):
+        self.edit('see you at one')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/chat/room/{self.room.group_name}/')
+            history.page_before(self.room.id)
+            history.missed(self.room.id, 0)
+        self.assertIn('message-history', response.content.decode())
+        self.assertFalse([q['sql'] for q in queries.captured_queries if 'messagerevision' in q['sql']])
+
+    def test_archived_messages_keep_their_history(self):
+        self.edit('see you at one')
+        GroupMessages.objects.filter(id=self.message.id).update(created=timezone.now() - timedelta(days=400))
+        with tempfile.TemporaryDirectory() as tmp, override_settings(CHAT_ARCHIVE_DIR=tmp):
+            self.assertEqual(archive.archive_batch(self.room.id, timezone.now() - timedelta(days=30)), 1)
+            archived = archive.segment_messages(ArchiveSegment.objects.get())[0]
+        self.assertEqual(archived.body, 'see you at one')
+        (number, _, delta), = archived.archived_revisions
+        self.assertEqual((number, revisions.apply(archived.body, json.loads(delta))), (0, 'see you at noon'))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CACHES=LOCAL_CACHES, CHAT_REDIS_URL=None, CHAT_SEND_BURST=1000)
+class QueryPlanTests(TransactionTestCase):
+    """
+    Runs the hot paths of the views and the consumer against a seeded
+    database and EXPLAINs every statement they issue: none may read a chat
+    table in full (see a_rtchat/queryplans.py).
+    """
+
+    def setUp(self):
+        ratelimit._local.buckets.clear()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(40)]
+        self.me = self.users[0]
+        self.dms = [ChatGroup.get_or_create_private(self.me, other)[0] for other in self.users[1:21]]
+        self.groups = []
+        for n in range(5):
+            group = ChatGroup.objects.create(groupchat_name=f'group {n}', admin=self.users[n])
+            group.members.add(*self.users[n * 5:n * 5 + 12])
+            self.groups.append(group)
+        rooms = self.dms + self.groups
+        GroupMessages.objects.bulk_create([
+            GroupMessages(group=rooms[i % len(rooms)], author=self.users[i % 13], body=f'message {i}') for i in range(3000)
+        ])
+        inbox.rebuild_inbox([room.id for room in rooms])
+        search.reindex(GroupMessages.objects.all())
+        for room in rooms[::3]:
+            receipts.mark_read(room.id, self.me.id)
+        BlockedUser.objects.create(blocker=self.users[30], blocked=self.me)
+        self.client.force_login(self.me)
+
+    def assertNoFullScans(self, statements):
+        report = queryplans.plan_report(statements)
+        self.assertFalse(report, '\n\n'.join(f'{", ".join(tables)} scanned in full by:\n{sql}' for sql, tables in report))
+
+    def test_views_use_indexes(self):
+        dm, group = self.dms[0], self.groups[0]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/chat/room/{dm.group_name}/')
+            self.client.get(f'/chat/room/{dm.group_name}/history/', {'before': response.context['history_next_cursor']})
+            self.client.get(f'/chat/room/{group.group_name}/')
+            self.client.get('/chat/sidebar/', {'cursor': sidebar_page(self.me, limit=10)[1]})
+            self.client.get('/chat/sidebar/', {'q': 'user1'})
+            _, cursor = search.search(self.me, 'message 1', limit=10)
+            self.client.get('/chat/search/messages/', {'q': 'message 1', 'cursor': cursor})
+            self.client.post(f'/chat/room/{dm.group_name}/', {'body': 'hot path'}, HTTP_HX_REQUEST='true')
+            message = GroupMessages.objects.filter(author=self.me).latest('id')
+            self.assertEqual(message.body, 'hot path')
+            self.client.post(f'/chat/message/{message.id}/edit/', {'body': 'edited'})
+            self.client.post(f'/chat/message/{message.id}/delete/')
+            self.client.post('/chat/messages/delete/', {'ids[]': [message.id]})
+            # DM lookup
+            self.client.get(f'/chat/{self.users[5].username}/')
+        self.assertNoFullScans([query['sql'] for query in queries.captured_queries])
+
+    def test_unindexed_query_is_reported(self):
+        sql = str(GroupMessages.objects.filter(edited=True).query)
+        self.assertEqual(queryplans.full_scans(sql), ['a_rtchat_groupmessages'])
+        self.assertEqual(queryplans.full_scans(str(GroupMessages.objects.filter(group=self.dms[0]).query)), [])
+
+    def test_consumer_uses_indexes(self):
+        dm = self.dms[1]
+        last = GroupMessages.objects.filter(group=dm).order_by('id')[10]
+
+        async def scenario():
+            socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+            socket.scope['user'] = self.me
+            await socket.connect()
+            await socket.send_json_to({'type': 'open', 'room': dm.group_name, 'after': last.id})
+            await socket.send_json_to({'body': 'over the socket', 'nonce': 'plan-1'})
+            await socket.receive_nothing()
+            await socket.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(scenario)()
+        self.assertGreater(len(queries), 5)
+        self.assertNoFullScans([query['sql'] for query in queries.captured_queries])
@@ -0,0 +1,156 @@
+# a_rtchat/typists.py
+"""
+Typing indicators, kept out of the database entirely.
+
+A socket reports that its user is typing at most once per
+CHAT_TYPING_INTERVAL per room; one atomic call then records the user as a
+typist of the room and, if nobody else has in the last interval, claims the
+room's broadcast. Only the claimant sends, and its event lists everyone who
+typed in the room recently. However many members are typing, a room fans out
+at most one typing event per interval, so a room full of typists costs its
+members one small frame each per interval rather than one per typist.
+
+Typists live in Redis when CHAT_REDIS_URL is set, otherwise in process. If
+Redis is unreachable, typing goes unreported.
+"""
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from . import protocol
+from .redis_store import get_redis
+
+# Names spelled out in the indicator; the rest are counted
+SHOWN = 3
+
+NOTE_TYPIST = """
+local now, interval, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+if not redis.call('SET', KEYS[1], 1, 'NX', 'PX', interval) then return 0 end
+redis.call('ZADD', KEYS[2], now, ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl)
+redis.call('PEXPIRE', KEYS[2], ttl)
+if not redis.call('SET', KEYS[3], 1, 'NX', 'PX', interval) then return 0 end
+return redis.call('ZRANGEBYSCORE', KEYS[2], now - ttl, '+inf')
+"""
+
+
+def interval():
+    return getattr(settings, 'CHAT_TYPING_INTERVAL', 3.0)
+
+
+def ttl():
+    """How long a typist stays listed (and an indicator shown) after their last report."""
+    return 2 * interval()
+
+
+def user_key(group_id, user_id):
+    return f'chat:typing:{group_id}:user:{user_id}'
+
+
+def room_key(group_id):
+    return f'chat:typing:{group_id}'
+
+
+def broadcast_key(group_id):
+    return f'chat:typing:{group_id}:sent'
+
+
+class LocalTypists:
+
+    def __init__(self):
+        self.until = {}
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key, now, span):
+        if len(self.until) > 10000:
+            self.until = {k: until for k, until in self.until.items() if until > now}
+        if self.until.get(key, 0) > now:
+            return False
+        self.until[key] = now + span
+        return True
+
+    def note(self, group_id, user_id, member, now, interval, ttl):
+        with self.lock:
+            if not self.claim(user_key(group_id, user_id), now, interval):
+                return None
+            typists = self.rooms.setdefault(group_id, {})
+            typists[member] = now
+            for name, seen in list(typists.items()):
+                if seen <= now - ttl:
+                    del typists[name]
+            if not self.claim(broadcast_key(group_id), now, interval):
+                return None
+            return sorted(typists, key=typists.get)
+
+
+class RedisTypists:
+
+    def __init__(self, client):
+        self.r = client
+
+    def note(self, group_id, user_id, member, now, interval, ttl):
+        keys = (user_key(group_id, user_id), room_key(group_id), broadcast_key(group_id))
+        typists = self.r.eval(NOTE_TYPIST, 3, *keys, int(now * 1000), int(interval * 1000), int(ttl * 1000), member)
+        return typists or None
+
+
+_local = LocalTypists()
+
+
+def _store():
+    client = get_redis()
+    return RedisTypists(client) if client is not None else _local
+
+
+def typing(group_id, group_name, user_id, name):
+    """
+    Record that `user_id` (shown as `name`) is typing in the room. Returns the
+    typing event to broadcast to the room, or None if this report is covered
+    by one already sent in the last interval.
+    """
+    try:
+        members = _store().note(group_id, user_id, f'{user_id}:{name}', time.time(), interval(), ttl())
+    except redis.RedisError:
+        return None
+    if not members:
+        return None
+    typists = [(int(uid), typist) for uid, typist in (member.split(':', 1) for member in members)]
+    return typing_event(group_name, typists)
+
+
+def typing_event(group_name, typists):
+    """
+    One event for the room, oldest typist first. Viewers never see themselves,
+    so besides the indicator everyone sees ('all') there is one variant per
+    named typist and one ('hidden') for a typist among those only counted.
+    """
+    shown = typists[:SHOWN]
+    others = len(typists) - len(shown)
+
+    def render(names, others):
+        return render_to_string('a_rtchat/partials/typing.html', {'names': names, 'others': others, 'ttl': ttl()})
+
+    names = [typist for _, typist in shown]
+    html = {'all': render(names, others)}
+    if others:
+        html['hidden'] = render(names, others - 1)
+    for uid, _ in shown:
+        html[str(uid)] = render([typist for other, typist in shown if other != uid], others)
+    return {
+        'type': 'typing_handler',
+        'room': group_name,
+        'typists': [uid for uid, _ in typists],
+        'html': html,
+        'wire': protocol.encode(protocol.typing_payload(group_name, typists, SHOWN + 1)),
+    }
+
+
+def viewer_key(event, user_id):
+    """Which of the event's variants `user_id` sees."""
+    if str(user_id) in event['html']:
+        return str(user_id)
+    return 'hidden' if user_id in event['typists'] else 'all'
@@ -0,0 +1,97 @@
+# a_rtchat/unread.py
+"""
+Per-user unread counters in Redis: one hash per user, group id -> count.
+
+ChatInbox.unread_count stays the durable copy; the hash lets the sidebar
+read every badge for a user in a single round trip. A hash only exists once
+it has been seeded from the database (it carries a "_" marker field), so
+increments never create a partial hash that would under-report.
+"""
+import redis
+
+from .models import ChatInbox
+from .redis_store import get_redis
+
+SEEDED = '_'
+# Hashes expire and get re-seeded from the database, which also heals any drift
+TTL_SECONDS = 24 * 60 * 60
+
+# Increment field ARGV[1] in every hash in KEYS that has been seeded
+_INCREMENT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HINCRBY', key, ARGV[1], 1)
+    end
+end
+"""
+
+
+def counter_key(user_id):
+    return f'chat:unread:{user_id}'
+
+
+def increment(group_id, user_ids):
+    r = get_redis()
+    if r is None or not user_ids:
+        return
+    try:
+        r.eval(_INCREMENT, len(user_ids), *[counter_key(uid) for uid in user_ids], group_id)
+    except redis.RedisError:
+        # Redis is optional; the next reconcile or re-seed fixes the hash
+        pass
+
+
+def reset(user_id, group_id):
+    r = get_redis()
+    if r is None:
+        return
+    try:
+        r.hdel(counter_key(user_id), group_id)
+    except redis.RedisError:
+        pass
+
+
+def forget(user_ids):
+    """Drop hashes so they are re-seeded from the database on next read."""
+    r = get_redis()
+    if r is None or not user_ids:
+        return
+    try:
+        r.delete(*[counter_key(uid) for uid in user_ids])
+    except redis.RedisError:
+        pass
+
+
+def db_counts(user_id):
+    return dict(
+        ChatInbox.objects.filter(user_id=user_id, unread_count__gt=0)
+        .values_list('group_id', 'unread_count')
+    )
+
+
+def store(pipe, user_id, counts):
+    key = counter_key(user_id)
+    pipe.delete(key)
+    pipe.hset(key, mapping={SEEDED: 1, **counts})
+    pipe.expire(key, TTL_SECONDS)
+
+
+def unread_counts(user_id):
+    """
+    {group_id: unread} for a user in one Redis round trip, seeding the hash
+    from the database when it is missing. None when Redis is unavailable.
+    """
+    r = get_redis()
+    if r is None:
+        return None
+    try:
+        data = r.hgetall(counter_key(user_id))
+        if data:
+            return {int(gid): int(n) for gid, n in data.items() if gid != SEEDED}
+        counts = db_counts(user_id)
+        pipe = r.pipeline()
+        store(pipe, user_id, counts)
+        pipe.execute()
+        return counts
+    except redis.RedisError:
+        return None
@@ -7,9 +7,12 @@ from .views import *
 urlpatterns = [
     path('', chat_index, name="home"),
     path('chat/room/<chatroom_name>/',chat_view, name="chatroom"),
+    path('chat/room/<chatroom_name>/history/', chat_history, name="chat-history"),
     # Specific paths must come before the catch-all username path
     path('chat/new_groupchat/',create_groupchat, name="new-groupchat"),
     path('chat/search/', chat_user_search, name="chat-user-search"),
+    path('chat/search/messages/', chat_message_search, name="chat-message-search"),
+    path('chat/sidebar/', chat_sidebar, name="chat-sidebar"),
     path('chat/start/', chat_start_new, name="chat-start-new"),
     path('chat/<username>/',get_or_create_chatroom, name="start-chat"),
     path('chat/edit/<chatroom_name>/',chatroom_edit_view,name="edit-chatroom"),
@@ -17,5 +20,6 @@ urlpatterns = [
     path('chat/leave/<chatroom_name>/', chatroom_leave_view, name="chatroom-leave"),
     path('chat/message/<int:message_id>/delete/', message_delete, name="message-delete"),
     path('chat/message/<int:message_id>/edit/', message_edit, name="message-edit"),
+    path('chat/message/<int:message_id>/history/', message_history, name="message-history"),
     path('chat/messages/delete/', messages_delete_bulk, name="messages-delete-bulk"),
 ]
\ No newline at end of file
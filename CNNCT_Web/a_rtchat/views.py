@@ -11,15 +11,19 @@ from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from datetime import datetime, timezone as dt_timezone
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Q
 from django.views.decorators.csrf import csrf_exempt
 from a_users.models import BlockedUser
+from .sidebar import push_sidebar_updates, sidebar_page
+from .sidebar_cache import render_sidebar
+from .fanout import message_update_events, update_events
+from . import archive, history, inbox, presence, ratelimit, receipts, revisions, search
 @login_required
 def chat_view(request, chatroom_name='public-chat'):
     chat_group=get_object_or_404(ChatGroup,group_name=chatroom_name)
-    # Fetch latest 30 messages then reverse to render oldest -> newest
-    latest_thirty = chat_group.chat_messages.order_by('-created', '-id')[:30]
-    chat_messages = list(latest_thirty)[::-1]
+    # Latest page, oldest -> newest; older pages load as the user scrolls up (chat_history)
+    chat_messages, history_next_cursor = history.page_before(chat_group.id)
     form=ChatmessageCreateForm()
 
     other_user= None
@@ -30,7 +34,7 @@ def chat_view(request, chatroom_name='public-chat'):
         for member in chat_group.members.all():
             if member != request.user:
                 other_user = member
-                other_user_online = chat_group.users_online.filter(id=other_user.id).exists()
+                other_user_online = presence.is_online(chat_group.id, other_user.id)
                 break
         # If current user has blocked the other, do not show the room
         if other_user and BlockedUser.objects.filter(blocker=request.user, blocked=other_user).exists():
@@ -46,7 +50,7 @@ def chat_view(request, chatroom_name='public-chat'):
     
 
 
-    if request.htmx:
+    if request.htmx and request.method == 'POST':
         form= ChatmessageCreateForm(request.POST)
         if form.is_valid:
             message = form.save(commit=False)
@@ -56,29 +60,18 @@ def chat_view(request, chatroom_name='public-chat'):
             if chat_group.is_private and other_user:
                 if BlockedUser.objects.filter(blocker=other_user, blocked=request.user).exists():
                     return JsonResponse({'ok': False, 'error': 'blocked'}, status=403)
+            if not ratelimit.allow(request.user.id):
+                return JsonResponse({'ok': False, 'error': 'rate_limited'}, status=429)
             message.save()
+            inbox.record_message(message)
+            search.index_message(message)
+            push_sidebar_updates(chat_group)
             context={
                 'message':message,
                 'user':request.user 
             }
         return render (request,'a_rtchat/partials/chat_messages_p.html',context) 
     
-    # Build de-duplicated sidebar lists
-    group_chats = request.user.chat_groups.filter(groupchat_name__isnull=False)
-    private_chats_qs = request.user.chat_groups.filter(is_private=True)
-    unique_private = {}
-    for room in private_chats_qs:
-        other = None
-        for member in room.members.all():
-            if member != request.user:
-                other = member
-                break
-        if other:
-            # keep the first room per other user
-            unique_private.setdefault(other.id, (room, other))
-
-    sidebar_private_chats = list(unique_private.values())  # list of tuples (room, other_user)
-
     # Mark this chat as read for the current user (create state if it doesn't exist)
     if request.user.is_authenticated:
         from .models import ChatReadState
@@ -87,82 +80,15 @@ def chat_view(request, chatroom_name='public-chat'):
         read_state.hidden = False  # opening the chat should unhide it
         read_state.save(update_fields=['last_read_at'])
         read_state.save(update_fields=['last_read_at','hidden'])
+        if inbox.mark_read(request.user, chat_group):
+            # clear the badge in the user's other open tabs
+            push_sidebar_updates(chat_group, [request.user.id], move_to_top=False)
 
         # Mark inbound messages as READ on opening the chat
-        inbound_qs = GroupMessages.objects.filter(group=chat_group).exclude(author=request.user)
-        updated_ids = list(inbound_qs.filter(status__lt=GroupMessages.STATUS_READ).values_list('id', flat=True))
-        if updated_ids:
-            GroupMessages.objects.filter(id__in=updated_ids).update(status=GroupMessages.STATUS_READ)
-            # Broadcast updates to re-render ticks in realtime for sender
-            channel_layer = get_channel_layer()
-            for mid in updated_ids:
-                event = {
-                    'type': 'message_update_handler',
-                    'message_id': mid,
-                    'chatroom_name': chat_group.group_name,
-                }
-                async_to_sync(channel_layer.group_send)(chat_group.group_name, event)
-
-    # Compute unread counts and request flags for sidebar rooms
-    from django.db.models import Max
-    target_groups = list({g.id for g in group_chats} | {t[0].id for t in sidebar_private_chats})
-    read_states = ChatReadState.objects.filter(user=request.user, group_id__in=target_groups)
-    state_map = {rs.group_id: rs.last_read_at for rs in read_states}
-    hidden_map = {rs.group_id: rs.hidden for rs in read_states}
-
-    # Attach unread_count and latest inbound timestamp to each group chat object
-    for g in group_chats:
-        last_read = state_map.get(g.id)
-        qs = GroupMessages.objects.filter(group=g).exclude(author=request.user)
-        if last_read:
-            qs = qs.filter(created__gt=last_read)
-        g.unread_count = qs.count()
-        latest_inbound = GroupMessages.objects.filter(group=g).exclude(author=request.user).order_by('-created').values_list('created', flat=True).first()
-        g.latest_inbound_at = latest_inbound
-
-    # Enrich private chats tuples with unread_count and request flag (no last_read yet and has inbound msgs)
-    enriched_private = []
-    for room, other in sidebar_private_chats:
-        # Exclude rooms where current user has blocked the other user
-        if BlockedUser.objects.filter(blocker=request.user, blocked=other).exists():
-            continue
-        last_read = state_map.get(room.id)
-        is_hidden = hidden_map.get(room.id, False)
-        inbound_qs = GroupMessages.objects.filter(group=room).exclude(author=request.user)
-        unread_qs = inbound_qs
-        if last_read:
-            unread_qs = inbound_qs.filter(created__gt=last_read)
-        unread_count = unread_qs.count()
-        is_request = (last_read is None and inbound_qs.exists())
-        latest_inbound = inbound_qs.order_by('-created').values_list('created', flat=True).first()
-        # If hidden, only show if there are unread inbound messages
-        if is_hidden and unread_count == 0:
-            continue
-        enriched_private.append((room, other, unread_count, is_request, latest_inbound))
-    # Combine group and private chats and sort by most recent inbound timestamp
-    def ts_or_min(ts):
-        return ts or datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
-    group_chats = list(group_chats)
-    combined = []
-    for g in group_chats:
-        combined.append({
-            'kind': 'group',
-            'group': g,
-            'other': None,
-            'unread': getattr(g, 'unread_count', 0),
-            'is_request': False,
-            'latest': getattr(g, 'latest_inbound_at', None),
-        })
-    for room, other, unread_count, is_request, latest_inbound in enriched_private:
-        combined.append({
-            'kind': 'private',
-            'group': room,
-            'other': other,
-            'unread': unread_count,
-            'is_request': is_request,
-            'latest': latest_inbound,
-        })
-    combined.sort(key=lambda x: ts_or_min(x['latest']), reverse=True)
+        event = receipts.mark_read(chat_group.id, request.user.id)
+        if event:
+            # One event re-renders the ticks in realtime for senders
+            async_to_sync(get_channel_layer().group_send)(chat_group.group_name, event)
 
     context = {
         'chat_messages':chat_messages,
@@ -171,7 +97,8 @@ def chat_view(request, chatroom_name='public-chat'):
         'other_user_online': other_user_online,
         'chatroom_name': chatroom_name,
         'chat_group': chat_group,
-        'sidebar_chats': combined,
+        'history_next_cursor': history_next_cursor,
+        'sidebar_html': render_sidebar(request.user),
     }
     return render(request,'a_rtchat/chat.html',context)
 
@@ -179,99 +106,66 @@ def chat_view(request, chatroom_name='public-chat'):
 @login_required
 def chat_index(request):
     """Render the chat UI with no room selected (blank state)."""
-    # Build de-duplicated sidebar lists (same as chat_view but without a selected room)
-    group_chats = request.user.chat_groups.filter(groupchat_name__isnull=False)
-    private_chats_qs = request.user.chat_groups.filter(is_private=True)
-
-    unique_private = {}
-    for room in private_chats_qs:
-        other = None
-        for member in room.members.all():
-            if member != request.user:
-                other = member
-                break
-        if other:
-            unique_private.setdefault(other.id, (room, other))
-
-    sidebar_private_chats = list(unique_private.values())
-
-    # Compute unread counts and request flags for sidebar rooms
-    from django.db.models import Max
-    from .models import ChatReadState, GroupMessages
-    target_groups = list({g.id for g in group_chats} | {t[0].id for t in sidebar_private_chats})
-    read_states = ChatReadState.objects.filter(user=request.user, group_id__in=target_groups)
-    state_map = {rs.group_id: rs.last_read_at for rs in read_states}
-    hidden_map = {rs.group_id: rs.hidden for rs in read_states}
-
-    for g in group_chats:
-        last_read = state_map.get(g.id)
-        qs = GroupMessages.objects.filter(group=g).exclude(author=request.user)
-        if last_read:
-            qs = qs.filter(created__gt=last_read)
-        g.unread_count = qs.count()
-        latest_inbound = GroupMessages.objects.filter(group=g).exclude(author=request.user).order_by('-created').values_list('created', flat=True).first()
-        g.latest_inbound_at = latest_inbound
-
-    enriched_private = []
-    for room, other in sidebar_private_chats:
-        # Exclude rooms where current user has blocked the other user
-        try:
-            from a_users.models import BlockedUser as BU
-            if BU.objects.filter(blocker=request.user, blocked=other).exists():
-                continue
-        except Exception:
-            pass
-        last_read = state_map.get(room.id)
-        is_hidden = hidden_map.get(room.id, False)
-        inbound_qs = GroupMessages.objects.filter(group=room).exclude(author=request.user)
-        unread_qs = inbound_qs
-        if last_read:
-            unread_qs = inbound_qs.filter(created__gt=last_read)
-        unread_count = unread_qs.count()
-        is_request = (last_read is None and inbound_qs.exists())
-        latest_inbound = inbound_qs.order_by('-created').values_list('created', flat=True).first()
-        if is_hidden and unread_count == 0:
-            continue
-        enriched_private.append((room, other, unread_count, is_request, latest_inbound))
-
-    from datetime import datetime, timezone as dt_timezone
-    def ts_or_min(ts):
-        return ts or datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
-    sidebar_private_chats = sorted(
-        enriched_private,
-        key=lambda t: ((t[2] > 0), ts_or_min(t[4])),
-        reverse=True,
-    )
-
-    group_chats = list(group_chats)
-    group_chats.sort(key=lambda g: ((getattr(g, 'unread_count', 0) > 0), ts_or_min(getattr(g, 'latest_inbound_at', None))), reverse=True)
-
     context = {
         'chat_messages': [],
         'form': None,
         'other_user': None,
         'chatroom_name': None,
         'chat_group': None,
-        'sidebar_group_chats': group_chats,
-        'sidebar_private_chats': sidebar_private_chats,
+        'sidebar_html': render_sidebar(request.user),
     }
     return render(request, 'a_rtchat/chat.html', context)
 
+
+@login_required
+def chat_sidebar(request):
+    """HTMX endpoint: one keyset page of the sidebar, optionally filtered by name."""
+    query = (request.GET.get('q') or '').strip()
+    cursor = request.GET.get('cursor') or None
+    sidebar_chats, sidebar_next_cursor = sidebar_page(request.user, cursor=cursor, query=query)
+    context = {
+        'sidebar_chats': sidebar_chats,
+        'sidebar_next_cursor': sidebar_next_cursor,
+        'cursor': cursor,
+        'query': query,
+    }
+    return render(request, 'a_rtchat/partials/sidebar_page.html', context)
+
+@login_required
+def chat_message_search(request):
+    """HTMX endpoint: one page of the messages in the user's rooms matching `q`, best match first."""
+    query = (request.GET.get('q') or '').strip()
+    cursor = request.GET.get('cursor') or None
+    search_results, search_next_cursor = search.search(request.user, query, cursor=cursor)
+    context = {
+        'search_results': search_results,
+        'search_next_cursor': search_next_cursor,
+        'cursor': cursor,
+        'query': query,
+    }
+    return render(request, 'a_rtchat/partials/message_search_page.html', context)
+
+@login_required
+def chat_history(request, chatroom_name):
+    """HTMX endpoint: the keyset page of messages before `before`, prepended above the loaded ones."""
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if (chat_group.is_private or chat_group.groupchat_name) and not chat_group.members.filter(id=request.user.id).exists():
+        raise Http404()
+    chat_messages, history_next_cursor = history.page_before(chat_group.id, request.GET.get('before'))
+    context = {
+        'chat_messages': chat_messages,
+        'history_next_cursor': history_next_cursor,
+        'chatroom_name': chatroom_name,
+    }
+    return render(request, 'a_rtchat/partials/history_page.html', context)
+
 @login_required
 def get_or_create_chatroom(request, username):
     if request.user.username ==username:
         return redirect('home')
     
     other_user = User.objects.get(username=username)
-    # Find an existing private room shared between the two users
-    chatroom = (
-        ChatGroup.objects.filter(is_private=True, members=request.user)
-        .filter(members=other_user)
-        .first()
-    )
-    if not chatroom:
-        chatroom = ChatGroup.objects.create(is_private=True)
-        chatroom.members.add(other_user, request.user)
+    chatroom, _ = ChatGroup.get_or_create_private(request.user, other_user)
 
     return redirect('chatroom', chatroom.group_name)
 
@@ -349,6 +243,7 @@ def chatroom_leave_view(request, chatroom_name):
             rs, _ = ChatReadState.objects.get_or_create(user=request.user, group=chat_group)
             rs.hidden = True
             rs.save(update_fields=['hidden'])
+            inbox.hide(request.user, chat_group)
             messages.success(request, 'Conversation hidden. New messages will unhide it.')
         else:
             chat_group.members.remove(request.user)
@@ -362,26 +257,49 @@ def chatroom_leave_view(request, chatroom_name):
 @login_required
 @require_http_methods(["POST"]) 
 def message_delete(request, message_id):
-    message = get_object_or_404(GroupMessages, id=message_id)
+    message = GroupMessages.objects.filter(id=message_id).first()
+    if message is None:
+        # Not hot any more: it may be one of the user's archived messages
+        deleted = delete_archived(request.user, [message_id])
+        if not deleted:
+            raise Http404()
+        context = { 'message': deleted[0], 'user': request.user }
+        return render(request, 'a_rtchat/chat_message.html', context)
     if message.author != request.user:
         raise Http404()
     message.is_deleted = True
     message.body = message.body  # no-op to keep body; still stored but hidden
-    message.save(update_fields=["is_deleted", "body"])
+    message.changed_at = timezone.now()
+    message.save(update_fields=["is_deleted", "body", "changed_at"])
+    inbox.record_deletes([message.id])
+    search.unindex([message.id])
 
     # Broadcast updated rendering to the room via channels
     channel_layer = get_channel_layer()
-    event = {
-        'type': 'message_update_handler',
-        'message_id': message.id,
-        'chatroom_name': message.group.group_name,
-    }
-    async_to_sync(channel_layer.group_send)(message.group.group_name, event)
+    for target, event in update_events([message.id]):
+        async_to_sync(channel_layer.group_send)(target, event)
 
     context = { 'message': message, 'user': request.user }
     return render(request, 'a_rtchat/chat_message.html', context)
 
 
+def delete_archived(user, message_ids):
+    """Delete `user`'s archived messages among `message_ids` and tell their rooms; returns the messages deleted."""
+    with transaction.atomic():
+        deleted = archive.redact(user.id, message_ids)
+    if not deleted:
+        return []
+    search.unindex([message.id for message in deleted])
+    groups = ChatGroup.objects.in_bulk({message.group_id for message in deleted})
+    for message in deleted:
+        message.author = user
+        message.group = groups[message.group_id]
+    channel_layer = get_channel_layer()
+    for target, event in message_update_events(deleted):
+        async_to_sync(channel_layer.group_send)(target, event)
+    return deleted
+
+
 @login_required
 def chat_user_search(request):
     """HTMX endpoint: search users by username or phone number (if present)."""
@@ -428,14 +346,7 @@ def chat_start_new(request):
         return render(request, 'a_rtchat/partials/user_search_results.html', { 'results': [], 'query': raw })
 
     # Reuse existing room or create
-    chatroom = (
-        ChatGroup.objects.filter(is_private=True, members=request.user)
-        .filter(members=candidate)
-        .first()
-    )
-    if not chatroom:
-        chatroom = ChatGroup.objects.create(is_private=True)
-        chatroom.members.add(candidate, request.user)
+    chatroom, _ = ChatGroup.get_or_create_private(request.user, candidate)
 
     return redirect('chatroom', chatroom.group_name)
 
@@ -452,20 +363,24 @@ def messages_delete_bulk(request):
         return JsonResponse({'ok': False, 'error': 'empty'}, status=400)
     # Only allow deleting own messages
     messages_qs = GroupMessages.objects.filter(id__in=id_ints, author=request.user)
+    # Ids that are not hot any more may be archived messages
+    archived = delete_archived(
+        request.user, set(id_ints) - set(GroupMessages.objects.filter(id__in=id_ints).values_list('id', flat=True))
+    )
     if not messages_qs.exists():
+        if archived:
+            return JsonResponse({'ok': True, 'count': len(archived)})
         return JsonResponse({'ok': False, 'error': 'none_owned'}, status=403)
     # Mark as deleted
-    messages_qs.update(is_deleted=True)
+    messages_qs.update(is_deleted=True, changed_at=timezone.now())
+    deleted_ids = list(messages_qs.values_list('id', flat=True))
+    inbox.record_deletes(deleted_ids)
+    search.unindex(deleted_ids)
     # Broadcast updates to re-render each message
     channel_layer = get_channel_layer()
-    for mid, gid in messages_qs.values_list('id', 'group__group_name'):
-        event = {
-            'type': 'message_update_handler',
-            'message_id': mid,
-            'chatroom_name': gid,
-        }
-        async_to_sync(channel_layer.group_send)(gid, event)
-    return JsonResponse({'ok': True, 'count': messages_qs.count()})
+    for target, event in update_events(messages_qs.values_list('id', flat=True)):
+        async_to_sync(channel_layer.group_send)(target, event)
+    return JsonResponse({'ok': True, 'count': messages_qs.count() + len(archived)})
 @login_required
 @require_http_methods(["POST"]) 
 def message_edit(request, message_id):
@@ -474,20 +389,51 @@ def message_edit(request, message_id):
         raise Http404()
     if message.is_deleted:
         return JsonResponse({'ok': False, 'error': 'deleted'}, status=400)
-    new_body = (request.POST.get('body') or '').strip()
-    if new_body:
-        message.body = new_body[:25000]
-        message.edited = True
-        message.edited_at = timezone.now()
-        message.save(update_fields=["body", "edited", "edited_at"]) 
+    new_body = (request.POST.get('body') or '').strip()[:25000]
+    changed = False
+    if new_body and new_body != message.body:
+        with transaction.atomic():
+            # Concurrent edits of the message take turns, so each numbers its revision after the last
+            message = get_object_or_404(GroupMessages.objects.select_for_update(), id=message.id)
+            if message.is_deleted:
+                # Deleted since the check above
+                return JsonResponse({'ok': False, 'error': 'deleted'}, status=400)
+            changed = new_body != message.body
+            if changed:
+                # The body being replaced goes to the edit history first
+                revisions.record(message, new_body)
+                message.body = new_body
+                message.edited = True
+                message.edited_at = message.changed_at = timezone.now()
+                message.save(update_fields=["body", "edited", "edited_at", "changed_at"]) 
+    if changed:
+        inbox.record_edit(message)
+        search.index_message(message)
 
         channel_layer = get_channel_layer()
-        event = {
-            'type': 'message_update_handler',
-            'message_id': message.id,
-            'chatroom_name': message.group.group_name,
-        }
-        async_to_sync(channel_layer.group_send)(message.group.group_name, event)
+        for target, event in update_events([message.id]):
+            async_to_sync(channel_layer.group_send)(target, event)
 
     context = { 'message': message, 'user': request.user }
-    return render(request, 'a_rtchat/chat_message.html', context)
\ No newline at end of file
+    return render(request, 'a_rtchat/chat_message.html', context)
+
+@login_required
+def message_history(request, message_id):
+    """HTMX endpoint: a message's edit history rebuilt from its deltas, or just revision `?revision=N`."""
+    message = get_object_or_404(GroupMessages.objects.select_related('group'), id=message_id, is_deleted=False)
+    chat_group = message.group
+    if (chat_group.is_private or chat_group.groupchat_name) and not chat_group.members.filter(id=request.user.id).exists():
+        raise Http404()
+    if 'revision' in request.GET:
+        try:
+            number = int(request.GET['revision'])
+        except ValueError:
+            raise Http404()
+        body = revisions.body_at(message, number)
+        if body is None:
+            raise Http404()
+        versions = [{'number': number, 'body': body, 'written_at': None}]
+    else:
+        versions = revisions.history(message)
+    context = { 'message': message, 'versions': versions }
+    return render(request, 'a_rtchat/partials/message_history.html', context)
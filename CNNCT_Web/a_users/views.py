@@ -11,6 +11,8 @@ from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
 from .forms import *
 from .models import BlockedUser
+from a_rtchat import sidebar_cache
+from a_rtchat.blocks import push_block_change
 
 def send_email_confirmation(request, user, signup=False):
     """
@@ -72,6 +74,8 @@ def profile_block_user(request, username):
     if target.id == request.user.id:
         return redirect('profile-settings')
     BlockedUser.objects.get_or_create(blocker=request.user, blocked=target)
+    sidebar_cache.bump([request.user.id])
+    push_block_change(request.user, target, True)
     messages.success(request, f'Blocked @{target.username}.')
     # If called via HTMX from chat, redirect back to chat index silently
     if getattr(request, 'htmx', False):
@@ -85,6 +89,8 @@ def profile_block_user(request, username):
 def profile_unblock_user(request, username):
     target = get_object_or_404(User, username=username)
     BlockedUser.objects.filter(blocker=request.user, blocked=target).delete()
+    sidebar_cache.bump([request.user.id])
+    push_block_change(request.user, target, False)
     messages.success(request, f'Unblocked @{target.username}.')
     return redirect('profile-settings')
 